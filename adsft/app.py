@@ -1,8 +1,91 @@
-from .models import KeyValue
-from adsputils import ADSCelery
+from .models import Base, KeyValue, XMLParserChoice, ExtractionState
+from adsputils import ADSCelery, get_date
+from sqlalchemy.exc import IntegrityError
 import os
 
 class ADSFulltextCelery(ADSCelery):
 
-    pass
+    def __init__(self, app_name, *args, **kwargs):
+        ADSCelery.__init__(self, app_name, *args, **kwargs)
+        if self._engine is not None:
+            Base.metadata.create_all(self._engine)
 
+    def get_xml_parser_choices(self):
+        """
+        :return: list of the XML parsers learned for each provider and journal
+        """
+        with self.session_scope() as session:
+            return [choice.toJSON() for choice in
+                    session.query(XMLParserChoice).order_by(XMLParserChoice.provider, XMLParserChoice.bibstem)]
+
+    def save_xml_parser_choices(self, choices, retries=3):
+        """
+        Another worker can insert the same choice at the same time, the
+        transaction is then retried and updates the choice it inserted
+
+        :param choices: list of (provider, bibstem, parser_name, documents)
+        :param retries: number of times the transaction is retried
+        :return: no return
+        """
+        for attempt in range(retries + 1):
+            try:
+                with self.session_scope() as session:
+                    for provider, bibstem, parser_name, documents in choices:
+                        choice = session.query(XMLParserChoice).get((provider, bibstem))
+                        if choice is None:
+                            choice = XMLParserChoice(provider=provider, bibstem=bibstem, documents=0)
+                            session.add(choice)
+                        choice.parser_name = parser_name
+                        choice.documents += documents
+                        choice.updated = get_date()
+                return
+            except IntegrityError:
+                if attempt == retries:
+                    raise
+
+    def reset_xml_parser_choices(self, provider=None, bibstem=None):
+        """
+        Forgets the learned XML parsers, all of them or only the ones of a
+        provider and/or journal
+
+        :return: number of choices removed
+        """
+        with self.session_scope() as session:
+            query = session.query(XMLParserChoice)
+            if provider:
+                query = query.filter_by(provider=provider)
+            if bibstem:
+                query = query.filter_by(bibstem=bibstem)
+            return query.delete()
+
+    def get_extraction_states(self, bibcodes):
+        """
+        :param bibcodes: list of bibcodes
+        :return: dictionary bibcode -> state of the last extraction, for the
+        bibcodes in the extraction index
+        """
+        states = {}
+        with self.session_scope() as session:
+            for i in range(0, len(bibcodes), 500):
+                for state in session.query(ExtractionState).filter(ExtractionState.bibcode.in_(bibcodes[i:i+500])):
+                    states[state.bibcode] = state.toJSON()
+        return states
+
+    def save_extraction_states(self, states):
+        """
+        :param states: list of dictionaries with the state of the last
+        extraction of each bibcode (see checker.extraction_state)
+        :return: no return
+        """
+        with self.session_scope() as session:
+            for state in states:
+                session.merge(ExtractionState(**state))
+
+    def reset_extraction_states(self):
+        """
+        Empties the extraction index
+
+        :return: number of states removed
+        """
+        with self.session_scope() as session:
+            return session.query(ExtractionState).delete()
@@ -20,14 +20,17 @@ __license__ = 'GPLv3'
 import sys
 import os
 from . import utils
+from . import compression
 import json
 import ptree
 import traceback
+import hashlib
+import time
 
-from stat import ST_MTIME
+from stat import ST_MTIME, S_ISREG
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from dateutil.parser import parse
-from adsft.utils import get_filenames
+from adsft.utils import get_filenames, format_index_date, parse_index_date
 
 # ============================= INITIALIZATION ==================================== #
 # - Use app logger:
@@ -42,17 +45,150 @@ logger = setup_logging(__name__, proj_home=proj_home,
                         attach_stdout=config.get('LOG_STDOUT', False))
 
 
+# ================================ CLASSES ======================================== #
+
+class StatCache(object):
+    """
+    Results of os.stat for the paths needed by check_if_extract, so that each
+    path is stat'ed only once. The paths can be stat'ed beforehand on a pool of
+    threads, which hides the latency of network file systems.
+    """
+
+    def __init__(self):
+        self.stats = {}
+
+    def prefetch(self, paths, max_workers=1):
+        """
+        Stats concurrently the paths not stat'ed yet
+
+        :param paths: iterable of paths
+        :param max_workers: number of threads
+        :return: no return
+        """
+        paths = [path for path in set(paths) if path not in self.stats]
+        if max_workers > 1 and len(paths) > 1:
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(paths))) as executor:
+                self.stats.update(zip(paths, executor.map(self._stat, paths)))
+        else:
+            self.stats.update((path, self._stat(path)) for path in paths)
+
+    @staticmethod
+    def _stat(path):
+        try:
+            return os.stat(path)
+        except (OSError, ValueError):
+            return None
+
+    def stat(self, path):
+        """
+        :param path: path to file
+        :return: stat result, None if the path does not exist
+        """
+        try:
+            return self.stats[path]
+        except KeyError:
+            result = self.stats[path] = self._stat(path)
+            return result
+
+    def exists(self, path):
+        return self.stat(path) is not None
+
+    def isfile(self, path):
+        result = self.stat(path)
+        return result is not None and S_ISREG(result.st_mode)
+
+
+class SourceFingerprinter(object):
+    """
+    Fingerprints the content of the source files, so that a source file that
+    was touched without being changed is not extracted again. It counts how
+    many source files were compared and how many were found unchanged.
+    """
+
+    def __init__(self):
+        self.statistics = {'compared': 0, 'unchanged': 0}
+
+    def fingerprint(self, ft_source):
+        """
+        :param ft_source: path to the source file, or several comma separated
+        :return: hash of the content of all the files, None if one cannot be read
+        """
+        try:
+            file_names = get_filenames(ft_source)
+        except ValueError:
+            file_names = [ft_source]
+        digest = hashlib.blake2b(digest_size=16)
+        try:
+            for file_name in file_names:
+                with open(file_name, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                        digest.update(chunk)
+                digest.update(b'\0')
+        except (IOError, OSError):
+            return None
+        return digest.hexdigest()
+
+    def unchanged(self, ft_source, previous):
+        """
+        :param ft_source: path to the source file, or several comma separated
+        :param previous: fingerprint saved at the last extraction
+        :return: True if the content of the source is the same
+        """
+        if not previous:
+            return False
+        self.statistics['compared'] += 1
+        if self.fingerprint(ft_source) != previous:
+            return False
+        self.statistics['unchanged'] += 1
+        return True
+
+    def get_statistics(self):
+        """
+        :return: number of source files compared and found unchanged (i.e.
+        extractions avoided)
+        """
+        return self.statistics
+
+SOURCE_FINGERPRINTER = SourceFingerprinter()
+
+
+def touch_extraction(meta_path):
+    """
+    Sets the last modified time of the meta.json and fulltext file to now,
+    so that the files written are considered newer than the source again
+
+    :param meta_path: path to the meta-data file
+    :return: no return
+    """
+    now = time.time()
+    fulltext_path = compression.find_text_file(os.path.dirname(meta_path), 'fulltext')
+    for path in (fulltext_path, meta_path):
+        if path is None:
+            continue
+        try:
+            os.utime(path, (now, now))
+        except OSError:
+            logger.warning('Could not touch %s', path)
+
+
 # =============================== FUNCTIONS ======================================= #
 
-def file_last_modified_time(file_input):
+def file_last_modified_time(file_input, stats=None):
     """
     Stats the given file to find the last modified time
 
     :param file_input: path to file
+    :param stats: StatCache to take the stat result from
     :return: date time object of the last modified time
     """
 
-    mtime = os.stat(file_input)[ST_MTIME]
+    if stats is not None:
+        result = stats.stat(file_input)
+        if result is None:
+            raise OSError('No such file: {}'.format(file_input))
+        mtime = result[ST_MTIME]
+    else:
+        mtime = os.stat(file_input)[ST_MTIME]
     return datetime.fromtimestamp(mtime)
 
 
@@ -73,17 +209,20 @@ def create_meta_path(dict_input, extract_path):
     return extract_path
 
 
-def meta_output_exists(file_input, extract_path):
+def meta_output_exists(file_input, extract_path, stats=None):
     """
     Checks if there is already a meta-data json file on disk.
 
     :param file_input: dictionary containing article meta-data
     :param extract_path: path to extract the full text content to
+    :param stats: StatCache to take the stat result from
     :return: boolean value; does the path exist or not
     """
 
     meta_full_path = create_meta_path(file_input, extract_path)
 
+    if stats is not None:
+        return stats.isfile(meta_full_path)
     if os.path.isfile(meta_full_path):
         return True
     else:
@@ -121,7 +260,7 @@ def load_meta_file(file_input, extract_path):
 
 
 def meta_needs_update(dict_input, meta_content,
-                      extract_path):
+                      extract_path, stats=None, fingerprint=False):
     """
     By examining the meta-data file and the relevant full text file, it checks
     if the full text should be extracted for the first time (or again). The
@@ -131,18 +270,26 @@ def meta_needs_update(dict_input, meta_content,
       3. STALE_CONTENT: the meta.json is older than the full text file
       4. STALE_META: the meta.json file does not all the required keys
 
-    The return value is empty if none of the above are true.
+    The return value is empty if none of the above are true. When fingerprint
+    is True and the full text file is newer but its content did not change,
+    the files written are touched and UNCHANGED_FT_SOURCE is returned.
 
     :param dict_input: dictionary containing article meta-data
     :param meta_content: the content in the old meta-data file
     :param extract_key: the content of the meta-data file
+    :param stats: StatCache to take the stat results from
+    :param fingerprint: compare the content of the full text file when it is
+    newer than the last extraction
     :return: the keyword that describes why it should be extracted
     """
 
+    if stats is None:
+        stats = StatCache()
+
     # Obtain the indexed date within the meta file
     try:
         time_stamp = meta_content['index_date']
-        meta_date = parse(time_stamp)
+        meta_date = parse_index_date(time_stamp)
         bibcode = meta_content['bibcode']
     except KeyError:
         logger.warning("Malformed meta-file: %s", traceback.format_exc())
@@ -163,36 +310,168 @@ def meta_needs_update(dict_input, meta_content,
             dict_input['ft_source']:
         return 'DIFFERING_FULL_TEXT'
 
-    if not os.path.exists(meta_content['ft_source']):
+    if not stats.exists(meta_content['ft_source']):
         return 'IGNORE_NON_EXISTENT_FT_SOURCE'
 
     # Content is considered 'stale'
     delta_comp_time = datetime.utcnow() - datetime.now()
 
     ft_source_last_modified = \
-        file_last_modified_time(meta_content['ft_source'])
+        file_last_modified_time(meta_content['ft_source'], stats)
     ft_source_last_modified += delta_comp_time
 
     meta_path = create_meta_path(dict_input, extract_path)
 
-    meta_json_last_modified = file_last_modified_time(meta_path)
+    meta_json_last_modified = file_last_modified_time(meta_path, stats)
 
     # If the source content is newer than the last time it was extracted
     logger.debug('FILE_SOUCE last modified: %s', ft_source_last_modified)
     logger.debug('META_PATH last modified: %s', meta_json_last_modified)
+    touched = False
     if ft_source_last_modified > meta_json_last_modified:
-        return 'STALE_CONTENT'
+        if not (fingerprint and SOURCE_FINGERPRINTER.unchanged(meta_content['ft_source'],
+                                                               meta_content.get('ft_source_hash'))):
+            return 'STALE_CONTENT'
+        touched = True
 
     # If the fulltext is older than the meta file
-    fulltext_path = meta_path.replace('meta.json', 'fulltext.txt.gz')
-    fulltext_last_modified = file_last_modified_time(fulltext_path)
+    fulltext_path = compression.find_text_file(os.path.dirname(meta_path), 'fulltext', exists=stats.exists) or \
+        compression.text_file_path(os.path.dirname(meta_path), 'fulltext')
+    fulltext_last_modified = file_last_modified_time(fulltext_path, stats)
 
     logger.debug('FULLTEXT_PATH last modified: %s', fulltext_last_modified)
     if meta_json_last_modified > fulltext_last_modified:
         return 'STALE_CONTENT'
 
+    if touched:
+        touch_extraction(meta_path)
+        return 'UNCHANGED_FT_SOURCE'
+
+
+def extraction_state(meta_content, meta_path, stats=None):
+    """
+    Builds the entry of the extraction index of an article from the content
+    of its meta.json
+
+    :param meta_content: the content of the meta-data file
+    :param meta_path: path to the meta-data file
+    :param stats: StatCache to take the stat results from
+    :return: dictionary with the state of the last extraction
+    """
+
+    if stats is None:
+        stats = StatCache()
+    ft_source = meta_content.get('ft_source')
+    source_stat = stats.stat(ft_source) if ft_source else None
+    meta_stat = stats.stat(meta_path)
+    fulltext_path = compression.find_text_file(os.path.dirname(meta_path), 'fulltext', exists=stats.exists)
+    fulltext_stat = stats.stat(fulltext_path) if fulltext_path else None
+    return {'bibcode': meta_content['bibcode'],
+            'ft_source': ft_source,
+            'source_mtime': source_stat.st_mtime if source_stat else None,
+            'source_size': source_stat.st_size if source_stat else None,
+            'meta_mtime': meta_stat.st_mtime if meta_stat else None,
+            'fulltext_mtime': fulltext_stat.st_mtime if fulltext_stat else None,
+            'index_date': meta_content.get('index_date'),
+            'file_format': meta_content.get('file_format'),
+            'cleaner_version': meta_content.get('cleaner_version'),
+            'ft_source_hash': meta_content.get('ft_source_hash')}
+
+
+def walk_extraction_states(extract_path):
+    """
+    Generator that reads all the meta.json files of the pair tree to rebuild
+    the extraction index
+
+    :param extract_path: path to extract the full text content to
+    :return: generator of dictionaries with the state of the last extraction
+    """
+
+    for root, dirs, files in os.walk(extract_path):
+        if 'meta.json' not in files:
+            continue
+        meta_path = os.path.join(root, 'meta.json')
+        try:
+            with open(meta_path, 'r') as f:
+                meta_content = json.loads(f.read())
+            yield extraction_state(meta_content, meta_path)
+        except Exception:
+            logger.warning('Could not index meta file %s: %s', meta_path, sys.exc_info())
+
+
+def state_matches_files(state, meta_path, stats=None):
+    """
+    Checks that the files written by the last extraction are still the ones
+    described by the entry of the extraction index, i.e. that the meta.json
+    and fulltext file were not deleted or written again since it was saved
+
+    :param state: entry of the extraction index (see extraction_state)
+    :param meta_path: path to the meta-data file
+    :param stats: StatCache to take the stat results from
+    :return: True if the entry can be used instead of the meta.json
+    """
+
+    if stats is None:
+        stats = StatCache()
+    meta_stat = stats.stat(meta_path)
+    fulltext_path = compression.find_text_file(os.path.dirname(meta_path), 'fulltext', exists=stats.exists)
+    fulltext_stat = stats.stat(fulltext_path) if fulltext_path else None
+    return meta_stat is not None and fulltext_stat is not None and \
+        state['meta_mtime'] == meta_stat.st_mtime and state['fulltext_mtime'] == fulltext_stat.st_mtime
+
+
+def state_needs_update(dict_input, state, stats=None, meta_path=None, fingerprint=False):
+    """
+    Same as meta_needs_update but using the entry of the extraction index
+    instead of reading the meta.json, it must only be used when the entry
+    matches the files written (see state_matches_files)
+
+    :param dict_input: dictionary containing article meta-data
+    :param state: entry of the extraction index (see extraction_state)
+    :param stats: StatCache to take the stat results from
+    :param meta_path: path to the meta-data file (to touch the files written)
+    :param fingerprint: compare the content of the full text file when it is
+    newer than the last extraction
+    :return: the keyword that describes why it should be extracted
+    """
+
+    if stats is None:
+        stats = StatCache()
+
+    if not state['index_date']:
+        return 'STALE_META'
+
+    if not state['ft_source']:
+        return 'MISSING_FULL_TEXT'
+
+    if state['ft_source'] != dict_input['ft_source']:
+        return 'DIFFERING_FULL_TEXT'
+
+    source_stat = stats.stat(state['ft_source'])
+    if source_stat is None:
+        return 'IGNORE_NON_EXISTENT_FT_SOURCE'
+
+    # Same comparisons as meta_needs_update
+    delta_comp_time = datetime.utcnow() - datetime.now()
+    ft_source_last_modified = datetime.fromtimestamp(source_stat[ST_MTIME]) + delta_comp_time
+    meta_json_last_modified = datetime.fromtimestamp(int(state['meta_mtime']))
+    touched = False
+    if ft_source_last_modified > meta_json_last_modified:
+        if not (fingerprint and meta_path and
+                SOURCE_FINGERPRINTER.unchanged(state['ft_source'], state.get('ft_source_hash'))):
+            return 'STALE_CONTENT'
+        touched = True
+
+    if meta_json_last_modified > datetime.fromtimestamp(int(state['fulltext_mtime'])):
+        return 'STALE_CONTENT'
+
+    if touched:
+        touch_extraction(meta_path)
+        return 'UNCHANGED_FT_SOURCE'
+
 
-def check_if_extract(message_list, extract_path):
+def check_if_extract(message_list, extract_path, max_workers=None, index=None,
+                     fingerprint=None, refreshed=None):
     """
     For each bibcode in the list, it is checked if it should be extracted by
     examining the meta-data supplied, the meta-data that exists in the current
@@ -207,9 +486,21 @@ def check_if_extract(message_list, extract_path):
 
     :param message_list: list of dictionaries the aricles meta-data
     :param extract_key: the content of the meta-data file
+    :param max_workers: number of threads used to stat the files of all the
+    messages beforehand (CHECK_IF_EXTRACT_STAT_WORKERS by default)
+    :param index: dictionary bibcode -> entry of the extraction index, the
+    meta.json is only read for the bibcodes that are not in it or whose
+    files written do not match it
+    :param fingerprint: when the full text file is newer than the last
+    extraction, compare its content with the fingerprint saved in the
+    meta.json and do not extract it again if it did not change
+    (FT_SOURCE_FINGERPRINT by default)
+    :param refreshed: list to which the new entries of the extraction index
+    are appended for the extractions found unchanged
     :return: dictionary containing two lists. One for PDF files and the other
     for normal files. It adds the extra keyword UPDATE which explains why the
-    extraction of the full text is required.
+    extraction of the full text is required. The messages that cannot be
+    checked (e.g., a file is missing) are logged and left out.
     """
 
     NEEDS_UPDATE = ["MISSING_FULL_TEXT", "DIFFERING_FULL_TEXT", "STALE_CONTENT",
@@ -219,27 +510,72 @@ def check_if_extract(message_list, extract_path):
     publish_list_of_standard_dictionaries = []
     publish_list_of_pdf_dictionaries = []
 
+    if max_workers is None:
+        max_workers = config.get('CHECK_IF_EXTRACT_STAT_WORKERS', 1)
+    if fingerprint is None:
+        fingerprint = config.get('FT_SOURCE_FINGERPRINT', False)
+
+    # Stat at once the paths needed by all the messages: first the source
+    # files and meta.json, then the fulltext file next to the meta.json
+    # files that exist (also for the articles in the index, to check that
+    # the files written still match it)
+    if index is None:
+        index = {}
+    stats = StatCache()
+    paths = []
+    meta_paths = []
     for message in message_list:
+        try:
+            paths.append(get_filenames(message['ft_source'])[0])
+        except ValueError:
+            pass
+        if message.get('UPDATE') not in ('FORCE_TO_EXTRACT', 'FORCE_TO_SEND'):
+            meta_paths.append(create_meta_path(message, extract_path))
+            paths.append(message['ft_source'])
+    stats.prefetch(paths + meta_paths, max_workers=max_workers)
+    stats.prefetch([compression.text_file_path(os.path.dirname(meta_path), 'fulltext')
+                    for meta_path in meta_paths if stats.isfile(meta_path)],
+                   max_workers=max_workers)
 
-        # message should be a dictionary
-        if 'UPDATE' in message \
-                and message['UPDATE'] == 'FORCE_TO_EXTRACT':
-            update = 'FORCE_TO_EXTRACT'
-        elif 'UPDATE' in message \
-                and message['UPDATE'] == 'FORCE_TO_SEND':
-            update = 'FORCE_TO_SEND'
-        elif meta_output_exists(message, extract_path):
-            meta_content = load_meta_file(message, extract_path)
-            update = meta_needs_update(message, meta_content,
-                                       extract_path)
-        else:
-            logger.debug('No existing meta file')
-            update = 'NOT_EXTRACTED_BEFORE'
+    for message in message_list:
+
+        # a record that cannot be checked is skipped, not the whole list
+        try:
+            # message should be a dictionary
+            if 'UPDATE' in message \
+                    and message['UPDATE'] == 'FORCE_TO_EXTRACT':
+                update = 'FORCE_TO_EXTRACT'
+            elif 'UPDATE' in message \
+                    and message['UPDATE'] == 'FORCE_TO_SEND':
+                update = 'FORCE_TO_SEND'
+            elif message['bibcode'] in index and \
+                    state_matches_files(index[message['bibcode']], create_meta_path(message, extract_path), stats):
+                meta_content = index[message['bibcode']]
+                update = state_needs_update(message, meta_content, stats,
+                                            create_meta_path(message, extract_path), fingerprint)
+            elif meta_output_exists(message, extract_path, stats):
+                meta_content = load_meta_file(message, extract_path)
+                update = meta_needs_update(message, meta_content,
+                                           extract_path, stats, fingerprint)
+            else:
+                logger.debug('No existing meta file')
+                update = 'NOT_EXTRACTED_BEFORE'
+        except OSError as err:
+            logger.error("Bibcode '%s' skipped because of a missing file: %s", message['bibcode'], err)
+            continue
+        except Exception:
+            logger.exception("Bibcode '%s' skipped, it could not be checked", message['bibcode'])
+            continue
+
+        if update == 'UNCHANGED_FT_SOURCE':
+            logger.info("Bibcode '%s' is linked to a file that was modified but has the same content, not extracting it again", message['bibcode'])
+            if refreshed is not None:
+                refreshed.append(extraction_state(meta_content, create_meta_path(message, extract_path)))
 
         # only check the first filename
         ft = get_filenames(message['ft_source'])[0]
-        if os.path.exists(ft):
-            ft_source_size = os.stat(ft).st_size # bytes
+        if stats.exists(ft):
+            ft_source_size = stats.stat(ft).st_size # bytes
             if ft_source_size == 0:
                 update = 'IGNORE_ZERO_BYTE_FT_SOURCE'
                 logger.error("Bibcode '%s' is linked to a zero byte size file '%s'", message['bibcode'], message['ft_source'])
@@ -254,7 +590,7 @@ def check_if_extract(message_list, extract_path):
             logger.debug('Creating meta path: %s', message['meta_path'])
 
             # Wite a time stamp of this process
-            message['index_date'] = datetime.utcnow().isoformat() + 'Z'
+            message['index_date'] = format_index_date()
             logger.debug('Adding timestamp: %s', message['index_date'])
 
             format_ = os.path.splitext(ft)[-1].replace('.', '').lower()
@@ -0,0 +1,173 @@
+"""
+Compression codecs of the text files written to the pair tree (fulltext,
+acknowledgements, ...). The codec used to write is set by FULLTEXT_CODEC, the
+files are read with the codec given by their magic bytes (or suffix), so that
+trees with files written with different codecs can be read.
+"""
+
+import os
+import gzip
+
+# ============================= INITIALIZATION ==================================== #
+
+from adsputils import setup_logging, load_config
+proj_home = os.path.realpath(os.path.join(os.path.dirname(__file__), '../'))
+config = load_config(proj_home=proj_home)
+logger = setup_logging(__name__, proj_home=proj_home,
+                        level=config.get('LOGGING_LEVEL', 'INFO'),
+                        attach_stdout=config.get('LOG_STDOUT', False))
+
+
+# ================================ CLASSES ======================================== #
+
+class GzipCodec(object):
+    """gzip, the format of the files written by the previous versions"""
+    name = 'gzip'
+    suffix = '.gz'
+    magic = b'\x1f\x8b'
+
+    def write(self, file_out, payload, level=None):
+        """
+        :param file_out: binary file object
+        :param payload: bytes to compress
+        :param level: compression level (codec default if None)
+        :return: no return
+        """
+        with gzip.GzipFile(filename='', mode='wb', fileobj=file_out,
+                           compresslevel=6 if level is None else level) as gzip_out:
+            gzip_out.write(payload)
+
+    def decompress(self, content):
+        return gzip.decompress(content)
+
+
+class ZstdCodec(object):
+    """zstd (needs the zstandard package), optionally with a trained dictionary"""
+    name = 'zstd'
+    suffix = '.zst'
+    magic = b'\x28\xb5\x2f\xfd'
+
+    def __init__(self, dictionary=None):
+        """
+        :param dictionary: path to a dictionary trained with `zstd --train`
+        (the same dictionary is needed to read the files)
+        """
+        import zstandard
+        self.zstandard = zstandard
+        self.dictionary = None
+        if dictionary:
+            with open(dictionary, 'rb') as f:
+                self.dictionary = zstandard.ZstdCompressionDict(f.read())
+        self.compressors = {}
+        self.decompressor = zstandard.ZstdDecompressor(dict_data=self.dictionary)
+
+    def write(self, file_out, payload, level=None):
+        level = 3 if level is None else level
+        if level not in self.compressors:
+            self.compressors[level] = self.zstandard.ZstdCompressor(level=level, dict_data=self.dictionary)
+        file_out.write(self.compressors[level].compress(payload))
+
+    def decompress(self, content):
+        return self.decompressor.decompress(content)
+
+
+class PlainCodec(object):
+    """No compression"""
+    name = 'none'
+    suffix = ''
+    magic = None
+
+    def write(self, file_out, payload, level=None):
+        file_out.write(payload)
+
+    def decompress(self, content):
+        return content
+
+
+CODEC_CLASSES = (GzipCodec, ZstdCodec, PlainCodec)
+_codecs = {}
+
+
+# =============================== FUNCTIONS ======================================= #
+
+def get_codec(name=None):
+    """
+    :param name: 'gzip', 'zstd' or 'none' (FULLTEXT_CODEC by default)
+    :return: the codec
+    """
+    if name is None:
+        name = config.get('FULLTEXT_CODEC', 'gzip')
+    if name not in _codecs:
+        for codec_class in CODEC_CLASSES:
+            if codec_class.name == name:
+                if codec_class is ZstdCodec:
+                    _codecs[name] = ZstdCodec(dictionary=config.get('FULLTEXT_ZSTD_DICTIONARY'))
+                else:
+                    _codecs[name] = codec_class()
+                break
+        else:
+            raise ValueError('Unknown codec: {}'.format(name))
+    return _codecs[name]
+
+
+def text_file_path(directory, name, codec=None):
+    """
+    :param directory: pair tree directory of the article
+    :param name: name of the content, e.g. fulltext or acknowledgements
+    :param codec: codec (the one to write with by default)
+    :return: path of the file of the content written with the codec
+    """
+    if codec is None:
+        codec = get_codec()
+    return os.path.join(directory, name) + '.txt' + codec.suffix
+
+
+def text_file_paths(directory, name):
+    """
+    :param directory: pair tree directory of the article
+    :param name: name of the content, e.g. fulltext or acknowledgements
+    :return: the paths the content may be written to, the one of the codec
+    to write with first
+    """
+    default = get_codec()
+    return [text_file_path(directory, name, default)] + \
+           [text_file_path(directory, name, codec_class) for codec_class in CODEC_CLASSES
+            if codec_class.name != default.name]
+
+
+def find_text_file(directory, name, exists=os.path.exists):
+    """
+    :param directory: pair tree directory of the article
+    :param name: name of the content, e.g. fulltext or acknowledgements
+    :param exists: function used to check if a path exists
+    :return: path of the file of the content, None if there is none
+    """
+    for path in text_file_paths(directory, name):
+        if exists(path):
+            return path
+    return None
+
+
+def detect_codec(content, file_name=''):
+    """
+    :param content: bytes read from the file
+    :param file_name: name of the file, used when the magic bytes are unknown
+    :return: the codec the content was written with
+    """
+    for codec_class in CODEC_CLASSES:
+        if codec_class.magic and content.startswith(codec_class.magic):
+            return get_codec(codec_class.name)
+    for codec_class in CODEC_CLASSES:
+        if codec_class.suffix and file_name.endswith(codec_class.suffix):
+            return get_codec(codec_class.name)
+    return get_codec('none')
+
+
+def read_text_file(file_name):
+    """
+    :param file_name: path to the file
+    :return: the text of the file, decompressed with the codec it was written with
+    """
+    with open(file_name, 'rb') as f:
+        content = f.read()
+    return detect_codec(content, file_name).decompress(content).decode('utf-8')
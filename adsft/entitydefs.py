@@ -14,6 +14,7 @@ __credit__ = ['V. Sudilovsky', 'A. Accomazzi', 'J. Luker']
 __license__ = 'GPLv3'
 
 import re
+from itertools import repeat
 
 entitydefs = {
     'nsqsupe': u'\u22e3',
@@ -1914,15 +1915,29 @@ def entitymap(match):
         return entitydefs[x]
 
 
+# Named and numeric entities, only the ones in entitydefs are kept and the
+# rest are removed
+ENTITY_PATTERN = re.compile(r'&(#\d+|#x[0-9a-fA-F]+|\w+);')
+
+
 def convertentities(input_string):
     """
     Replaces any of the HTML/LaTeX types listed in entitydefs that are matched
     by regular expression.
 
+    The string is split around the entities, which are then looked up all at
+    once, instead of calling entitymap for every match. Documents without any
+    '&' are returned as they are.
+
     :param input_string: string that needs to be parsed
     :return: string with the relevant characters removed
     """
 
-    if input_string is None:
+    if input_string is None or '&' not in input_string:
+        return input_string
+    # Odd positions contain the entity names (group of the pattern)
+    parts = ENTITY_PATTERN.split(input_string)
+    if len(parts) == 1:
         return input_string
-    return re.sub('&(#\d+|#x[0-9a-fA-F]+|\w+);', entitymap, input_string)
+    parts[1::2] = map(entitydefs.get, parts[1::2], repeat(u'', len(parts) // 2))
+    return u''.join(parts)
@@ -25,11 +25,16 @@ __status__ = 'Production'
 __credit__ = ['V. Sudilovsky', 'A. Accomazzi', 'J. Luker']
 __license__ = 'GPLv3'
 
+import codecs
 import os
 import random
+import shutil
 import string
+import tempfile
+import time
 
 from bs4 import UnicodeDammit
+from bs4.dammit import EncodingDetector
 import lxml
 import lxml.html
 import lxml.etree
@@ -44,9 +49,10 @@ import re
 import traceback
 import unicodedata
 from adsft import entitydefs as edef
-from adsft.rules import META_CONTENT
+from adsft.rules import META_CONTENT, COMPILED_META_CONTENT, PRUNE, ACKNOWLEDGEMENTS
+from adsft.rules import STREAMING_META_CONTENT, STREAMING_ACKNOWLEDGEMENTS, PRUNE_TAGS
 from requests.exceptions import HTTPError
-from subprocess import Popen, PIPE, STDOUT
+from subprocess import Popen, PIPE, STDOUT, TimeoutExpired
 
 # ============================= INITIALIZATION ==================================== #
 # - Use app logger:
@@ -63,6 +69,71 @@ logger = setup_logging(__name__, proj_home=proj_home,
 
 # ================================ CLASSES ======================================== #
 
+class ContentDecoder(object):
+    """
+    Decodes the raw content of XML and HTML files. The cheap checks are tried
+    first: byte order mark, encoding declared in the XML declaration and
+    strict UTF-8. Only when they fail, the
+    encoding is detected by UnicodeDammit, whose decoded content is reused.
+    It counts how many files took each route.
+    """
+
+    def __init__(self):
+        """
+        Initialisation method (constructor) of the class
+
+        :return: no return
+        """
+        self.statistics = {}
+
+    def _strict_decode(self, raw_content, encoding, partial):
+        try:
+            if partial:
+                # the content may end in the middle of a character
+                return codecs.getincrementaldecoder(encoding)().decode(raw_content, final=False)
+            return raw_content.decode(encoding)
+        except (UnicodeDecodeError, LookupError):
+            return None
+
+    def decode(self, raw_content, partial=False):
+        """
+        :param raw_content: bytes read from the file
+        :param partial: boolean, is the content only the beginning of the file
+        :return: tuple of decoded content, encoding and route taken ('bom',
+        'declared', 'utf-8' or 'detector')
+        """
+        content = None
+        encoding = EncodingDetector.strip_byte_order_mark(raw_content)[1]
+        route = 'bom'
+        if encoding is None:
+            encoding = EncodingDetector.find_declared_encoding(raw_content)
+            route = 'declared'
+        if encoding is not None:
+            content = self._strict_decode(raw_content, encoding, partial)
+        if content is None:
+            encoding = 'utf-8'
+            route = 'utf-8'
+            content = self._strict_decode(raw_content, encoding, partial)
+        if content is None:
+            route = 'detector'
+            dammit = UnicodeDammit(raw_content)
+            encoding = dammit.original_encoding
+            content = dammit.unicode_markup
+            if dammit.contains_replacement_characters:
+                # characters that could not be decoded are ignored
+                content = raw_content.decode(encoding, "ignore")
+        self.statistics[route] = self.statistics.get(route, 0) + 1
+        return content, encoding, route
+
+    def get_statistics(self):
+        """
+        :return: number of files decoded by each route
+        """
+        return self.statistics
+
+CONTENT_DECODER = ContentDecoder()
+
+
 class StandardExtractorBasicText(object):
     """
     Class for extracting text from a text file. Essentialy used to clean the
@@ -173,11 +244,9 @@ class StandardExtractorHTML(object):
         with open(html_file, 'rb') as fp:
             raw_html = fp.read()
 
-        # detect the encoding of the html file
-        encoding = UnicodeDammit(raw_html).original_encoding
-
-        # encoding is then used to decode bytecode into unicode
-        raw_html = raw_html.decode(encoding, "ignore")
+        # detect the encoding of the html file and decode bytecode into unicode
+        raw_html, encoding, route = CONTENT_DECODER.decode(raw_html)
+        logger.debug('Decoded %s as %s (%s)', html_file, encoding, route)
 
         raw_html = edef.convertentities(raw_html)
 
@@ -256,7 +325,7 @@ class StandardExtractorHTML(object):
         # Remove anything before introduction
         for xpath in META_CONTENT[self.meta_name]['introduction']:
             try:
-                tmp = self.parsed_html.xpath(xpath)
+                tmp = COMPILED_META_CONTENT[self.meta_name][xpath](self.parsed_html)
                 if tmp and len(tmp) > 0:
                     removed_content = tmp[0] # TODO(rca): only first elem?
                     break
@@ -279,7 +348,7 @@ class StandardExtractorHTML(object):
         for xpath in META_CONTENT[self.meta_name]['references']:
             removed_content = None
             try:
-                removed_content = self.parsed_html.xpath(xpath)[0]
+                removed_content = COMPILED_META_CONTENT[self.meta_name][xpath](self.parsed_html)[0]
                 html_ul_element = removed_content.getnext()
                 html_ul_element.getparent().remove(html_ul_element)
                 removed_content.getparent().remove(removed_content)
@@ -300,7 +369,7 @@ class StandardExtractorHTML(object):
 
                 try:
                     table_node_to_insert = \
-                        table_root_node.xpath(xpath)[0].getparent()
+                        COMPILED_META_CONTENT[self.meta_name][xpath](table_root_node)[0].getparent()
                     break
 
                 except AttributeError:
@@ -378,6 +447,149 @@ class StandardExtractorHTML(object):
         return meta_out
 
 
+class XMLParserSelector(object):
+    """
+    Decides in which order the XML parsers are tried for a document. The
+    parser that succeeded last for the same provider and journal (bibstem) is
+    tried first, if there is none, the one that succeeded for documents of the
+    provider with the same cheap signals read from the raw content (XML
+    declaration and namespace declarations). The configured order is kept for
+    the rest. It also counts per provider how many parser attempts failed
+    before one succeeded (fallbacks).
+
+    The choices per provider and journal can be shared between processes (see
+    load_journal_choices and pop_changed_journal_choices).
+    """
+
+    def __init__(self):
+        """
+        Initialisation method (constructor) of the class
+
+        :return: no return
+        """
+        self.best_parser_names = {}
+        self.statistics = {}
+        self.changed_journal_choices = {}
+        self.loaded_at = None
+
+    @staticmethod
+    def bibstem(bibcode):
+        """
+        :param bibcode: bibcode of the article (e.g., 2015MNRAS.446.4239E)
+        :return: journal abbreviation (e.g., MNRAS) or None
+        """
+        if not bibcode or len(bibcode) != 19:
+            return None
+        return bibcode[4:9].rstrip('.') or None
+
+    def keys(self, provider, bibcode, raw_xml):
+        """
+        Groups the document by provider and journal, and by provider and what
+        its first bytes look like
+
+        :param provider: provider/publisher of the article
+        :param bibcode: bibcode of the article
+        :param raw_xml: decoded content of the XML file
+        :return: list of hashable keys, from the most specific group
+        """
+        head = raw_xml[:4096]
+        has_declaration = head.lstrip().startswith('<?xml')
+        has_namespaces = 'xmlns:' in head
+        keys = [('signals', provider, has_declaration, has_namespaces)]
+        bibstem = self.bibstem(bibcode)
+        if bibstem:
+            keys.insert(0, ('journal', provider, bibstem))
+        return keys
+
+    def order(self, keys, parser_names):
+        """
+        :param keys: groups of the document (see keys)
+        :param parser_names: parsers in the configured order of preference
+        :return: parsers in the order they should be tried
+        """
+        parser_names = list(parser_names)
+        for key in keys:
+            best_parser_name = self.best_parser_names.get(key)
+            if best_parser_name in parser_names:
+                parser_names.remove(best_parser_name)
+                parser_names.insert(0, best_parser_name)
+                break
+        return parser_names
+
+    def record(self, keys, parser_name, attempts):
+        """
+        Keeps the parser that succeeded for the groups of the document and
+        updates the statistics of its provider
+
+        :param keys: groups of the document (see keys)
+        :param parser_name: parser that succeeded or None if all failed
+        :param attempts: number of parsers that were tried
+        :return: no return
+        """
+        provider = keys[0][1]
+        stats = self.statistics.setdefault(provider, {'documents': 0, 'fallbacks': 0, 'failures': 0, 'parsers': {}})
+        stats['documents'] += 1
+        stats['fallbacks'] += attempts - 1
+        if parser_name is None:
+            stats['failures'] += 1
+            return
+        stats['parsers'][parser_name] = stats['parsers'].get(parser_name, 0) + 1
+        if attempts > 1:
+            logger.info("XML parser '%s' succeeded for provider '%s' after %d fallbacks", parser_name, provider, attempts - 1)
+        for key in keys:
+            self.best_parser_names[key] = parser_name
+            if key[0] == 'journal':
+                documents = self.changed_journal_choices.get(key, (None, 0))[1]
+                self.changed_journal_choices[key] = (parser_name, documents + 1)
+
+    def get_statistics(self):
+        """
+        :return: per provider number of documents parsed, fallbacks, documents
+        no parser could handle, and successes of each parser
+        """
+        return self.statistics
+
+    def pop_changed_journal_choices(self):
+        """
+        :return: list of (provider, bibstem, parser_name, documents) learned
+        since the last call, documents being the number of documents parsed
+        """
+        changed = [(key[1], key[2], parser_name, documents)
+                   for key, (parser_name, documents) in self.changed_journal_choices.items()]
+        self.changed_journal_choices = {}
+        return changed
+
+    def restore_changed_journal_choices(self, choices):
+        """
+        Puts back the choices popped that could not be saved, they are merged
+        with the ones learned since then
+
+        :param choices: list of (provider, bibstem, parser_name, documents)
+        :return: no return
+        """
+        for provider, bibstem, parser_name, documents in choices:
+            key = ('journal', provider, bibstem)
+            # the parser learned since then is the most recent choice
+            parser_name, more_documents = self.changed_journal_choices.get(key, (parser_name, 0))
+            self.changed_journal_choices[key] = (parser_name, documents + more_documents)
+
+    def load_journal_choices(self, choices):
+        """
+        Replaces the choices per provider and journal by the given ones (e.g.,
+        learned by other processes), so that a reset of the choices is honoured
+
+        :param choices: list of (provider, bibstem, parser_name)
+        :return: no return
+        """
+        for key in [key for key in self.best_parser_names if key[0] == 'journal']:
+            del self.best_parser_names[key]
+        for provider, bibstem, parser_name in choices:
+            self.best_parser_names[('journal', provider, bibstem)] = parser_name
+        self.loaded_at = time.time()
+
+XML_PARSER_SELECTOR = XMLParserSelector()
+
+
 class StandardExtractorXML(object):
     """
     Class for extracting text from an XML file.
@@ -401,10 +613,17 @@ class StandardExtractorXML(object):
             'list': self.extract_list,
         }
         self.preferred_parser_names = load_config().get('PREFERRED_XML_PARSER_NAMES')
+        self._preprocessed_source = None
+        self._preprocessed = {}
+        self._xpath_results_tree = None
+        self._xpath_results = {}
+        # files larger than this (in bytes) are extracted while being parsed
+        # instead of building the whole tree (0 to disable)
+        self.streaming_threshold = config.get('XML_STREAMING_THRESHOLD', 0)
 
     def open_xml(self):
         """
-        Opens the XML file and reads raw string, uses UnicodeDammit to encode.
+        Opens the XML file and reads raw string, decodes it (see ContentDecoder).
 
         Removes some text that has no relevance for XML files, such as HTML tags, LaTeX entities
 
@@ -419,10 +638,9 @@ class StandardExtractorXML(object):
                 raw_xml = fp.read()
 
             # detect the encoding of the xml file (Latin-1, UTF-8, etc.)
-            encoding = UnicodeDammit(raw_xml).original_encoding
-
-            # this encoding is then used to decode bytecode into unicode
-            raw_xml = raw_xml.decode(encoding, "ignore")
+            # and decode bytecode into unicode
+            raw_xml, encoding, route = CONTENT_DECODER.decode(raw_xml)
+            logger.debug('Decoded %s as %s (%s)', self.file_input, encoding, route)
 
             # converting the html entities needs be given a string in unicode,
             # otherwise you'll be mixing bytecode with unicode
@@ -479,37 +697,55 @@ class StandardExtractorXML(object):
             parent.remove(node)
             parent.addnext(node)
 
-    def _remove_special_elements(self, raw_xml, parser_name):
+    def _preprocessing_steps(self, parser_name):
         """
-        Remove character data (CDATA), comments and processing instructions
-        using regex as needed for the target parser
+        Regex passes needed by the target parser, in the order they have to
+        be applied. Parsers share the first steps, which allows to compute
+        them only once per document (see _preprocess)
         """
+        steps = []
+        if parser_name in ("html5lib", "html.parser", "lxml-html", "direct-lxml-html", "lxml-xml", "direct-lxml-xml",):
+            steps.append('body_comment')
+        if parser_name in ("lxml-xml", "lxml-html", "html.parser", "html5lib"):
+            steps.append('comments')
+        steps.append('cdata')
+        if parser_name in ("html5lib", "html.parser", "lxml-html", "direct-lxml-html"):
+            steps.append('processing_instructions')
+        if parser_name in ("html5lib",):
+            steps.append('self_closing_tags')
         if parser_name in ("lxml-xml", ):
+            # Only touches the XML declaration, which is not affected by the
+            # previous steps, thus it can be the last one
+            steps.append('encoding')
+        return tuple(steps)
+
+    def _apply_preprocessing_step(self, raw_xml, step):
+        if step == 'encoding':
             # These parsers will use the encoding specified in the content, we need to
             # replace encoding by UTF-8 since we already decoded the original file content
             raw_xml = re.sub('(<\?[^>]+encoding=")(?:[^"]*)("\?>)', '\g<1>UTF-8\g<2>', raw_xml)
-
-        if parser_name in ("html5lib", "html.parser", "lxml-html", "direct-lxml-html", "lxml-xml", "direct-lxml-xml",):
+        elif step == 'body_comment':
             # replace <!-- body enbody --> with content inside
             # see issue https://github.com/adsabs/ADSfulltext/issues/104
             raw_xml = re.sub('<!--\s*body\s*([\s\S\n]*)\s*endbody\s*-->', r'\1', raw_xml)
-        if parser_name in ("lxml-xml", "lxml-html", "html.parser", "html5lib"):
+        elif step == 'comments':
             # - A comment is coded like this: <!--  My comment goes here. and it can span multiple lines -->
             #   RegEx Source: https://stackoverflow.com/a/4616640/6940788
             raw_xml = re.sub('<!--[\s\S\n]*?-->', '', raw_xml) # Comments
-        # - A CDATA is coded like this: <![CDATA[<b>Your Code Goes Here</b>]]>
-        #   RegEx Source: https://superuser.com/a/1153242
-        raw_xml = re.sub('<!\[CDATA\[[\s\S\n]*?\]\]>', '', raw_xml) # CDATA
-        # Notes:
-        #   - no parser provides a reliable way to find CDATA and remove their content
-        #     Source: https://stackoverflow.com/a/44561547
-        if parser_name in ("html5lib", "html.parser", "lxml-html", "direct-lxml-html"):
+        elif step == 'cdata':
+            # - A CDATA is coded like this: <![CDATA[<b>Your Code Goes Here</b>]]>
+            #   RegEx Source: https://superuser.com/a/1153242
+            raw_xml = re.sub('<!\[CDATA\[[\s\S\n]*?\]\]>', '', raw_xml) # CDATA
+            # Notes:
+            #   - no parser provides a reliable way to find CDATA and remove their content
+            #     Source: https://stackoverflow.com/a/44561547
+        elif step == 'processing_instructions':
             # - CDATA in Processing Instruction form, can include '>' symbol
             #   which will break Processing Instruction regex in the link below
             # - A processing instruction is coded like this: <?ignore .... what ever I want here, including <!-- comments --> ...  ?>
             #   RegEx Source: https://stackoverflow.com/a/29418829/6940788
             raw_xml = re.sub('<\?[\s\S\n]*?\?>', '', raw_xml) # Processing instructions
-        if parser_name in ("html5lib",):
+        elif step == 'self_closing_tags':
             # - Convert self closing xml tags to closing tags
             #   Source: https://stackoverflow.com/a/14028108
             # - html5lib will close them itself (unless it is a recognised html
@@ -518,7 +754,35 @@ class StandardExtractorXML(object):
             #   (i.e., graphics), we will wrongly remove the content that was
             #   wrapped
             raw_xml = re.sub('<\s*([^\s>]+)([^>]*)/\s*>', r'<\1\2></\1>', raw_xml) # Self closing tags (e.g., <graphics/>) to closing tabs (e.g., <graphics></graphics>)
+        return raw_xml
+
+    def _remove_special_elements(self, raw_xml, parser_name):
+        """
+        Remove character data (CDATA), comments and processing instructions
+        using regex as needed for the target parser
+        """
+        for step in self._preprocessing_steps(parser_name):
+            raw_xml = self._apply_preprocessing_step(raw_xml, step)
+        return raw_xml
 
+    def _preprocess(self, parser_name):
+        """
+        Same as _remove_special_elements for the opened document, but the
+        result of every sequence of steps is kept so that trying the next
+        parser only runs the steps it does not share with the previous ones
+        """
+        if self._preprocessed_source is not self.raw_xml:
+            self._preprocessed_source = self.raw_xml
+            self._preprocessed = {(): self.raw_xml}
+
+        steps = self._preprocessing_steps(parser_name)
+        done = len(steps)
+        while steps[:done] not in self._preprocessed:
+            done -= 1
+        raw_xml = self._preprocessed[steps[:done]]
+        for i in range(done, len(steps)):
+            raw_xml = self._apply_preprocessing_step(raw_xml, steps[i])
+            self._preprocessed[steps[:i+1]] = raw_xml
         return raw_xml
 
     def _save_body_tag(self, raw_xml):
@@ -624,10 +888,15 @@ class StandardExtractorXML(object):
         if preferred_parser_names is None or \
             (isinstance(preferred_parser_names, (list, tuple)) and not isinstance(preferred_parser_names, basestring) and \
              (len(preferred_parser_names) == 0 or all(item is None for item in preferred_parser_names))):
-            # If None or (None,), use the default from the config file
-            preferred_parser_names = self.preferred_parser_names
+            # If None or (None,), use the default from the config file and
+            # let the selector try first the parser that worked for similar documents
+            selection_keys = XML_PARSER_SELECTOR.keys(self.dict_item.get('provider'), self.dict_item.get('bibcode'), self.raw_xml)
+            preferred_parser_names = XML_PARSER_SELECTOR.order(selection_keys, self.preferred_parser_names)
+        else:
+            selection_keys = None
 
-        for parser_name in preferred_parser_names:
+        succeeded_parser_name = None
+        for attempt, parser_name in enumerate(preferred_parser_names, 1):
             parsed_xml = self._parse_xml(parser_name)
 
             logger.debug("Checking if the parser '%s' succeeded", parser_name)
@@ -635,7 +904,7 @@ class StandardExtractorXML(object):
             content_found = []
             for content_name in META_CONTENT[self.meta_name]:
                 for xpath in META_CONTENT[self.meta_name].get(content_name, {}).get('xpath', []):
-                    elements = parsed_xml.xpath(xpath)
+                    elements = self._xpath(parsed_xml, xpath)
                     if len(elements) > 0:
                         success = True
                         content_found.append(content_name)
@@ -644,10 +913,14 @@ class StandardExtractorXML(object):
                 logger.debug("The parser '%s' succeeded extracting the following fields '%s'", parser_name, ", ".join(content_found))
                 if 'fulltext' not in content_found:
                     logger.debug('Fulltext body not extracted for %s though overall extraction succeeded', self.dict_item['bibcode'])
+                succeeded_parser_name = parser_name
                 break
             else:
                 logger.debug("The parser '%s' did not extract any of the following fields '%s'", parser_name, ", ".join(META_CONTENT[self.meta_name].keys()))
 
+        if selection_keys is not None:
+            XML_PARSER_SELECTOR.record(selection_keys, succeeded_parser_name, attempt)
+
         self.parsed_xml = parsed_xml
         return parsed_xml
 
@@ -667,9 +940,7 @@ class StandardExtractorXML(object):
 
         :return: parsed XML file
         """
-        raw_xml = self.raw_xml
-
-        raw_xml = self._remove_special_elements(raw_xml, parser_name)
+        raw_xml = self._preprocess(parser_name)
         if parser_name in ("direct-lxml-html", "lxml-html", "html5lib"):
             raw_xml, random_body_tag = self._save_body_tag(raw_xml)
         else:
@@ -726,15 +997,36 @@ class StandardExtractorXML(object):
             parsed_xml = self._remove_namespace_prefixes(parsed_xml)
 
         # remove tables, formulas, figures and bibliography
-        for e in parsed_xml.xpath("//table | //graphic | //disp-formula | ////inline-formula | //formula | //tex-math | //processing-instruction('CDATA') | //bibliography"):
+        for e in PRUNE(parsed_xml):
             self._remove_keeping_tail(e)
 
         # move acknowledgments after body (most likely only a minority of documents have this problem)
-        for e in parsed_xml.xpath(" | ".join(META_CONTENT['xml']['acknowledgements']['xpath'])):
+        for e in ACKNOWLEDGEMENTS(parsed_xml):
             self._append_tag_outside_parent(e)
 
         return parsed_xml
 
+    def _xpath(self, parsed_xml, xpath):
+        """
+        Evaluates a rule with its precompiled xpath. The results are kept until
+        a different tree is given, thus the rules evaluated to check if a parser
+        succeeded are not evaluated again when the fields are extracted.
+
+        :param parsed_xml: parsed document
+        :param xpath: xpath string, as in META_CONTENT
+        :return: list of results
+        """
+        if self._xpath_results_tree is not parsed_xml:
+            self._xpath_results_tree = parsed_xml
+            self._xpath_results = {}
+        if xpath not in self._xpath_results:
+            compiled = COMPILED_META_CONTENT.get(self.meta_name, {}).get(xpath)
+            if compiled is None:
+                self._xpath_results[xpath] = parsed_xml.xpath(xpath)
+            else:
+                self._xpath_results[xpath] = compiled(parsed_xml)
+        return self._xpath_results[xpath]
+
     def extract_string(self, static_xpath, **kwargs):
         """
         Extracts the first matching string requested from the given xpath
@@ -760,7 +1052,7 @@ class StandardExtractorXML(object):
         else:
             extract_all = False
 
-        s = self.parsed_xml.xpath(static_xpath)
+        s = self._xpath(self.parsed_xml, static_xpath)
 
         if s:
             if sys.version_info > (3,):
@@ -820,7 +1112,7 @@ class StandardExtractorXML(object):
             logger.error('You did not supply the info kwarg, returning an empty list')
             return data_inner
 
-        text_content = self.parsed_xml.xpath(static_xpath)
+        text_content = self._xpath(self.parsed_xml, static_xpath)
 
         for span in text_content:
             try:
@@ -876,6 +1168,11 @@ class StandardExtractorXML(object):
             # If None or (None,), use the default from the config file
             preferred_parser_names = self.preferred_parser_names
 
+        if self.streaming_threshold and STREAMING_META_CONTENT.get(self.meta_name) \
+                and os.path.getsize(self.file_input) > self.streaming_threshold:
+            logger.info('Streaming the extraction of %s (larger than %s bytes)', self.file_input, self.streaming_threshold)
+            return self.extract_multi_content_streaming(translate=translate, decode=decode)
+
         meta_out = {}
         self.open_xml()
         self.parse_xml(preferred_parser_names=preferred_parser_names)
@@ -967,6 +1264,240 @@ class StandardExtractorXML(object):
 
         return meta_out
 
+    def _stream_xml(self, chunk_size=1024*1024):
+        """
+        Reads the XML file in chunks and applies the same changes as open_xml
+        and the regex passes of the direct-lxml-xml parser that must be done
+        before parsing: the comment syntax around the body is removed, CDATA
+        is removed and the entities are converted. Every chunk is cut after
+        the last complete tag, thus entities and CDATA are never split.
+
+        :param chunk_size: number of bytes read at a time
+        :return: generator of UTF-8 encoded chunks
+        """
+        with open(self.file_input, 'rb') as fp:
+            raw_xml = fp.read(chunk_size)
+            # the encoding is detected with the first chunk only
+            encoding = CONTENT_DECODER.decode(raw_xml, partial=True)[1] or 'utf-8'
+            decoder = codecs.getincrementaldecoder(encoding)(errors='ignore')
+            pending = ''
+            while raw_xml:
+                pending += decoder.decode(raw_xml)
+                end = pending.rfind('>') + 1
+                cdata_start = pending.rfind('<![CDATA[', 0, end)
+                if cdata_start >= 0 and pending.find(']]>', cdata_start, end) < 0:
+                    end = cdata_start
+                if end > 0:
+                    yield self._preprocess_chunk(pending[:end])
+                    pending = pending[end:]
+                raw_xml = fp.read(chunk_size)
+            pending += decoder.decode(b'', final=True)
+            if pending:
+                yield self._preprocess_chunk(pending)
+
+    def _preprocess_chunk(self, raw_xml):
+        # see https://github.com/adsabs/ADSfulltext/issues/104 for the
+        # comment syntax around the body, the markers are removed separately
+        # since they are usually in different chunks
+        raw_xml = re.sub('<!--\s*body\s*(?=<)', '', raw_xml)
+        raw_xml = re.sub('\s*endbody\s*-->', '', raw_xml)
+        raw_xml = self._apply_preprocessing_step(raw_xml, 'cdata')
+        raw_xml = edef.convertentities(raw_xml)
+        return raw_xml.encode('utf-8')
+
+    def _local_name(self, name):
+        i = name.find('}')
+        if i > 0:
+            return name[i+1:]
+        return name
+
+    def _attribute(self, element, name):
+        """
+        :return: value of the attribute, if the rules give a prefixed name
+        (e.g., xlink:href) any namespace is accepted
+        """
+        value = element.attrib.get(name)
+        if value is None and ":" in name:
+            name = name.split(":", 1)[1]
+            for key, key_value in element.attrib.items():
+                if self._local_name(key) == name:
+                    return key_value
+        return value
+
+    def extract_multi_content_streaming(self, translate=True, decode=False):
+        """
+        Extracts the same content as extract_multi_content while the file is
+        parsed (lxml XMLPullParser), to avoid holding the file content and the
+        whole tree in memory for very large files. Elements that cannot be
+        part of the extracted content are cleared as soon as they are closed,
+        tables, formulas, figures and bibliography are removed when they are
+        closed and acknowledgements are removed from their parent (i.e., body).
+        Inside the elements that are extracted, the text of every closed
+        element is collected and the element is deleted once its tail has been
+        read, thus only the open elements stay in the tree. Only rules that
+        select elements by name and attributes are used (see
+        rules.streaming_xpath).
+
+        Unlike the DOM parsers, which move the acknowledgements after their
+        parent, the acknowledgements are removed from their parent keeping
+        their tail: an acknowledgement nested in a paragraph of the body is not
+        part of the full text, the text that follows an acknowledgement in the
+        body is, and the first of several acknowledgements is extracted (the
+        last one with the DOM parsers).
+
+        :param translate: boolean, should it translate the text (see utils.py)
+        :param decode: boolean, should it decode to UTF-8 (see utils.py)
+        :return: updated meta-data containing the full text and other user
+        specified content
+        """
+        rules = STREAMING_META_CONTENT[self.meta_name]
+        # per content name and xpath, text (or attribute) of the matching
+        # elements in document order
+        found = dict((content_name, dict((xpath, []) for xpath, compiled in rules[content_name]))
+                     for content_name in rules)
+        # elements that have been opened: (element, positions to fill with
+        # their text when they are closed, pruned, acknowledgement, collected
+        # text or None if no open element needs it)
+        open_elements = []
+        capturing = 0
+        pruned = 0
+
+        parser = lxml.etree.XMLPullParser(events=('start', 'end'), recover=True, huge_tree=True, remove_blank_text=True,
+                                          remove_comments=True, remove_pis=True, strip_cdata=True, resolve_entities=False,
+                                          encoding="UTF-8")
+
+        def collect(element, collected, count):
+            """
+            Appends to the collected text of the element the text of its first
+            children (as element.itertext would give it) and deletes them,
+            their tails must have been read. As _remove_keeping_tail, the tail
+            of a removed child is appended to the text before it.
+            """
+            text = collected['text']
+            if text is None:
+                text = collected['text'] = [element.text] if element.text is not None else []
+                collected['loose'] = element.text is not None
+            for child in element[:count]:
+                removed = False
+                if isinstance(child.tag, basestring):
+                    child_text = collected['children'].pop(0)
+                    removed = child_text is None
+                    if not removed:
+                        text.extend(child_text)
+                elif child.tag is lxml.etree.Entity:
+                    text.append(child.text)
+                if child.tail is not None:
+                    if removed and collected['loose']:
+                        text[-1] += child.tail
+                    else:
+                        text.append(child.tail)
+                    collected['loose'] = True
+                elif not removed:
+                    collected['loose'] = False
+                element.remove(child)
+
+        def handle(event, element):
+            nonlocal capturing, pruned
+            if not isinstance(element.tag, basestring):
+                return
+            if event == 'start':
+                is_pruned = pruned > 0 or self._local_name(element.tag) in PRUNE_TAGS
+                positions = []
+                if is_pruned:
+                    pruned += 1
+                else:
+                    for content_name in rules:
+                        content_type = META_CONTENT[self.meta_name][content_name]['type']
+                        for xpath, compiled in rules[content_name]:
+                            if not compiled(element):
+                                continue
+                            if content_type == 'list':
+                                found[content_name][xpath].append(self._attribute(element, META_CONTENT[self.meta_name][content_name]['info']))
+                            else:
+                                found[content_name][xpath].append(None)
+                                positions.append((content_name, xpath, len(found[content_name][xpath]) - 1))
+                    if positions:
+                        capturing += 1
+                is_acknowledgement = not is_pruned and bool(STREAMING_ACKNOWLEDGEMENTS(element))
+                # text of the children closed but not collected yet
+                collected = {'text': None, 'children': []} if capturing > 0 and not is_pruned else None
+                open_elements.append((element, positions, is_pruned, is_acknowledgement, collected))
+                return
+
+            element, positions, is_pruned, is_acknowledgement, collected = open_elements.pop()
+            parent = element.getparent()
+            if is_pruned:
+                pruned -= 1
+            if collected is not None:
+                collect(element, collected, len(element))
+            if positions:
+                capturing -= 1
+                text = " ".join(map(str.strip, collected['text']))
+                for content_name, xpath, position in positions:
+                    found[content_name][xpath][position] = text
+            parent_collected = open_elements[-1][4] if open_elements else None
+            if parent_collected is not None:
+                # the parent collects the text (None if removed) when the tail
+                # is known, i.e., once a following sibling has been closed
+                parent_collected['children'].append(None if is_pruned or is_acknowledgement else collected['text'])
+                element.text = None
+                collect(parent, parent_collected, parent.index(element))
+            elif is_pruned or is_acknowledgement:
+                if parent is not None:
+                    self._remove_keeping_tail(element)
+            else:
+                # no open element needs the content of this one
+                element.clear()
+                if parent is not None:
+                    while element.getprevious() is not None:
+                        del parent[0]
+
+        for chunk in self._stream_xml():
+            parser.feed(chunk)
+            for event, element in parser.read_events():
+                handle(event, element)
+        parser.close()
+        for event, element in parser.read_events():
+            handle(event, element)
+
+        meta_out = {}
+        for content_name in rules:
+            content_type = META_CONTENT[self.meta_name][content_name]['type']
+            all_text_content = []
+            for xpath, compiled in rules[content_name]:
+                values = found[content_name][xpath]
+                if content_type == 'string':
+                    if content_name != 'fulltext':
+                        # as extract_string, only the first element is used
+                        values = values[:1]
+                    text_content = TextCleaner(text=" ".join(values)).run(
+                        decode=decode,
+                        translate=translate,
+                        normalise=True,
+                        trim=True)
+                else:
+                    text_content = []
+                    for value in values:
+                        if value is None:
+                            continue
+                        value = TextCleaner(text=value).run(
+                            decode=decode,
+                            translate=translate,
+                            normalise=True,
+                            trim=True)
+                        if value == 'None' or value == '':
+                            continue
+                        text_content.append(value)
+                if text_content and not any(text_content in s for s in all_text_content):
+                    all_text_content.append(text_content)
+
+            if content_type == 'string':
+                meta_out[content_name] = "\n".join(all_text_content)
+            elif len(all_text_content) > 0:
+                meta_out[content_name] = all_text_content[0]
+
+        return meta_out
+
 
 class StandardExtractorTEIXML(StandardExtractorXML):
     """
@@ -1113,15 +1644,20 @@ class PDFExtractor(object):
         self.bibcode = kwargs.get('bibcode', None)
         self.provider = kwargs.get('provider', None)
         self.extract_pdf_script = proj_home + kwargs.get('extract_pdf_script', '/scripts/extract_pdf_with_pdftotext.sh')
+        # pool of resident PDFBox extractors (see pdfserver.py), if any
+        self.pdf_server = kwargs.get('pdf_server', None)
 
         if not self.ft_source:
             raise Exception('Missing or non-existent source: %s', self.ft_source)
 
     def extract_multi_content(self, translate=False, decode=True):
-        p = Popen([self.extract_pdf_script, self.ft_source], stdout=PIPE, stderr=PIPE)
-        stdout, stderr = p.communicate()
-        if p.returncode != 0:
-            raise Exception(stderr)
+        if self.pdf_server is not None:
+            stdout = self.pdf_server.extract(self.ft_source)
+        else:
+            p = Popen([self.extract_pdf_script, self.ft_source], stdout=PIPE, stderr=PIPE)
+            stdout, stderr = p.communicate()
+            if p.returncode != 0:
+                raise Exception(stderr)
         fulltext = TextCleaner(text=stdout).run(translate=translate,
                                           decode=decode,
                                           normalise=True,
@@ -1196,7 +1732,8 @@ def extract_content(input_list, **kwargs):
     settings.py).
 
     :param input_list: dictionaries that contain meta-data of articles
-    :param kwargs: used to store grobid service URL
+    :param kwargs: used to store grobid service URL, PDF extraction script and
+    pool of resident PDF extractors
     :return: json formatted list of dictionaries now containing full text
     """
 
@@ -1238,6 +1775,7 @@ def extract_content(input_list, **kwargs):
             try:
                 dict_item['grobid_service'] = kwargs.get('grobid_service', None)
                 dict_item['extract_pdf_script'] = kwargs.get('extract_pdf_script', None)
+                dict_item['pdf_server'] = kwargs.get('pdf_server', None)
                 # get one or more files from ft_source and process
                 files = get_filenames(dict_item['ft_source'])
                 for f in files:
@@ -1249,14 +1787,22 @@ def extract_content(input_list, **kwargs):
                         if item in dict_item:
                             # values can be strings or, for dataset, a list
                             if isinstance(dict_item[item], str):
-                                dict_item[item] += ' ' + parsed_content[item]
+                                # empty texts are skipped to keep the result clean
+                                dict_item[item] = ' '.join([text for text in (dict_item[item], parsed_content[item]) if text])
                             else:
                                 dict_item[item] += parsed_content[item]
                         else:
                             dict_item[item] = parsed_content[item]
 
+                # every extractor cleans the texts (TextCleaner.run), but some
+                # join them with new lines, which are only removed when the
+                # body is cleaned again before being sent
+                if TextCleaner.is_clean(dict_item.get('fulltext', '')):
+                    dict_item['cleaner_version'] = TextCleaner.version
+
                 del dict_item['grobid_service']
                 del dict_item['extract_pdf_script']
+                del dict_item['pdf_server']
 
                 output_list.append(dict_item)
 
@@ -1267,3 +1813,102 @@ def extract_content(input_list, **kwargs):
             del extractor, parsed_content
 
     return output_list
+
+
+def extract_pdf_batch(input_list, **kwargs):
+    """
+    Extracts the full text of a batch of PDF articles with a single call to
+    the PDF extractor, which accepts many "source.pdf|output.txt" arguments,
+    instead of one process per article. A file that cannot be extracted only
+    fails the article it belongs to.
+
+    :param input_list: dictionaries that contain meta-data of PDF articles
+    :param kwargs: extract_pdf_batch_script, pdf_server (pool of resident PDF
+    extractors, used instead of the script when given), timeout in seconds,
+    and extract_pdf_script and grobid_service used by extract_content for the
+    FORCE_TO_SEND articles without previously extracted data
+    :return: tuple with the list of dictionaries now containing full text and
+    the list of dictionaries that failed
+    """
+
+    output_list, failed_list = [], []
+    extract_pdf_batch_script = proj_home + kwargs.get('extract_pdf_batch_script', '/scripts/extract_pdf_batch_with_pdfbox.sh')
+    pdf_server = kwargs.get('pdf_server', None)
+    timeout = kwargs.get('timeout', None)
+
+    pending = []
+    for dict_item in input_list:
+        if 'UPDATE' in dict_item and dict_item['UPDATE'] == 'FORCE_TO_SEND':
+            # Previously extracted data is read back by the standard path,
+            # which extracts the PDF again if there is none
+            try:
+                output_list.extend(extract_content([dict_item],
+                                                   extract_pdf_script=kwargs.get('extract_pdf_script', '/scripts/extract_pdf_with_pdftotext.sh'),
+                                                   grobid_service=kwargs.get('grobid_service', None),
+                                                   pdf_server=pdf_server))
+            except Exception:
+                failed_list.append(dict_item)
+            continue
+        try:
+            files = get_filenames(dict_item['ft_source'])
+        except ValueError:
+            logger.exception("Fulltext extraction failed for bibcode '%s': '%s'", dict_item['bibcode'], dict_item['ft_source'])
+            failed_list.append(dict_item)
+            continue
+        if any('|' in f for f in files):
+            logger.error("Fulltext extraction failed for bibcode '%s', unsupported file name: '%s'", dict_item['bibcode'], dict_item['ft_source'])
+            failed_list.append(dict_item)
+            continue
+        pending.append((dict_item, files))
+
+    temp_dir = tempfile.mkdtemp(prefix='pdfbatch')
+    try:
+        arguments, texts = [], {}
+        for i, (dict_item, files) in enumerate(pending):
+            for j, f in enumerate(files):
+                output_file_name = os.path.join(temp_dir, '{0}_{1}.txt'.format(i, j))
+                arguments.append('{0}|{1}'.format(f, output_file_name))
+
+        if pdf_server is not None:
+            for argument in arguments:
+                ft_source, output_file_name = argument.split('|')
+                try:
+                    texts[output_file_name] = pdf_server.extract(ft_source)
+                except Exception as err:
+                    logger.error('PDF extraction failed for %s: %s', ft_source, err)
+        elif arguments:
+            p = Popen([extract_pdf_batch_script] + arguments, stdout=PIPE, stderr=STDOUT)
+            try:
+                stdout, stderr = p.communicate(timeout=timeout)
+            except TimeoutExpired:
+                p.kill()
+                stdout, stderr = p.communicate()
+                logger.error('PDF batch extraction timed out after %s seconds, keeping completed files', timeout)
+            if p.returncode != 0:
+                logger.error('PDF batch extraction exited with code %s: %s', p.returncode, stdout)
+            for argument in arguments:
+                output_file_name = argument.split('|')[1]
+                if os.path.exists(output_file_name):
+                    with open(output_file_name, 'rb') as f:
+                        texts[output_file_name] = f.read()
+
+        for i, (dict_item, files) in enumerate(pending):
+            output_file_names = [os.path.join(temp_dir, '{0}_{1}.txt'.format(i, j)) for j in range(len(files))]
+            missing = [f for f, o in zip(files, output_file_names) if o not in texts]
+            if missing:
+                logger.error("Fulltext extraction failed for bibcode '%s': '%s'", dict_item['bibcode'], ", ".join(missing))
+                failed_list.append(dict_item)
+                continue
+            fulltext = [TextCleaner(text=texts[o]).run(translate=False,
+                                                       decode=True,
+                                                       normalise=True,
+                                                       trim=True)
+                        for o in output_file_names]
+            dict_item['fulltext'] = ' '.join([text for text in fulltext if text])
+            if TextCleaner.is_clean(dict_item['fulltext']):
+                dict_item['cleaner_version'] = TextCleaner.version
+            output_list.append(dict_item)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    return output_list, failed_list
@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, Text, TIMESTAMP
+from sqlalchemy import Column, Integer, BigInteger, Float, String, Text, TIMESTAMP
 
 Base = declarative_base()
 
@@ -13,3 +13,41 @@ class KeyValue(Base):
 
     def toJSON(self):
         return {'key': self.key, 'value': self.value }
+
+
+class XMLParserChoice(Base):
+    """XML parser that succeeded last for the articles of a provider and journal"""
+    __tablename__ = 'xml_parser_choice'
+    provider = Column(String(255), primary_key=True)
+    bibstem = Column(String(255), primary_key=True)
+    parser_name = Column(String(255))
+    documents = Column(Integer, default=0)
+    updated = Column(TIMESTAMP)
+
+    def toJSON(self):
+        return {'provider': self.provider, 'bibstem': self.bibstem,
+                'parser_name': self.parser_name, 'documents': self.documents,
+                'updated': self.updated and self.updated.isoformat() }
+
+
+class ExtractionState(Base):
+    """State of the last extraction of an article, as written in its meta.json"""
+    __tablename__ = 'extraction_state'
+    bibcode = Column(String(255), primary_key=True)
+    ft_source = Column(Text)
+    source_mtime = Column(Float)
+    source_size = Column(BigInteger)
+    meta_mtime = Column(Float)
+    fulltext_mtime = Column(Float)
+    index_date = Column(String(255))
+    file_format = Column(String(255))
+    cleaner_version = Column(Integer)
+    ft_source_hash = Column(String(255))
+
+    def toJSON(self):
+        return {'bibcode': self.bibcode, 'ft_source': self.ft_source,
+                'source_mtime': self.source_mtime, 'source_size': self.source_size,
+                'meta_mtime': self.meta_mtime, 'fulltext_mtime': self.fulltext_mtime,
+                'index_date': self.index_date,
+                'file_format': self.file_format, 'cleaner_version': self.cleaner_version,
+                'ft_source_hash': self.ft_source_hash }
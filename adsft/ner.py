@@ -1,4 +1,8 @@
 import os
+import re
+import time
+import threading
+import multiprocessing
 import spacy
 
 # ============================= INITIALIZATION ==================================== #
@@ -14,8 +18,142 @@ logger = setup_logging(__name__, proj_home=proj_home,
                         attach_stdout=config.get('LOG_STDOUT', False))
 
 
+# Components of the pipeline that do not set the entities of a document and
+# are not needed to identify facilities (NER_DISABLE_COMPONENTS by default),
+# any other component (e.g., a custom entity ruler) is kept
+NER_DISABLE_COMPONENTS = ('tagger', 'parser', 'sentencizer')
+
+# Boundaries tried, in this order, to split long texts in chunks
+CHUNK_BOUNDARIES = ('\n\n', '\n', '. ', ' ')
+
+_models = {}
+_gazetteers = {}
+_models_lock = threading.Lock()
+
+# ================================ CLASSES ======================================== #
+
+class FacilityGazetteer(object):
+    """
+    Prefilter of the texts sent to the NER models: a text (or chunk) that does
+    not mention any of the known facility names or aliases is not worth a
+    spacy pass. The names are searched case insensitively, as whole words,
+    with an Aho-Corasick automaton if pyahocorasick is installed or a regular
+    expression otherwise. It counts how many texts were checked and skipped.
+    """
+
+    def __init__(self, names):
+        """
+        :param names: facility names and aliases
+        """
+        names = sorted(set(name.strip().lower() for name in names if name.strip()))
+        self.statistics = {'checked': 0, 'skipped': 0}
+        if not names:
+            logger.warning('The facility gazetteer is empty, the NER will be skipped for all the texts')
+        try:
+            import ahocorasick
+        except ImportError:
+            ahocorasick = None
+        if ahocorasick is not None:
+            self.automaton = ahocorasick.Automaton()
+            for name in names:
+                self.automaton.add_word(name, len(name))
+            self.automaton.make_automaton()
+            self.pattern = None
+        else:
+            self.automaton = None
+            self.pattern = re.compile(r'(?!)') if not names else re.compile(r'(?<!\w)(?:' + '|'.join(re.escape(name) for name in
+                                                          sorted(names, key=len, reverse=True)) + r')(?!\w)')
+
+    @classmethod
+    def from_file(cls, file_name):
+        """
+        :param file_name: path to a file with one facility name or alias per line
+        :return: the gazetteer
+        """
+        with open(file_name, 'rb') as f:
+            return cls(line.decode('utf-8') for line in f)
+
+    def mentions_facility(self, text):
+        """
+        :param text: text to check
+        :return: True if the text mentions one of the facilities
+        """
+        text = text.lower()
+        if self.automaton is None:
+            return self.pattern.search(text) is not None
+        if len(self.automaton) == 0:
+            return False
+        for end, length in self.automaton.iter(text):
+            start = end - length + 1
+            if (start == 0 or not text[start - 1].isalnum() and text[start - 1] != '_') and \
+                    (end + 1 == len(text) or not text[end + 1].isalnum() and text[end + 1] != '_'):
+                return True
+        return False
+
+    def worth_ner(self, text):
+        """
+        :param text: text (or chunk of text) to check
+        :return: True if the text should be sent to the NER model
+        """
+        self.statistics['checked'] += 1
+        if self.mentions_facility(text):
+            return True
+        self.statistics['skipped'] += 1
+        return False
+
+    def get_statistics(self):
+        """
+        :return: number of texts checked and skipped, and the skip rate
+        """
+        statistics = dict(self.statistics)
+        statistics['skip_rate'] = float(statistics['skipped']) / statistics['checked'] if statistics['checked'] else 0.
+        return statistics
+
+
 # =============================== FUNCTIONS ======================================= #
 
+def split_text(text, max_length=None, overlap=None):
+
+    """
+    purpose: to split a long text in chunks of bounded length, cut on
+    paragraph or sentence boundaries when possible, each chunk overlapping
+    the previous one so that the entities cut by a boundary (shorter than
+    half the overlap) are found entirely in one of them
+    input: text to split, maximum number of characters of a chunk
+    (NER_CHUNK_SIZE by default, 0 to not split) and number of characters
+    overlapping between consecutive chunks (NER_CHUNK_OVERLAP by default)
+    return: generator of (start, end, own_start, own_end) offsets of the
+    chunks in the text, each chunk owns the entities starting in
+    [own_start, own_end) so that the ones in the overlaps are kept once
+    """
+
+    if max_length is None:
+        max_length = config.get('NER_CHUNK_SIZE', 100000)
+    if overlap is None:
+        overlap = config.get('NER_CHUNK_OVERLAP', 200)
+
+    if not max_length or len(text) <= max_length:
+        yield 0, len(text), 0, len(text)
+        return
+
+    overlap = min(overlap, max_length // 4)
+    start = own_start = 0
+    while start + max_length < len(text):
+        end = start + max_length
+        # cut on the last boundary in the second half of the chunk
+        for boundary in CHUNK_BOUNDARIES:
+            position = text.rfind(boundary, start + max_length // 2, end)
+            if position != -1:
+                end = position + len(boundary)
+                break
+        # the next chunk starts at the beginning of a word of the overlap
+        next_start = text.find(' ', end - overlap, end)
+        next_start = end - overlap if next_start == -1 else next_start + 1
+        own_end = (next_start + end) // 2
+        yield start, end, own_start, own_end
+        start, own_start = next_start, own_end
+    yield start, len(text), own_start, len(text)
+
 def get_facilities(model, text):
 
     """
@@ -24,15 +162,81 @@ def get_facilities(model, text):
     return: list of facilities identified with custom spacy ner model
     """
 
-    doc = model(text)
+    return get_facilities_batch(model, [text], batch_size=1, n_process=1)[0]
+
+def get_facilities_batch(model, texts, batch_size=None, n_process=None, gazetteer=None):
 
-    facilities = []
+    """
+    purpose: to identify facilities within many texts, streamed through the
+    model with nlp.pipe, the long texts are split in chunks (see split_text)
+    so that the memory used does not depend on the length of the texts
+    input: model loaded from disk, list of texts to process, number of chunks
+    per batch (NER_BATCH_SIZE by default), number of processes (NER_N_PROCESS
+    by default) and FacilityGazetteer used to skip the chunks that do not
+    mention any known facility (None to send all of them to the model)
+    return: list of the lists of facilities identified in each text, in the
+    same order as the texts
+    """
 
-    for ent in doc.ents:
-        facilities.append(ent.text)
+    if not texts:
+        return []
+    if batch_size is None:
+        batch_size = config.get('NER_BATCH_SIZE', 32)
+    if n_process is None:
+        n_process = config.get('NER_N_PROCESS', 1)
+    if n_process > 1 and multiprocessing.current_process().daemon:
+        # celery prefork workers are daemonic and cannot start processes
+        logger.warning('Cannot use %s processes for NER within a daemonic process, using one', n_process)
+        n_process = 1
+    n_process = min(n_process, len(texts))
+
+    def chunks():
+        for i, text in enumerate(texts):
+            for start, end, own_start, own_end in split_text(text):
+                if gazetteer is None or gazetteer.worth_ner(text[start:end]):
+                    yield text[start:end], (i, start, own_start, own_end)
+
+    disable_components = config.get('NER_DISABLE_COMPONENTS', NER_DISABLE_COMPONENTS)
+    disable = [name for name in model.pipe_names if name in disable_components]
+    facilities = [[] for text in texts]
+    for doc, (i, start, own_start, own_end) in model.pipe(chunks(), as_tuples=True, batch_size=batch_size,
+                                                          n_process=n_process, disable=disable):
+        facilities[i].extend(ent.text for ent in doc.ents if own_start <= start + ent.start_char < own_end)
 
     return facilities
 
 def load_model(dir):
 
     return spacy.load(dir)
+
+def get_model(dir):
+
+    """
+    purpose: to get the model of the current process, it is loaded on first
+    use so that only the workers running the NER pay for it
+    input: directory of the model
+    return: model loaded from disk
+    """
+
+    with _models_lock:
+        if dir not in _models:
+            start = time.time()
+            _models[dir] = load_model(dir)
+            logger.info('Loaded spacy model %s in %.1f s', dir, time.time() - start)
+    return _models[dir]
+
+def get_gazetteer(file_name):
+
+    """
+    purpose: to get the facility gazetteer of the current process, it is
+    loaded on first use
+    input: path to the file of facility names and aliases, or None
+    return: FacilityGazetteer, None if there is no file
+    """
+
+    if not file_name:
+        return None
+    with _models_lock:
+        if file_name not in _gazetteers:
+            _gazetteers[file_name] = FacilityGazetteer.from_file(file_name)
+    return _gazetteers[file_name]
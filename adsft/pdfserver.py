@@ -0,0 +1,322 @@
+"""
+PDFBox Extraction Server Functions
+
+Keeps a pool of resident PDFBox extractors (App.java started with --server)
+per worker process, so that every PDF does not pay for a JVM start up and the
+PDFBox class loading as it does with scripts/extract_pdf_with_pdfbox.sh. The
+JVMs read one "pdf|output" request per line from stdin and answer with one
+line on stdout, they are health checked when idle and restarted if they crash
+or hang.
+"""
+import os
+import sys
+import time
+import atexit
+import select
+import tempfile
+import threading
+from subprocess import Popen, PIPE
+if sys.version_info > (3,):
+    import queue
+else:
+    import Queue as queue
+
+# ============================= INITIALIZATION ==================================== #
+# - Use app logger:
+#import logging
+#logger = logging.getLogger('ads-fulltext')
+# - Or individual logger for this file:
+from adsputils import setup_logging, load_config
+proj_home = os.path.realpath(os.path.join(os.path.dirname(__file__), '../'))
+config = load_config(proj_home=proj_home)
+logger = setup_logging(__name__, proj_home=proj_home,
+                        level=config.get('LOGGING_LEVEL', 'INFO'),
+                        attach_stdout=config.get('LOG_STDOUT', False))
+
+
+# ================================ CLASSES ======================================== #
+
+class PDFServerError(Exception):
+    """
+    The resident extractor died, hung or could not be started
+    """
+    pass
+
+
+class PDFExtractionError(Exception):
+    """
+    The resident extractor is healthy but could not extract the given PDF
+    """
+    pass
+
+
+class PDFBoxServer(object):
+    """
+    Wraps one resident PDFBox extractor process. Responses are prefixed with
+    RESPONSE_PREFIX, any other line on stdout is log4j output and is ignored.
+    """
+
+    RESPONSE_PREFIX = 'ADSFT-'
+
+    def __init__(self, command, timeout=120, health_check_interval=60):
+        """
+        Initialisation method (constructor) of the class
+
+        :param command: command line that starts the extractor in server mode
+        :param timeout: seconds to wait for the extraction of a single PDF
+        :param health_check_interval: idle seconds after which the process is
+        pinged before being used again
+        :return: no return
+        """
+        self.command = command
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.process = None
+        self.restarts = 0
+        self.last_used = 0
+        self._buffer = b''
+
+    def start(self):
+        """
+        Starts the extractor process
+        :return: no return
+        """
+        logger.debug('Starting PDFBox server: %s', self.command)
+        with open(os.devnull, 'wb') as devnull:
+            self.process = Popen(self.command, stdin=PIPE, stdout=PIPE,
+                                 stderr=devnull, cwd=proj_home)
+        self._buffer = b''
+        self.last_used = time.time()
+
+    def stop(self):
+        """
+        Closes the extractor stdin, which ends the server loop, and makes sure
+        the process is gone
+        :return: no return
+        """
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+        except (IOError, OSError):
+            pass
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+        self.process.stdout.close()
+        self.process = None
+        self._buffer = b''
+
+    def restart(self):
+        """
+        Replaces a crashed or hung extractor process by a new one
+        :return: no return
+        """
+        logger.warning('Restarting PDFBox server: %s', self.command)
+        self.stop()
+        self.restarts += 1
+        self.start()
+
+    def is_alive(self):
+        """
+        :return: boolean, is the extractor process running
+        """
+        return self.process is not None and self.process.poll() is None
+
+    def _send(self, line):
+        try:
+            self.process.stdin.write((line + '\n').encode('utf-8'))
+            self.process.stdin.flush()
+        except (IOError, OSError) as err:
+            raise PDFServerError('Could not write to PDFBox server: {0}'.format(err))
+
+    def _read_response(self, timeout):
+        """
+        Reads stdout until a line with the response prefix is found
+
+        :param timeout: seconds to wait for the response
+        :return: the response without the prefix
+        """
+        deadline = time.time() + timeout
+        fd = self.process.stdout.fileno()
+        while True:
+            while b'\n' in self._buffer:
+                line, self._buffer = self._buffer.split(b'\n', 1)
+                line = line.decode('utf-8', 'ignore').strip()
+                if line.startswith(self.RESPONSE_PREFIX):
+                    return line[len(self.RESPONSE_PREFIX):]
+                logger.debug('PDFBox server output: %s', line)
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise PDFServerError('PDFBox server did not answer in {0} seconds'.format(timeout))
+            ready, _, _ = select.select([fd], [], [], remaining)
+            if not ready:
+                continue
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                raise PDFServerError('PDFBox server exited with code {0}'.format(self.process.wait()))
+            self._buffer += chunk
+
+    def ping(self, timeout=10):
+        """
+        Health check of the extractor process
+
+        :param timeout: seconds to wait for the answer
+        :return: boolean, did the process answer
+        """
+        if not self.is_alive():
+            return False
+        try:
+            self._send('PING')
+            return self._read_response(timeout) == 'PONG'
+        except PDFServerError:
+            return False
+
+    def ensure_running(self):
+        """
+        Starts the process if needed, restarts it if it crashed or if it does
+        not answer a health check after being idle
+        :return: no return
+        """
+        if self.process is None:
+            self.start()
+        elif not self.is_alive():
+            self.restart()
+        elif time.time() - self.last_used > self.health_check_interval and not self.ping():
+            self.restart()
+
+    def _extract(self, ft_source, output_file_name):
+        self._send('{0}|{1}'.format(ft_source, output_file_name))
+        response = self._read_response(self.timeout)
+        self.last_used = time.time()
+        if not response.startswith('OK'):
+            raise PDFExtractionError(response)
+        with open(output_file_name, 'rb') as f:
+            return f.read()
+
+    def extract(self, ft_source):
+        """
+        Extracts the text of a PDF. If the process crashes while extracting,
+        it is restarted and the file is tried once more; if it hangs, it is
+        restarted and the file is given up.
+
+        :param ft_source: path to the PDF file
+        :return: extracted text (UTF-8 bytes)
+        """
+        self.ensure_running()
+        fd, output_file_name = tempfile.mkstemp(prefix='pdfbox', suffix='.txt')
+        os.close(fd)
+        try:
+            try:
+                return self._extract(ft_source, output_file_name)
+            except PDFServerError as err:
+                hung = self.is_alive()
+                logger.warning('PDFBox server failed on %s: %s', ft_source, err)
+                self.restart()
+                if hung:
+                    raise
+                return self._extract(ft_source, output_file_name)
+        finally:
+            try:
+                os.remove(output_file_name)
+            except OSError:
+                pass
+
+
+class PDFBoxServerPool(object):
+    """
+    Fixed size pool of resident extractors, processes are started on first use
+    """
+
+    def __init__(self, size, command, timeout=120, health_check_interval=60):
+        """
+        Initialisation method (constructor) of the class
+
+        :param size: number of resident extractor processes
+        :param command: command line that starts the extractor in server mode
+        :param timeout: seconds to wait for the extraction of a single PDF
+        :param health_check_interval: idle seconds before a health check
+        :return: no return
+        """
+        self.servers = [PDFBoxServer(command, timeout=timeout,
+                                     health_check_interval=health_check_interval)
+                        for i in range(size)]
+        self._idle = queue.Queue()
+        for server in self.servers:
+            self._idle.put(server)
+
+    def extract(self, ft_source):
+        """
+        Extracts the text of a PDF with the next idle extractor
+
+        :param ft_source: path to the PDF file
+        :return: extracted text (UTF-8 bytes)
+        """
+        server = self._idle.get()
+        try:
+            return server.extract(ft_source)
+        finally:
+            self._idle.put(server)
+
+    def restarts(self):
+        """
+        :return: total number of restarts of the extractors of this pool
+        """
+        return sum(server.restarts for server in self.servers)
+
+    def close(self):
+        """
+        Stops all the extractor processes
+        :return: no return
+        """
+        for server in self.servers:
+            server.stop()
+
+
+# =============================== FUNCTIONS ======================================= #
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_server_pool(size, jar, java='java', timeout=120, health_check_interval=60):
+    """
+    Returns the pool of resident extractors of the current process, it is
+    created on first use so that the JVMs are never inherited by forked
+    workers.
+
+    :param size: number of resident extractors, 0 disables the pool
+    :param jar: path to the PDF extractor jar with dependencies
+    :param java: java executable
+    :param timeout: seconds to wait for the extraction of a single PDF
+    :param health_check_interval: idle seconds before a health check
+    :return: the pool or None if disabled
+    """
+    global _pool, _pool_pid
+
+    if not size or size <= 0:
+        return None
+
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            command = [java, '-jar', jar, '--server']
+            _pool = PDFBoxServerPool(size, command, timeout=timeout,
+                                     health_check_interval=health_check_interval)
+            _pool_pid = os.getpid()
+            logger.info('Created pool of %d PDFBox servers: %s', size, command)
+    return _pool
+
+
+def close_server_pool():
+    """
+    Stops the resident extractors of the current process (if any)
+    :return: no return
+    """
+    global _pool
+    if _pool is not None and _pool_pid == os.getpid():
+        _pool.close()
+    _pool = None
+
+atexit.register(close_server_pool)
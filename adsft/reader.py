@@ -5,9 +5,16 @@ The function class for the ReadMetaFile workers. The aim of the worker is to
 read previously extracted content.
 """
 import os
+import copy
 import json
 import gzip
+import mmap
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
 from adsft.rules import META_CONTENT
+from adsft import compression
 
 # ============================= INITIALIZATION ==================================== #
 # - Use app logger:
@@ -22,29 +29,213 @@ logger = setup_logging(__name__, proj_home=proj_home,
                         attach_stdout=config.get('LOG_STDOUT', False))
 
 
+# ================================ CLASSES ======================================== #
+
+class ExtractionCache(object):
+    """
+    Bounded cache of the content of the extraction files read recently, so
+    that an extraction read again (e.g. for FORCE_TO_SEND and then by the
+    NER) is not decompressed again. The entries are keyed by path, last
+    modified time and size, so that a file written again is never served from
+    the cache, and the least recently used ones are evicted first.
+
+    The content is kept in memory and, if a directory is given (e.g. in
+    /dev/shm or on a local disk), the decompressed text files are also kept
+    there, shared by the worker processes, and read with mmap.
+    """
+
+    def __init__(self, max_size, directory=None, max_directory_size=0):
+        """
+        :param max_size: maximum number of characters (text) or bytes (json)
+        kept in memory
+        :param directory: directory of the decompressed text files (None to
+        only keep them in memory)
+        :param max_directory_size: maximum number of bytes of the directory
+        """
+        self.max_size = max_size
+        self.directory = directory
+        self.max_directory_size = max_directory_size
+        self.entries = OrderedDict()
+        self.size = 0
+        self.directory_written = 0
+        self.lock = threading.Lock()
+        self.statistics = {'hits': 0, 'directory_hits': 0, 'misses': 0, 'evictions': 0}
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def read(self, file_name, json_format, read):
+        """
+        :param file_name: path to the file
+        :param json_format: whether the content is in json format
+        :param read: function reading the file, called on a miss
+        :return: the content of the file (a copy for json)
+        """
+        file_stat = os.stat(file_name)
+        key = (file_name, json_format)
+        version = (file_stat.st_mtime_ns, file_stat.st_size)
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == version:
+                self.entries.move_to_end(key)
+                self.statistics['hits'] += 1
+                return copy.deepcopy(entry[1]) if json_format else entry[1]
+
+        content = None
+        if self.directory and not json_format:
+            content = self._read_directory(file_name, version)
+        if content is None:
+            content = read(file_name, json_format)
+            with self.lock:
+                self.statistics['misses'] += 1
+            if self.directory and not json_format:
+                self._write_directory(file_name, version, content)
+        else:
+            with self.lock:
+                self.statistics['directory_hits'] += 1
+
+        cost = file_stat.st_size if json_format else len(content)
+        if cost <= self.max_size:
+            with self.lock:
+                previous = self.entries.pop(key, None)
+                if previous is not None:
+                    self.size -= previous[2]
+                self.entries[key] = (version, content, cost)
+                self.size += cost
+                while self.size > self.max_size:
+                    evicted_key, (evicted_version, evicted_content, evicted_cost) = self.entries.popitem(last=False)
+                    self.size -= evicted_cost
+                    self.statistics['evictions'] += 1
+        return copy.deepcopy(content) if json_format else content
+
+    def _directory_path(self, file_name, version):
+        key = '{0}\0{1}\0{2}'.format(file_name, version[0], version[1]).encode('utf-8')
+        return os.path.join(self.directory, hashlib.blake2b(key, digest_size=16).hexdigest() + '.txt')
+
+    def _read_directory(self, file_name, version):
+        path = self._directory_path(file_name, version)
+        try:
+            with open(path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    content = u''
+                else:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                        content = mapped[:].decode('utf-8')
+            # the last modified time orders the files to evict
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return content
+
+    def _write_directory(self, file_name, version, content):
+        payload = content.encode('utf-8')
+        if len(payload) > self.max_directory_size:
+            return
+        try:
+            with tempfile.NamedTemporaryFile(mode='wb', dir=self.directory, suffix='.tmp',
+                                             delete=False) as temp_file:
+                temp_file.write(payload)
+            os.replace(temp_file.name, self._directory_path(file_name, version))
+        except (IOError, OSError) as err:
+            logger.warning('Could not write %s to the read cache directory: %s', file_name, err)
+            return
+        with self.lock:
+            self.directory_written += len(payload)
+            trim = self.directory_written > self.max_directory_size // 10
+            if trim:
+                self.directory_written = 0
+        if trim:
+            self._trim_directory()
+
+    def _trim_directory(self):
+        """
+        Removes the least recently used files of the directory, written by
+        any process, until it is under 90% of its maximum size
+        """
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.txt'):
+                try:
+                    entry_stat = entry.stat()
+                except OSError:
+                    continue
+                files.append((entry_stat.st_mtime, entry_stat.st_size, entry.path))
+        total = sum(size for mtime, size, path in files)
+        if total <= self.max_directory_size:
+            return
+        for mtime, size, path in sorted(files):
+            if total <= self.max_directory_size * 0.9:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            with self.lock:
+                self.statistics['evictions'] += 1
+
+    def get_statistics(self):
+        """
+        :return: number of hits (in memory and in the directory), misses and
+        evictions, and the hit ratio
+        """
+        with self.lock:
+            statistics = dict(self.statistics)
+        reads = statistics['hits'] + statistics['directory_hits'] + statistics['misses']
+        statistics['hit_ratio'] = float(reads - statistics['misses']) / reads if reads else 0.
+        return statistics
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
 # =============================== FUNCTIONS ======================================= #
 
+def get_cache():
+    """
+    Returns the read cache of the current process, created on first use from
+    READ_CACHE_SIZE, READ_CACHE_DIR and READ_CACHE_DIR_SIZE
+
+    :return: the ExtractionCache, None if disabled
+    """
+    global _cache
+
+    max_size = config.get('READ_CACHE_SIZE', 0)
+    if not max_size or max_size <= 0:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = ExtractionCache(max_size, directory=config.get('READ_CACHE_DIR', None),
+                                     max_directory_size=config.get('READ_CACHE_DIR_SIZE', 0))
+    return _cache
+
+
 def read_file(input_filename, json_format=True):
     """
-    Read file
+    Read file (through the read cache if enabled)
 
     :param input_filename: File name to be read
     :param json_format: whether the given content is in json format
     :return: File content
     """
 
-    if input_filename.endswith('gz'):
+    cache = get_cache()
+    if cache is not None:
+        return cache.read(input_filename, json_format, _read_file)
+    return _read_file(input_filename, json_format)
+
+
+def _read_file(input_filename, json_format=True):
+
+    if not json_format:
+        # the codec is detected from the magic bytes or the suffix
+        content = compression.read_text_file(input_filename)
+    elif input_filename.endswith('gz'):
         with gzip.open(input_filename, 'rb') as input_file:
-            if json_format:
-                content = json.load(input_file)
-            else:
-                content = input_file.read().decode('utf-8')
+            content = json.load(input_file)
     else:
         with open(input_filename, 'r') as input_file:
-            if json_format:
-                content = json.load(input_file)
-            else:
-                content = input_file.read().decode('utf-8')
+            content = json.load(input_file)
 
     logger.debug('Read file name: {0}'.format(input_filename))
 
@@ -66,7 +257,7 @@ def read_content(payload_dictionary):
     if payload_dictionary['file_format'] == "pdf-grobid":
         full_text_output_file_path = os.path.join(bibcode_pair_tree_path, 'grobid_fulltext.xml')
     else:
-        full_text_output_file_path = os.path.join(bibcode_pair_tree_path, 'fulltext.txt.gz')
+        full_text_output_file_path = compression.find_text_file(bibcode_pair_tree_path, 'fulltext')
 
     content = {}
     if os.path.exists(meta_output_file_path):
@@ -74,7 +265,7 @@ def read_content(payload_dictionary):
         for key, value in meta_dict.items():
             content[key] = value
 
-        if os.path.exists(full_text_output_file_path):
+        if full_text_output_file_path and os.path.exists(full_text_output_file_path):
             fulltext = read_file(full_text_output_file_path, json_format=False)
             content['fulltext'] = fulltext
         else:
@@ -88,9 +279,9 @@ def read_content(payload_dictionary):
                 continue
 
             logger.debug(meta_key_word)
-            meta_constant_file_path = os.path.join(bibcode_pair_tree_path, meta_key_word) + '.txt.gz'
+            meta_constant_file_path = compression.find_text_file(bibcode_pair_tree_path, meta_key_word)
             logger.debug('Reading {0} from file at: {1}'.format(meta_key_word, meta_constant_file_path))
-            if os.path.exists(meta_constant_file_path):
+            if meta_constant_file_path:
                 try:
                     content[meta_key_word] = read_file(meta_constant_file_path, json_format=False)
                 except IOError:
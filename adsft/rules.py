@@ -1,3 +1,6 @@
+import re
+import lxml.etree
+
 '''The xpath order is very important here because we are appending all of the results
 for each xpath, rather than taking the first one that returns something other than null.
 If the order is changed specifically for app-group we will have to modify our unique test.'''
@@ -99,3 +102,91 @@ META_CONTENT = {
     'pdf': {'fulltext': ['']},
     'pdf-grobid': {'grobid_fulltext': ['']},
 }
+
+# Elements removed from the XML documents before extracting the content:
+# tables, formulas, figures and bibliography
+PRUNE_TAGS = ('table', 'graphic', 'disp-formula', 'inline-formula', 'formula', 'tex-math', 'bibliography')
+PRUNE_XPATH = " | ".join(["//" + tag for tag in PRUNE_TAGS] + ["//processing-instruction('CDATA')"])
+
+# Acknowledgments that are moved after their parent (body) element
+ACKNOWLEDGEMENTS_XPATH = " | ".join(META_CONTENT['xml']['acknowledgements']['xpath'])
+
+
+def compile_rules(meta_content):
+    """
+    Compiles every xpath of the rules once, lxml would otherwise parse the
+    expression again for every document and parser. A rule that does not
+    compile raises a ValueError, which stops the workers when they start.
+    Templates (e.g., TABLE_NAME) are left to be compiled at run time.
+
+    :param meta_content: rules with the same structure as META_CONTENT
+    :return: dictionary of format -> xpath string -> lxml.etree.XPath
+    """
+    compiled = {}
+    for format_name, contents in meta_content.items():
+        compiled[format_name] = {}
+        for content_name, rule in contents.items():
+            xpaths = rule['xpath'] if isinstance(rule, dict) else rule
+            for xpath in xpaths:
+                if not xpath or 'TABLE_NAME' in xpath:
+                    continue
+                try:
+                    compiled[format_name][xpath] = lxml.etree.XPath(xpath)
+                except lxml.etree.XPathSyntaxError as err:
+                    raise ValueError("Invalid xpath for '{0}' in '{1}' rules: {2} ({3})".format(content_name, format_name, xpath, err))
+    return compiled
+
+
+def streaming_xpath(xpath):
+    """
+    Rewrites a rule that selects elements by name and attributes (e.g.,
+    '//section[@type="body"]') into an xpath that tests a single element
+    (e.g., 'self::*[local-name()="section"][@type="body"]'), which can be
+    evaluated while the document is being parsed. The local name is used since
+    namespaces are not removed when streaming.
+
+    :param xpath: xpath string, as in META_CONTENT
+    :return: the rewritten xpath or None if the rule depends on other elements
+    """
+    match = re.match(r'^//([\w\-]+|\*)((?:\[[^/]*\])*)$', xpath)
+    if match is None:
+        return None
+    name, predicates = match.groups()
+    if name == '*':
+        return 'self::*' + predicates
+    return 'self::*[local-name()="{0}"]{1}'.format(name, predicates)
+
+
+def compile_streaming_rules(meta_content):
+    """
+    Compiles the rules of the XML formats for the streaming extraction (see
+    streaming_xpath). Rules that cannot be evaluated on a single element are
+    left out.
+
+    :param meta_content: rules with the same structure as META_CONTENT
+    :return: dictionary of format -> content name -> list of (xpath string,
+    lxml.etree.XPath)
+    """
+    compiled = {}
+    for format_name, contents in meta_content.items():
+        if not all(isinstance(rule, dict) for rule in contents.values()):
+            continue
+        compiled[format_name] = {}
+        for content_name, rule in contents.items():
+            compiled[format_name][content_name] = []
+            for xpath in rule['xpath']:
+                element_xpath = streaming_xpath(xpath)
+                if element_xpath is None:
+                    continue
+                try:
+                    compiled[format_name][content_name].append((xpath, lxml.etree.XPath(element_xpath)))
+                except lxml.etree.XPathSyntaxError as err:
+                    raise ValueError("Invalid xpath for '{0}' in '{1}' rules: {2} ({3})".format(content_name, format_name, xpath, err))
+    return compiled
+
+
+COMPILED_META_CONTENT = compile_rules(META_CONTENT)
+STREAMING_META_CONTENT = compile_streaming_rules(META_CONTENT)
+PRUNE = lxml.etree.XPath(PRUNE_XPATH)
+ACKNOWLEDGEMENTS = lxml.etree.XPath(ACKNOWLEDGEMENTS_XPATH)
+STREAMING_ACKNOWLEDGEMENTS = lxml.etree.XPath(" | ".join(streaming_xpath(xpath) for xpath in META_CONTENT['xml']['acknowledgements']['xpath']))
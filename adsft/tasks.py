@@ -6,9 +6,11 @@ if sys.version_info > (3,):
 from adsputils import get_date, exceptions
 import adsft.app as app_module
 from kombu import Queue
-from adsft import extraction, checker, writer, reader, ner
+from celery.signals import worker_process_init
+from adsft import extraction, checker, writer, reader, ner, pdfserver
 from adsmsg import FulltextUpdate
 import os
+import time
 from adsft.utils import TextCleaner
 
 # ============================= INITIALIZATION ==================================== #
@@ -21,15 +23,32 @@ logger = app.logger
 app.conf.CELERY_QUEUES = (
     Queue('check-if-extract', app.exchange, routing_key='check-if-extract'),
     Queue('extract', app.exchange, routing_key='extract'),
+    Queue('extract-pdf-batch', app.exchange, routing_key='extract-pdf-batch'),
     Queue('extract-grobid', app.exchange, routing_key='extract-grobid'),
     Queue('output-results', app.exchange, routing_key='output-results'),
     Queue('facility-ner', app.exchange, routing_key='facility-ner'),
 )
 
 
-logger.debug("Loading spacy models for facilities...")
-model1 = ner.load_model(app.conf['NER_FACILITY_MODEL_ACK'])
-model2 = ner.load_model(app.conf['NER_FACILITY_MODEL_FT'])
+# the spacy models for facilities are loaded on first use by the processes
+# consuming the facility-ner queue (see _preload_ner_models)
+NER_MODELS = ('NER_FACILITY_MODEL_ACK', 'NER_FACILITY_MODEL_FT')
+
+
+@worker_process_init.connect
+def _preload_ner_models(**kwargs):
+    """
+    Loads the spacy models when a worker process consuming the facility-ner
+    queue starts (if NER_PRELOAD_MODELS is set), instead of on the first task
+    """
+    if not app.conf.get('NER_PRELOAD_MODELS', False):
+        return
+    consume_from = app.amqp.queues.consume_from
+    if consume_from and 'facility-ner' not in consume_from:
+        return
+    logger.debug("Loading spacy models for facilities...")
+    for model in NER_MODELS:
+        ner.get_model(app.conf[model])
 
 
 # ============================= TASKS ============================================= #
@@ -47,21 +66,46 @@ def task_check_if_extract(message):
 
     logger.debug("Calling 'check_if_extract' with message '%s' and path '%s'", message, app.conf['FULLTEXT_EXTRACT_PATH'])
 
+    index = None
+    if app.conf.get('EXTRACTION_INDEX', False):
+        try:
+            index = app.get_extraction_states([m['bibcode'] for m in message])
+        except Exception:
+            logger.exception('Failed to read the extraction index, reading the meta files instead')
+
+    refreshed = []
     try:
-        results = checker.check_if_extract(message, app.conf['FULLTEXT_EXTRACT_PATH'])
+        results = checker.check_if_extract(message, app.conf['FULLTEXT_EXTRACT_PATH'], index=index,
+                                           refreshed=refreshed)
     except OSError as err:
         logger.error('Task failed at check_if_extract because of missing file. Error: %s', err)
         return
+    if refreshed:
+        logger.info('Extractions avoided because the full text files did not change: %s',
+                    checker.SOURCE_FINGERPRINTER.get_statistics())
+        if index is not None:
+            try:
+                app.save_extraction_states(refreshed)
+            except Exception:
+                logger.exception('Failed to update the extraction index')
     logger.debug('Results: %s', results)
     if results:
+        pdf_batch_size = app.conf.get('PDF_EXTRACT_BATCH_SIZE', 0)
         for key in results:
             if key == 'PDF' or key == 'Standard':
                 for msg in results[key]:
-                    logger.debug("Calling 'task_extract' with message '%s'", msg)
-                    task_extract.delay(msg)
+                    if key == 'Standard' or pdf_batch_size <= 0:
+                        # PDFs are otherwise extracted in batches below
+                        logger.debug("Calling 'task_extract' with message '%s'", msg)
+                        task_extract.delay(msg)
                     if app.conf['GROBID_SERVICE'] is not None and key == 'PDF':
                         logger.debug("Calling 'task_extract_grobid' with message '%s'", msg)
                         task_extract_grobid.delay(msg)
+                if key == 'PDF' and pdf_batch_size > 0:
+                    for i in range(0, len(results[key]), pdf_batch_size):
+                        batch = results[key][i:i+pdf_batch_size]
+                        logger.debug("Calling 'task_extract_pdf_batch' with %d messages", len(batch))
+                        task_extract_pdf_batch.delay(batch)
             else:
                 logger.error('Unknown type: %s and message: %s', key, results[key])
 
@@ -76,31 +120,152 @@ def task_extract(message):
     if not isinstance(message, list):
         message = [message]
 
-    results = extraction.extract_content(message, extract_pdf_script=app.conf['EXTRACT_PDF_SCRIPT'])
+    pdf_server = _get_pdf_server()
+    _sync_xml_parser_choices()
+    results = extraction.extract_content(message, extract_pdf_script=app.conf['EXTRACT_PDF_SCRIPT'],
+                                         pdf_server=pdf_server)
+    _sync_xml_parser_choices()
+    _log_xml_parser_statistics()
+    _log_content_decoder_statistics()
     logger.debug('Results: %s', results)
     for r in results:
+        _write_and_output_results(r)
+    _log_read_cache_statistics()
+
+    if app.conf['RUN_NER_FACILITIES_AFTER_EXTRACTION']:
+        # perform named-entity recognition
+        task_identify_facilities.delay(message)
 
-        logger.debug("Calling 'write_content' with '%s'", str(r))
-        # Write locally to filesystem
-        writer.write_content(r)
 
-        # Send results to master
-        msg = {
-                'bibcode': r['bibcode'],
-                'body': r['fulltext'],
-                }
-        for x in ('acknowledgements', 'dataset', 'facility'):
-            if x in r and r[x]:
-                msg[x] = r[x]
+@app.task(queue='extract-pdf-batch')
+def task_extract_pdf_batch(message):
+    """
+    Extracts the full text of a batch of PDF articles with a single call to
+    the PDF extractor, then writes and pushes each of them to the output
+    queue as task_extract does. Articles that fail are logged and do not
+    affect the rest of the batch.
+    """
+    logger.debug('Extract PDF batch of %d articles', len(message) if isinstance(message, list) else 1)
+    if not isinstance(message, list):
+        message = [message]
 
-        # Call task without checking if fulltext is empty
-        # to ensure other components (acks, etc) are output/sent to master
-        logger.debug("Calling 'task_output_results' with '%s'", msg)
-        task_output_results.delay(msg)
+    pdf_server = _get_pdf_server()
+    results, failures = extraction.extract_pdf_batch(message,
+                                                     extract_pdf_batch_script=app.conf.get('EXTRACT_PDF_BATCH_SCRIPT', '/scripts/extract_pdf_batch_with_pdfbox.sh'),
+                                                     pdf_server=pdf_server,
+                                                     timeout=app.conf.get('PDF_EXTRACT_BATCH_TIMEOUT', None),
+                                                     extract_pdf_script=app.conf['EXTRACT_PDF_SCRIPT'])
+    logger.debug('Results: %s', results)
+    for r in failures:
+        logger.error("PDF batch extraction failed for bibcode '%s': '%s'", r['bibcode'], r['ft_source'])
 
-    if app.conf['RUN_NER_FACILITIES_AFTER_EXTRACTION']:
+    written = []
+    for r in results:
+        try:
+            _write_and_output_results(r)
+            written.append(r)
+        except Exception:
+            logger.exception("Writing extraction failed for bibcode '%s'", r['bibcode'])
+
+    if app.conf['RUN_NER_FACILITIES_AFTER_EXTRACTION'] and written:
         # perform named-entity recognition
-        task_identify_facilities.delay(message)
+        task_identify_facilities.delay(written)
+
+
+def _get_pdf_server():
+    return pdfserver.get_server_pool(app.conf.get('PDFBOX_SERVER_POOL_SIZE', 0),
+                                     proj_home + app.conf.get('PDFBOX_SERVER_JAR', ''),
+                                     java=app.conf.get('PDFBOX_SERVER_JAVA', 'java'),
+                                     timeout=app.conf.get('PDFBOX_SERVER_TIMEOUT', 120),
+                                     health_check_interval=app.conf.get('PDFBOX_SERVER_HEALTH_CHECK_INTERVAL', 60))
+
+
+def _log_read_cache_statistics():
+    cache = reader.get_cache()
+    if cache is not None:
+        logger.info('Read cache statistics: %s', cache.get_statistics())
+
+
+def _log_content_decoder_statistics():
+    """
+    Logs how many XML and HTML files were decoded by each route since the
+    worker process started, and their share (the detector being the slow one)
+    """
+    statistics = extraction.CONTENT_DECODER.get_statistics()
+    decoded = sum(statistics.values())
+    if decoded:
+        logger.info('Content decoder routes: %s',
+                    ', '.join('{0}: {1} ({2:.1%})'.format(route, count, float(count) / decoded)
+                              for route, count in sorted(statistics.items())))
+
+
+def _log_xml_parser_statistics():
+    """
+    Logs per provider how many XML documents were parsed since the worker
+    process started, how many parser attempts failed before one succeeded
+    (fallbacks), how many no parser could handle and the parsers that succeeded
+    """
+    for provider, statistics in sorted(extraction.XML_PARSER_SELECTOR.get_statistics().items()):
+        logger.info("XML parsers for provider '%s': %i documents, %i fallbacks, %i failures, successes %s",
+                    provider, statistics['documents'], statistics['fallbacks'], statistics['failures'],
+                    statistics['parsers'])
+
+
+def _sync_xml_parser_choices():
+    """
+    Saves the XML parsers learned by this worker for each provider and journal
+    in the database (if SQLALCHEMY_URL is set) and periodically loads the ones
+    learned by the other workers
+    """
+    if not app.conf.get('SQLALCHEMY_URL'):
+        return
+    selector = extraction.XML_PARSER_SELECTOR
+    try:
+        changed = selector.pop_changed_journal_choices()
+        if changed:
+            try:
+                app.save_xml_parser_choices(changed)
+            except Exception:
+                # saved with the next ones
+                selector.restore_changed_journal_choices(changed)
+                raise
+        if selector.loaded_at is None or \
+                time.time() - selector.loaded_at > app.conf.get('XML_PARSER_CHOICES_RELOAD_INTERVAL', 600):
+            selector.load_journal_choices([(c['provider'], c['bibstem'], c['parser_name'])
+                                           for c in app.get_xml_parser_choices()])
+    except Exception:
+        logger.exception('Failed to synchronise the learned XML parser choices')
+
+
+def _write_and_output_results(r):
+    """
+    Writes one extracted article locally and pushes it to the output queue
+    """
+    logger.debug("Calling 'write_content' with '%s'", str(r))
+    # Write locally to filesystem
+    state = writer.write_content(r)
+    if state and app.conf.get('EXTRACTION_INDEX', False):
+        try:
+            app.save_extraction_states([state])
+        except Exception:
+            logger.exception("Failed to update the extraction index for bibcode '%s'", r['bibcode'])
+
+    # Send results to master
+    msg = {
+            'bibcode': r['bibcode'],
+            'body': r['fulltext'],
+            }
+    for x in ('acknowledgements', 'dataset', 'facility'):
+        if x in r and r[x]:
+            msg[x] = r[x]
+    if 'cleaner_version' in r:
+        # the body does not need to be cleaned again
+        msg['cleaner_version'] = r['cleaner_version']
+
+    # Call task without checking if fulltext is empty
+    # to ensure other components (acks, etc) are output/sent to master
+    logger.debug("Calling 'task_output_results' with '%s'", msg)
+    task_output_results.delay(msg)
 
 if app.conf['GROBID_SERVICE'] is not None:
     @app.task(queue='extract-grobid')
@@ -146,9 +311,12 @@ def task_output_results(msg):
     :return: no return
     """
 
-    # Ensure we send unicode normalized trimmed text. Extractors already do this,
-    # but we still have some file saved extraction that weren't cleaned.
-    msg['body'] = TextCleaner(text=msg['body']).run(translate=False, decode=True, normalise=True, trim=True)
+    # Ensure we send unicode normalized trimmed text. Extractors already do this
+    # and stamp the version of the cleaner, but we still have some file saved
+    # extraction that weren't cleaned (or were cleaned by a previous version).
+    cleaner_version = msg.pop('cleaner_version', None)
+    if cleaner_version != TextCleaner.version:
+        msg['body'] = TextCleaner(text=msg['body']).run(translate=False, decode=True, normalise=True, trim=True)
 
     logger.debug('Will forward this record: %s', msg)
     rec = FulltextUpdate(**msg)
@@ -172,6 +340,17 @@ def task_identify_facilities(message):
 
     keys = ['acknowledgements', 'fulltext']
 
+    # the texts of all the records are streamed through each model in batches,
+    # skipping the ones without any known facility if there is a gazetteer
+    gazetteer = ner.get_gazetteer(app.conf.get('NER_FACILITY_GAZETTEER'))
+    facilities = {}
+    for key, model in zip(keys, NER_MODELS):
+        texts = [r[key] for r in content if key in r]
+        facilities[key] = iter(ner.get_facilities_batch(ner.get_model(app.conf[model]), texts,
+                                                        gazetteer=gazetteer) if texts else [])
+    if gazetteer is not None:
+        logger.info('Facility gazetteer prefilter statistics: %s', gazetteer.get_statistics())
+
     for r in content:
 
         bibcode_pair_tree_path = os.path.dirname(r['meta_path'])
@@ -179,10 +358,10 @@ def task_identify_facilities(message):
 
         out = {}
 
-        for key, elem_str, model in zip(keys, ['facility-ack', 'facility-ft'], [model1, model2]):
+        for key, elem_str in zip(keys, ['facility-ack', 'facility-ft']):
 
             if key in r:
-                facs = ner.get_facilities(model, r[key])
+                facs = next(facilities[key])
                 if len(facs) > 0:
                     logger.debug("Adding %s as facilities found in %s using spacy ner model", str(facs), key)
                     out[elem_str] = list(set(facs)) # remove duplicates
@@ -195,6 +374,8 @@ def task_identify_facilities(message):
 
         writer.write_file(output_file_path, out)
 
+    _log_read_cache_statistics()
+
 
 if __name__ == '__main__':
     app.start()
@@ -4,8 +4,12 @@ if sys.version_info > (3,):
 import unittest
 import os
 import re
+import time
+import shutil
+import tempfile
+from mock import patch
 
-from adsft import utils, checker
+from adsft import utils, checker, writer
 from adsft.tests import test_base
 
 class TestCheckIfExtracted(test_base.TestUnit):
@@ -350,6 +354,179 @@ class TestCheckIfExtracted(test_base.TestUnit):
         self.assertTrue(len(payload_false['PDF']) != 0)
 
 
+    def test_check_if_extract_stats_each_path_once(self):
+        """
+        Tests that check_if_extract gives the same result whether the files
+        are stat'ed on a pool of threads or sequentially, and that a path is
+        never stat'ed twice.
+
+        :return: no return
+        """
+
+        test_file = os.path.join(self.app.conf['PROJ_HOME'], 'tests/test_integration/stub_data/fulltext_range_of_formats.links')
+        FileInputStream = utils.FileInputStream(test_file)
+        FileInputStream.extract()
+
+        stat = os.stat
+        stated = []
+        def counting_stat(path, *args, **kwargs):
+            stated.append(path)
+            return stat(path, *args, **kwargs)
+
+        with patch('os.stat', side_effect=counting_stat):
+            payload = checker.check_if_extract(
+                [dict(m) for m in FileInputStream.payload],
+                self.app.conf['FULLTEXT_EXTRACT_PATH'], max_workers=1
+            )
+        self.assertEqual(len(stated), len(set(stated)))
+
+        threaded_payload = checker.check_if_extract(
+            [dict(m) for m in FileInputStream.payload],
+            self.app.conf['FULLTEXT_EXTRACT_PATH'], max_workers=4
+        )
+        for key in ('PDF', 'Standard'):
+            self.assertEqual([(m['bibcode'], m['UPDATE']) for m in payload[key]],
+                             [(m['bibcode'], m['UPDATE']) for m in threaded_payload[key]])
+
+    def test_index_gives_the_same_decisions_as_the_meta_files(self):
+        """
+        Tests that check_if_extract decides the same with and without the
+        extraction index, also when the files written or the source changed
+        in ways the index alone does not see.
+
+        :return: no return
+        """
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            ft_source = os.path.join(tmp_dir, 'source', 'test.txt')
+            extract_path = os.path.join(tmp_dir, 'live')
+            os.makedirs(os.path.dirname(ft_source))
+            with open(ft_source, 'w') as f:
+                f.write('Full text')
+            past = time.time() - 3600
+            os.utime(ft_source, (past, past))
+            message = {'bibcode': 'test1', 'ft_source': ft_source, 'provider': 'MNRAS'}
+
+            def extract():
+                payload = checker.check_if_extract([dict(message, UPDATE='FORCE_TO_EXTRACT')], extract_path)
+                state = writer.write_content(dict(payload['Standard'][0], fulltext='Full text'))
+                return {'test1': state}, payload['Standard'][0]['meta_path']
+
+            def decisions(index):
+                results = []
+                for i in (index, None):
+                    payload = checker.check_if_extract([dict(message)], extract_path, index=i)
+                    results.append([m['UPDATE'] for m in payload['Standard']])
+                return results
+
+            index, meta_path = extract()
+            self.assertEqual(decisions(index), [[], []])
+
+            # the source is changed keeping its last modified time
+            with open(ft_source, 'w') as f:
+                f.write('Full text changed')
+            os.utime(ft_source, (past, past))
+            self.assertEqual(decisions(index), [[], []])
+
+            # the meta.json is written again after the fulltext file
+            later = time.time() + 60
+            os.utime(meta_path, (later, later))
+            self.assertEqual(decisions(index), [['STALE_CONTENT'], ['STALE_CONTENT']])
+
+            # the fulltext file was deleted, the record is skipped
+            index, meta_path = extract()
+            os.remove(meta_path.replace('meta.json', 'fulltext.txt.gz'))
+            self.assertEqual(decisions(index), [[], []])
+
+            # the meta.json was deleted
+            index, meta_path = extract()
+            os.remove(meta_path)
+            self.assertEqual(decisions(index), [['NOT_EXTRACTED_BEFORE'], ['NOT_EXTRACTED_BEFORE']])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_record_that_cannot_be_checked_is_skipped(self):
+        """
+        Tests that a record whose extraction cannot be checked (e.g., its
+        fulltext file was deleted) is skipped and the others of the same list
+        are still checked.
+
+        :return: no return
+        """
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            extract_path = os.path.join(tmp_dir, 'live')
+            messages = []
+            for bibcode in ('test1', 'test2', 'test3'):
+                ft_source = os.path.join(tmp_dir, 'source', bibcode + '.txt')
+                if not os.path.exists(os.path.dirname(ft_source)):
+                    os.makedirs(os.path.dirname(ft_source))
+                with open(ft_source, 'w') as f:
+                    f.write('Full text')
+                messages.append({'bibcode': bibcode, 'ft_source': ft_source, 'provider': 'MNRAS'})
+
+            payload = checker.check_if_extract([dict(m) for m in messages], extract_path)
+            for result in payload['Standard']:
+                writer.write_content(dict(result, fulltext='Full text'))
+            os.remove(payload['Standard'][1]['meta_path'].replace('meta.json', 'fulltext.txt.gz'))
+            os.utime(messages[2]['ft_source'], (time.time() + 60, time.time() + 60))
+
+            payload = checker.check_if_extract([dict(m) for m in messages], extract_path)
+            self.assertEqual([(m['bibcode'], m['UPDATE']) for m in payload['Standard']],
+                             [('test3', 'STALE_CONTENT')])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_touched_source_with_same_content_is_not_extracted_again(self):
+        """
+        Tests that with fingerprints, a full text file that was modified after
+        the extraction without changing its content is not extracted again,
+        while one whose content changed is.
+
+        :return: no return
+        """
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            ft_source = os.path.join(tmp_dir, 'source', 'test.txt')
+            extract_path = os.path.join(tmp_dir, 'live')
+            os.makedirs(os.path.dirname(ft_source))
+            with open(ft_source, 'w') as f:
+                f.write('Full text')
+            message = {'bibcode': 'test1', 'ft_source': ft_source, 'provider': 'MNRAS'}
+
+            with patch.object(checker.SOURCE_FINGERPRINTER, 'fingerprint') as fingerprint:
+                payload = checker.check_if_extract([dict(message)], extract_path, fingerprint=True)
+            # the source is only hashed when it is written
+            self.assertFalse(fingerprint.called)
+            result = dict(payload['Standard'][0], fulltext='Full text')
+            state = writer.write_content(result, fingerprint=True)
+            self.assertTrue(state['ft_source_hash'])
+
+            past = time.time() - 3600
+            for path in (result['meta_path'], result['meta_path'].replace('meta.json', 'fulltext.txt.gz')):
+                os.utime(path, (past, past))
+            os.utime(ft_source, (past + 60, past + 60))
+            statistics = dict(checker.SOURCE_FINGERPRINTER.get_statistics())
+
+            refreshed = []
+            payload = checker.check_if_extract([dict(message)], extract_path, fingerprint=True, refreshed=refreshed)
+            self.assertEqual(payload['Standard'], [])
+            self.assertEqual(refreshed[0]['ft_source_hash'], state['ft_source_hash'])
+            self.assertEqual(checker.SOURCE_FINGERPRINTER.get_statistics()['unchanged'], statistics['unchanged'] + 1)
+            self.assertGreater(os.stat(result['meta_path']).st_mtime, past + 60)
+
+            with open(ft_source, 'w') as f:
+                f.write('New full text')
+            os.utime(ft_source, (time.time() + 60, time.time() + 60))
+            payload = checker.check_if_extract([dict(message)], extract_path, fingerprint=True)
+            self.assertEqual(payload['Standard'][0]['UPDATE'], 'STALE_CONTENT')
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
 
 if __name__ == '__main__':
     unittest.main()
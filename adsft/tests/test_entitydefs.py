@@ -0,0 +1,61 @@
+import glob
+import os
+import re
+import unittest
+
+from adsft import entitydefs
+
+
+def previous_convertentities(input_string):
+    """
+    Implementation of convertentities before it was optimised, used as
+    reference
+    """
+    if input_string is None:
+        return input_string
+    return re.sub(r'&(#\d+|#x[0-9a-fA-F]+|\w+);', entitydefs.entitymap, input_string)
+
+
+class TestConvertEntities(unittest.TestCase):
+    """
+    Checks that the entity conversion gives the same output as the previous
+    implementation
+    """
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.proj_home = os.path.realpath(os.path.join(os.path.dirname(__file__), '../..'))
+
+    def test_same_output_for_the_test_corpus(self):
+        """
+        Every XML and HTML file of the stub data is converted as before
+
+        :return: no return
+        """
+        file_names = []
+        for pattern in ('tests/test_unit/stub_data/*.xml', 'tests/test_unit/stub_data/*.html',
+                        'tests/test_integration/stub_data/*.xml', 'tests/test_integration/stub_data/*.html'):
+            file_names.extend(glob.glob(os.path.join(self.proj_home, pattern)))
+        self.assertTrue(len(file_names) > 0)
+
+        for file_name in file_names:
+            with open(file_name, 'rb') as f:
+                content = f.read().decode('utf-8', 'ignore')
+            self.assertEqual(entitydefs.convertentities(content), previous_convertentities(content), file_name)
+
+    def test_same_output_for_edge_cases(self):
+        """
+        Known, unknown (removed), numeric and unterminated entities
+
+        :return: no return
+        """
+        for content in (None, u'', u'no entities', u'& alone', u'&alpha;', u'&alpha;&beta;',
+                        u'&unknown; &#x03B2; &#946; &amp; &gt;', u'&alpha', u'&&alpha;;', u'&#x;',
+                        u'<mml:mo>&PlusMinus;</mml:mo> tail &', u'&été; &nbsp;end'):
+            self.assertEqual(entitydefs.convertentities(content), previous_convertentities(content), content)
+
+        self.assertEqual(entitydefs.convertentities(u'&alpha; &unknown; &#946;'), u'α  ')
+
+
+if __name__ == '__main__':
+    unittest.main()
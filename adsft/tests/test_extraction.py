@@ -4,12 +4,16 @@ if sys.version_info > (3,):
 import unittest
 import os
 import re
+import shutil
+import tempfile
 
 from adsft import extraction, rules, utils
 from adsft.tests import test_base
 from adsputils import load_config
 import unittest
 import httpretty
+import lxml.etree
+from mock import patch
 from requests.exceptions import HTTPError
 
 class TestXMLExtractorBase(test_base.TestUnit):
@@ -122,6 +126,31 @@ class TestXMLExtractor(TestXMLExtractorBase):
         content = extraction.extract_content([self.dict_item])
         # does the fulltext contain two copies of the file's contents
         self.assertEqual(2, content[0]['fulltext'].count('Entry 1'))
+        # the texts of the xpaths are joined with new lines, the body is not
+        # stamped as clean so that it is cleaned again before being sent
+        self.assertNotIn('cleaner_version', content[0])
+
+    def test_body_sent_is_unchanged_by_the_cleaner_version(self):
+        """
+        Tests that the body sent to master (the text stamped as clean, or
+        cleaned again by task_output_results) is the text cleaned again after
+        the extraction, for documents whose texts are found by several xpaths
+        and joined with new lines, and for single texts.
+
+        :return: no return
+        """
+        for ft_source, file_format in ((self.test_stub_xml, 'xml'), (self.test_multi_file, 'xml'),
+                                       (self.test_stub_text, 'txt')):
+            content = extraction.extract_content([{'ft_source': ft_source, 'file_format': file_format,
+                                                   'provider': 'MNRAS', 'bibcode': 'test'}])[0]
+            cleaned = utils.TextCleaner(text=content['fulltext']).run(translate=False, decode=True,
+                                                                      normalise=True, trim=True)
+            if content.get('cleaner_version') == utils.TextCleaner.version:
+                body = content['fulltext']
+            else:
+                body = cleaned
+            self.assertEqual(body, cleaned)
+            self.assertEqual(file_format == 'txt', 'cleaner_version' in content)
 
 
     def test_that_we_can_extract_using_settings_template(self):
@@ -397,6 +426,207 @@ class TestXMLExtractor(TestXMLExtractorBase):
             self.assertEqual(self.extractor._remove_special_elements(raw_xml, parser_name), "<body><p>body content</p></body> ")
 
 
+    def test_preprocessing_is_shared_between_parsers(self):
+        """
+        The cached preprocessing gives the same result as running all the
+        regex passes for each parser, the common steps are run only once
+        """
+
+        self.extractor.open_xml()
+        for parser_name in self.preferred_parser_names:
+            self.assertEqual(self.extractor._preprocess(parser_name),
+                             self.extractor._remove_special_elements(self.extractor.raw_xml, parser_name))
+        steps = [self.extractor._preprocessing_steps(parser_name) for parser_name in self.preferred_parser_names]
+        self.assertEqual(len(self.extractor._preprocessed), len(set(s[:i] for s in steps for i in range(len(s)+1))))
+
+    def test_parser_selector_tries_the_last_successful_parser_first(self):
+        """
+        Documents of the same provider and journal, or of the same provider and
+        signals, start with the parser that succeeded last, and fallbacks are
+        counted per provider
+        """
+
+        selector = extraction.XMLParserSelector()
+        self.extractor.open_xml()
+        keys = selector.keys('MNRAS', '2015MNRAS.446.4239E', self.extractor.raw_xml)
+        # JATS declaration and xlink namespace
+        self.assertEqual(keys, [('journal', 'MNRAS', 'MNRAS'), ('signals', 'MNRAS', True, True)])
+        self.assertEqual(selector.order(keys, self.preferred_parser_names), list(self.preferred_parser_names))
+
+        selector.record(keys, 'direct-lxml-xml', len(self.preferred_parser_names))
+        order = selector.order(keys, self.preferred_parser_names)
+        self.assertEqual(order[0], 'direct-lxml-xml')
+        self.assertEqual(sorted(order), sorted(self.preferred_parser_names))
+        # another journal of the provider with the same signals
+        other_journal = selector.keys('MNRAS', '2015MNRAS.446.4239E'.replace('MNRAS', 'PASP.'), self.extractor.raw_xml)
+        self.assertEqual(selector.order(other_journal, self.preferred_parser_names)[0], 'direct-lxml-xml')
+        # other providers or documents with different signals are not affected
+        self.assertEqual(selector.order([('signals', 'Wiley', True, True)], self.preferred_parser_names)[0], self.preferred_parser_names[0])
+        self.assertEqual(selector.order([('signals', 'MNRAS', False, True)], self.preferred_parser_names)[0], self.preferred_parser_names[0])
+
+        selector.record(keys, None, 2)
+        self.assertEqual(selector.get_statistics()['MNRAS'],
+                         {'documents': 2, 'fallbacks': len(self.preferred_parser_names), 'failures': 1,
+                          'parsers': {'direct-lxml-xml': 1}})
+
+    def test_parser_selector_journal_choices_can_be_shared(self):
+        """
+        Choices per provider and journal are handed out once to be saved, and
+        loading choices replaces the previous ones
+        """
+
+        selector = extraction.XMLParserSelector()
+        keys = [('journal', 'MNRAS', 'MNRAS'), ('signals', 'MNRAS', True, True)]
+        selector.record(keys, 'lxml-html', 3)
+        selector.record(keys, 'lxml-html', 1)
+        self.assertEqual(selector.pop_changed_journal_choices(), [('MNRAS', 'MNRAS', 'lxml-html', 2)])
+        self.assertEqual(selector.pop_changed_journal_choices(), [])
+
+        selector.load_journal_choices([('MNRAS', 'ApJ', 'html.parser')])
+        self.assertEqual(selector.order([('journal', 'MNRAS', 'ApJ')], self.preferred_parser_names)[0], 'html.parser')
+        # a reset choice is forgotten, the signals are kept
+        self.assertEqual(selector.order(keys[:1], self.preferred_parser_names)[0], self.preferred_parser_names[0])
+        self.assertEqual(selector.order(keys, self.preferred_parser_names)[0], 'lxml-html')
+
+
+    def test_rules_are_compiled_once(self):
+        """
+        Every xpath of the rules is precompiled, the results of the success
+        check of the parser are reused when extracting the fields
+        """
+
+        for content in rules.META_CONTENT['xml'].values():
+            for xpath in content['xpath']:
+                self.assertIn(xpath, rules.COMPILED_META_CONTENT['xml'])
+
+        self.assertRaises(ValueError, rules.compile_rules, {'xml': {'fulltext': {'xpath': ['//body[']}}})
+
+        self.extractor.open_xml()
+        parsed_xml = self.extractor.parse_xml()
+        self.assertIs(self.extractor._xpath_results_tree, parsed_xml)
+        self.assertIn('//body', self.extractor._xpath_results)
+
+    def test_streaming_extraction_of_large_files(self):
+        """
+        Files larger than the threshold are extracted while they are parsed,
+        with the same result as the direct lxml XML parser, also when the
+        chunks read are small
+        """
+
+        content = self.extractor.extract_multi_content(preferred_parser_names=('direct-lxml-xml',))
+        self.extractor.streaming_threshold = 1
+        self.assertEqual(self.extractor.extract_multi_content(), content)
+
+        self.extractor = extraction.EXTRACTOR_FACTORY['xml'](self.dict_item)
+        stream_xml = self.extractor._stream_xml
+        self.extractor._stream_xml = lambda: stream_xml(chunk_size=7)
+        self.assertEqual(self.extractor.extract_multi_content_streaming(), content)
+        self.assertNotIn('ACK INSIDE BODY TAG', content['fulltext'])
+
+        self.assertEqual(rules.streaming_xpath('//section[@type="body"]'), 'self::*[local-name()="section"][@type="body"]')
+        self.assertIsNone(rules.streaming_xpath('//body//p'))
+
+    def test_streaming_extraction_removes_the_acknowledgements(self):
+        """
+        The acknowledgements are removed from the element that contains them
+        when streaming, while the DOM parsers move them after it: the
+        differences are deliberate
+        """
+
+        documents = {
+            # nested in a paragraph of the body
+            '<article><body><p>Text <ack>Thanks</ack> more.</p><p>End.</p></body></article>':
+                ({'fulltext': 'Text more. End.', 'acknowledgements': 'Thanks'},
+                 {'fulltext': 'Text Thanks more. End.', 'acknowledgements': 'Thanks'}),
+            # several acknowledgements
+            '<article><body><p>Text.</p><ack>First thanks</ack><ack>Second thanks</ack></body></article>':
+                ({'fulltext': 'Text.', 'acknowledgements': 'First thanks'},
+                 {'fulltext': 'Text.', 'acknowledgements': 'Second thanks'}),
+            # text following the acknowledgements in the body
+            '<article><body><p>Text.</p><ack>Thanks</ack> tail text<p>End.</p></body></article>':
+                ({'fulltext': 'Text. tail text End.', 'acknowledgements': 'Thanks'},
+                 {'fulltext': 'Text. End.', 'acknowledgements': 'Thanks'}),
+        }
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            file_input = os.path.join(tmp_dir, 'ack.xml')
+            for xml, (streamed, parsed) in documents.items():
+                with open(file_input, 'w') as f:
+                    f.write(xml)
+                extractor = extraction.EXTRACTOR_FACTORY['xml']({'ft_source': file_input, 'file_format': 'xml',
+                                                                   'provider': 'MNRAS', 'bibcode': 'test'})
+                self.assertEqual(extractor.extract_multi_content_streaming(), streamed)
+                extractor = extraction.EXTRACTOR_FACTORY['xml']({'ft_source': file_input, 'file_format': 'xml',
+                                                                   'provider': 'MNRAS', 'bibcode': 'test'})
+                content = extractor.extract_multi_content(preferred_parser_names=('direct-lxml-xml',))
+                self.assertEqual(dict((key, content[key]) for key in parsed), parsed)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_streaming_extraction_keeps_only_the_open_elements(self):
+        """
+        While a large body is streamed, the paragraphs already read are
+        collected and deleted, thus the tree does not grow with the body
+        """
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            file_input = os.path.join(tmp_dir, 'large.xml')
+            paragraph = '<p>Paragraph {0} with <italic>italic</italic> text<inline-formula>x</inline-formula>.</p>'
+            with open(file_input, 'w') as f:
+                f.write('<article><body><sec>')
+                for i in range(5000):
+                    f.write(paragraph.format(i))
+                f.write('</sec><ack>Thanks</ack></body></article>')
+
+            sizes = []
+            class CountingParser(lxml.etree.XMLPullParser):
+                def read_events(self):
+                    for event, element in super(CountingParser, self).read_events():
+                        yield event, element
+                        if event == 'end' and element.tag == 'p':
+                            sizes.append(sum(1 for e in element.getroottree().iter()))
+
+            extractor = extraction.EXTRACTOR_FACTORY['xml']({'ft_source': file_input, 'file_format': 'xml',
+                                                               'provider': 'MNRAS', 'bibcode': 'test'})
+            stream_xml = extractor._stream_xml
+            extractor._stream_xml = lambda: stream_xml(chunk_size=4096)
+            with patch('lxml.etree.XMLPullParser', CountingParser):
+                content = extractor.extract_multi_content_streaming()
+
+            self.assertEqual(len(sizes), 5000)
+            # besides the open elements, the tree only holds the elements
+            # parsed ahead in the chunk being read (15000 elements in total)
+            self.assertLess(max(sizes), 500)
+            self.assertTrue(content['fulltext'].startswith('Paragraph 0 with italic text.'))
+            self.assertTrue(content['fulltext'].endswith('Paragraph 4999 with italic text.'))
+            self.assertNotIn('Thanks', content['fulltext'])
+            self.assertEqual(content['acknowledgements'], 'Thanks')
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+    def test_content_decoder_takes_the_cheapest_route(self):
+        """
+        The encoding is given by the byte order mark, the XML declaration or
+        a strict UTF-8 decode, the heuristic detector is only used when they
+        fail and the result is the same as decoding with its encoding
+        """
+
+        decoder = extraction.ContentDecoder()
+        self.assertEqual(decoder.decode(u'\ufeff<a>\u00e9</a>'.encode('utf-16-le')), (u'\ufeff<a>\u00e9</a>', 'utf-16le', 'bom'))
+        latin = u'<?xml version="1.0" encoding="ISO-8859-1"?><a>\u00e9</a>'
+        self.assertEqual(decoder.decode(latin.encode('latin-1')), (latin, 'iso-8859-1', 'declared'))
+        self.assertEqual(decoder.decode(u'<a>\u00e9</a>'.encode('utf-8')), (u'<a>\u00e9</a>', 'utf-8', 'utf-8'))
+        # a character cut at the end of a partial content
+        self.assertEqual(decoder.decode(u'<a>\u00e9</a>\u00e9'.encode('utf-8')[:-1], partial=True)[2], 'utf-8')
+        raw = u'<a>\u00e9\u00e0 \u201cquoted\u201d</a>'.encode('windows-1252')
+        content, encoding, route = decoder.decode(raw)
+        self.assertEqual(route, 'detector')
+        self.assertEqual(content, raw.decode(encoding, 'ignore'))
+        self.assertEqual(decoder.get_statistics(), {'bom': 1, 'declared': 1, 'utf-8': 2, 'detector': 1})
+
+
 class TestNonStandardXMLExtractor(TestXMLExtractorBase):
 
         """
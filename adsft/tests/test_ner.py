@@ -0,0 +1,141 @@
+import unittest
+from mock import patch
+
+import spacy
+from spacy.pipeline import EntityRuler
+
+from adsft import ner
+
+
+class TestNER(unittest.TestCase):
+    """
+    Tests the identification of facilities with the spacy models
+    """
+
+    def setUp(self):
+        """
+        Makes a blank model that tags a few facilities, with a component not
+        needed to identify them.
+
+        :return: no return
+        """
+        self.model = spacy.blank('en')
+        self.model.add_pipe(self.model.create_pipe('sentencizer'))
+        ruler = EntityRuler(self.model)
+        ruler.add_patterns([{'label': 'FAC', 'pattern': 'ALMA'},
+                            {'label': 'FAC', 'pattern': [{'LOWER': 'hubble'}, {'LOWER': 'space'}, {'LOWER': 'telescope'}]}])
+        self.model.add_pipe(ruler)
+        self.texts = [u'We thank the ALMA team.',
+                      u'',
+                      u'No facility here.',
+                      u'Observations with the Hubble Space Telescope and ALMA. ' * 50]
+
+    def test_batch_gives_the_same_facilities_as_one_text_at_a_time(self):
+        """
+        Tests that streaming the texts through the model in batches gives the
+        facilities of each text, in the same order.
+
+        :return: no return
+        """
+        expected = [[ent.text for ent in self.model(text).ents] for text in self.texts]
+        self.assertEqual(expected[0], [u'ALMA'])
+        self.assertEqual(expected[1:3], [[], []])
+
+        for batch_size in (1, 2, 100):
+            self.assertEqual(ner.get_facilities_batch(self.model, self.texts, batch_size=batch_size, n_process=1),
+                             expected)
+        self.assertEqual([ner.get_facilities(self.model, text) for text in self.texts], expected)
+        self.assertEqual(ner.get_facilities_batch(self.model, []), [])
+
+    def test_only_the_components_not_setting_entities_are_disabled(self):
+        """
+        Tests that a component that sets entities is kept whatever its name,
+        while the ones of NER_DISABLE_COMPONENTS are disabled.
+
+        :return: no return
+        """
+        ruler = EntityRuler(self.model)
+        ruler.add_patterns([{'label': 'FAC', 'pattern': 'JWST'}])
+        self.model.add_pipe(ruler, name='custom_facilities')
+        texts = [u'We thank the ALMA and JWST teams.']
+
+        pipe = self.model.pipe
+        with patch.object(self.model, 'pipe', wraps=pipe) as wrapped_pipe:
+            self.assertEqual(ner.get_facilities_batch(self.model, texts, n_process=1), [[u'ALMA', u'JWST']])
+        self.assertEqual(wrapped_pipe.call_args_list[0][1]['disable'], ['sentencizer'])
+
+    def test_long_texts_are_split_in_chunks(self):
+        """
+        Tests that the long texts are split in bounded chunks on paragraph or
+        sentence boundaries, and that the facilities found in the chunks are the ones
+        found in the whole text, once.
+
+        :return: no return
+        """
+        text = u'\n\n'.join(self.texts) * 20
+        chunks = list(ner.split_text(text, max_length=1000, overlap=100))
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(chunks[0][2], 0)
+        self.assertEqual(chunks[-1][3], len(text))
+        for (start, end, own_start, own_end), next_chunk in zip(chunks, chunks[1:]):
+            self.assertLessEqual(end - start, 1000)
+            self.assertTrue(text[:end].endswith((u'\n\n', u'. ')))
+            self.assertLess(next_chunk[0], end)
+            self.assertEqual(own_end, next_chunk[2])
+
+        expected = [ent.text for ent in self.model(text).ents]
+        with patch.dict(ner.config, {'NER_CHUNK_SIZE': 1000, 'NER_CHUNK_OVERLAP': 100}):
+            self.assertEqual(ner.get_facilities_batch(self.model, [text, self.texts[0]], n_process=1),
+                             [expected, [u'ALMA']])
+        self.assertEqual(list(ner.split_text(self.texts[0], max_length=1000)), [(0, 23, 0, 23)])
+
+    def test_gazetteer_skips_texts_without_facilities(self):
+        """
+        Tests that the texts that do not mention any known facility are not
+        sent to the model, that the others give the same facilities, and that
+        the texts skipped are counted.
+
+        :return: no return
+        """
+        gazetteer = ner.FacilityGazetteer([u'ALMA', u'Hubble Space Telescope', u'HST', u''])
+        self.assertTrue(gazetteer.mentions_facility(u'Data from the hubble space telescope.'))
+        self.assertTrue(gazetteer.mentions_facility(u'HST'))
+        # only whole words
+        self.assertFalse(gazetteer.mentions_facility(u'The HSTs of almanacs.'))
+
+        expected = ner.get_facilities_batch(self.model, self.texts, n_process=1)
+        sent = []
+        worth_ner = gazetteer.worth_ner
+
+        def record(text):
+            if worth_ner(text):
+                sent.append(text)
+                return True
+            return False
+
+        with patch.object(gazetteer, 'worth_ner', side_effect=record):
+            self.assertEqual(ner.get_facilities_batch(self.model, self.texts, n_process=1, gazetteer=gazetteer),
+                             expected)
+        self.assertEqual(sent, [self.texts[0], self.texts[3]])
+        self.assertEqual(gazetteer.get_statistics(), {'checked': 4, 'skipped': 2, 'skip_rate': 0.5})
+
+    def test_models_are_loaded_once_on_first_use(self):
+        """
+        Tests that the models are only loaded when they are first needed, and
+        then reused.
+
+        :return: no return
+        """
+        with patch('adsft.ner.load_model', return_value=self.model) as load_model:
+            self.assertFalse(load_model.called)
+            for i in range(2):
+                self.assertIs(ner.get_model('/models/test_ack'), self.model)
+            self.assertEqual(load_model.call_count, 1)
+            ner.get_model('/models/test_ft')
+            self.assertEqual(load_model.call_count, 2)
+        ner._models.pop('/models/test_ack')
+        ner._models.pop('/models/test_ft')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+import sys
+import os
+import stat
+import shutil
+import tempfile
+import unittest
+
+from adsft import pdfserver, extraction
+from adsft.tests import test_base
+
+# Minimal stand-in for App.java --server: it echoes the PDF path as extracted
+# text, prints log-like noise and exits when asked to extract 'crash'
+FAKE_SERVER = '''
+import sys
+for line in iter(sys.stdin.readline, ''):
+    line = line.strip()
+    if line == 'PING':
+        print('ADSFT-PONG')
+    elif line.startswith('crash|'):
+        sys.exit(1)
+    elif line.startswith('/a/b/missing.pdf|'):
+        print('2020-01-01 00:00:00 ERROR App:1 - Failed extracting')
+        print('ADSFT-ERROR File not found: missing')
+    else:
+        pdf, output = line.split('|')
+        with open(output, 'w') as f:
+            f.write('text of ' + pdf)
+        print('INFO log line')
+        print('ADSFT-OK ' + output)
+    sys.stdout.flush()
+'''
+
+
+class TestPDFBoxServer(test_base.TestUnit):
+    """
+    Tests the resident PDF extractor pool against a fake extractor process
+    """
+
+    def setUp(self):
+        super(TestPDFBoxServer, self).setUp()
+        self.command = [sys.executable, '-c', FAKE_SERVER]
+        self.pool = pdfserver.PDFBoxServerPool(2, self.command, timeout=10)
+
+    def tearDown(self):
+        self.pool.close()
+        super(TestPDFBoxServer, self).tearDown()
+
+    def test_extract_reuses_the_resident_process(self):
+        self.assertEqual(self.pool.extract('/a.pdf'), b'text of /a.pdf')
+        server = self.pool.servers[0]
+        pid = server.process.pid
+        self.assertEqual(self.pool.extract('/b.pdf'), b'text of /b.pdf')
+        self.assertEqual(server.process.pid, pid)
+        self.assertTrue(server.ping())
+        self.assertEqual(self.pool.restarts(), 0)
+
+    def test_extraction_error_keeps_the_process(self):
+        server = pdfserver.PDFBoxServer(self.command, timeout=10)
+        self.assertRaises(pdfserver.PDFExtractionError, server.extract, '/a/b/missing.pdf')
+        self.assertTrue(server.is_alive())
+        self.assertEqual(server.restarts, 0)
+        server.stop()
+
+    def test_restart_on_crash(self):
+        server = pdfserver.PDFBoxServer(self.command, timeout=10)
+        self.assertRaises(pdfserver.PDFServerError, server.extract, 'crash')
+        # restarted once to retry the file, which crashes it again
+        self.assertEqual(server.restarts, 1)
+        self.assertFalse(server.is_alive())
+        # the next request starts a healthy process
+        self.assertEqual(server.extract('/c.pdf'), b'text of /c.pdf')
+        self.assertEqual(server.restarts, 2)
+        server.stop()
+
+    def test_pdf_extractor_uses_the_pool(self):
+        extractor = extraction.PDFExtractor({'ft_source': '/d.pdf', 'bibcode': 'test',
+                                             'pdf_server': self.pool})
+        self.assertEqual(extractor.extract_multi_content()['fulltext'], 'text of /d.pdf')
+
+    def test_pool_is_disabled_by_default(self):
+        self.assertIsNone(pdfserver.get_server_pool(0, 'ADSfulltext.jar'))
+
+
+# Stand-in for scripts/extract_pdf_batch_with_pdfbox.sh (App.java multi-file
+# mode): writes an output file for every argument but the missing PDFs
+FAKE_BATCH_SCRIPT = '''#!{0}
+import sys
+for argument in sys.argv[1:]:
+    pdf, output = argument.split('|')
+    if not pdf.endswith('missing.pdf'):
+        with open(output, 'w') as f:
+            f.write('text of ' + pdf)
+'''
+
+# Stand-in for scripts/extract_pdf_with_pdftotext.sh: prints the text of a PDF
+FAKE_SCRIPT = '''#!{0}
+import sys
+sys.stdout.write('text extracted again from ' + sys.argv[1])
+'''
+
+
+class TestPDFBatchExtraction(test_base.TestUnit):
+    """
+    Tests the extraction of many PDFs with a single extractor call
+    """
+
+    def setUp(self):
+        super(TestPDFBatchExtraction, self).setUp()
+        self.temp_dir = tempfile.mkdtemp()
+        script = os.path.join(self.temp_dir, 'extract_pdf_batch.sh')
+        with open(script, 'w') as f:
+            f.write(FAKE_BATCH_SCRIPT.format(sys.executable))
+        os.chmod(script, stat.S_IRWXU)
+        # the script path is relative to the project home
+        self.script = '/' + os.path.relpath(script, extraction.proj_home)
+        single_script = os.path.join(self.temp_dir, 'extract_pdf.sh')
+        with open(single_script, 'w') as f:
+            f.write(FAKE_SCRIPT.format(sys.executable))
+        os.chmod(single_script, stat.S_IRWXU)
+        self.single_script = '/' + os.path.relpath(single_script, extraction.proj_home)
+        self.messages = [
+            {'bibcode': 'test1', 'ft_source': '/a/b/1.pdf', 'file_format': 'pdf'},
+            {'bibcode': 'test2', 'ft_source': '/a/b/missing.pdf', 'file_format': 'pdf'},
+            {'bibcode': 'test3', 'ft_source': '/a/b/3.pdf,/a/b/4.pdf', 'file_format': 'pdf'},
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+        super(TestPDFBatchExtraction, self).tearDown()
+
+    def check_results(self, results, failures):
+        self.assertEqual([r['bibcode'] for r in results], ['test1', 'test3'])
+        self.assertEqual(results[0]['fulltext'], 'text of /a/b/1.pdf')
+        self.assertEqual(results[1]['fulltext'], 'text of /a/b/3.pdf text of /a/b/4.pdf')
+        self.assertEqual([r['bibcode'] for r in failures], ['test2'])
+
+    def test_one_call_for_the_batch(self):
+        results, failures = extraction.extract_pdf_batch(self.messages, extract_pdf_batch_script=self.script)
+        self.check_results(results, failures)
+
+    def test_batch_with_resident_extractors(self):
+        pool = pdfserver.PDFBoxServerPool(1, [sys.executable, '-c', FAKE_SERVER], timeout=10)
+        try:
+            results, failures = extraction.extract_pdf_batch(self.messages, pdf_server=pool)
+        finally:
+            pool.close()
+        self.check_results(results, failures)
+
+    def test_forced_send_without_previous_extraction_is_extracted_again(self):
+        message = {'bibcode': 'test4', 'ft_source': '/a/b/5.pdf', 'file_format': 'pdf', 'provider': 'MNRAS',
+                   'UPDATE': 'FORCE_TO_SEND', 'meta_path': os.path.join(self.temp_dir, 'te/st/4/meta.json')}
+        results, failures = extraction.extract_pdf_batch(self.messages + [message],
+                                                         extract_pdf_batch_script=self.script,
+                                                         extract_pdf_script=self.single_script)
+        self.assertEqual([r['bibcode'] for r in results], ['test4', 'test1', 'test3'])
+        self.assertEqual(results[0]['fulltext'], 'text extracted again from /a/b/5.pdf')
+        self.assertEqual([r['bibcode'] for r in failures], ['test2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
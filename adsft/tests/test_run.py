@@ -0,0 +1,103 @@
+import sys
+import unittest
+import os
+import shutil
+import tempfile
+
+from mock import patch, MagicMock, call
+from adsft import tasks
+from adsft.tests import test_base
+
+class TestPublishInBulk(test_base.TestUnit):
+    """
+    Class that tests the publishing of the records in packets by run.py
+    """
+
+    def setUp(self):
+        super(TestPublishInBulk, self).setUp()
+        sys.path.append(self.app.conf['PROJ_HOME'])
+        self.records = [{'bibcode': 'test{}'.format(i), 'ft_source': '', 'provider': 'TEST'} for i in range(5)]
+
+    def test_packets_are_published_through_one_producer(self):
+        """
+        Tests that the records are sent to the task in packets of packet_size
+        records through a single producer, whose connection uses publisher
+        confirms on top of the configured transport options and is released.
+
+        :return: no return
+        """
+        from run import publish_in_bulk
+
+        task = MagicMock()
+        with patch.object(tasks, 'app') as app:
+            app.conf = {'broker_transport_options': {'max_retries': 3}}
+            connection = app.connection_for_write.return_value
+            producer = app.amqp.Producer.return_value
+            packets = publish_in_bulk(task, iter(self.records), packet_size=2)
+
+        self.assertEqual(packets, 3)
+        app.connection_for_write.assert_called_once_with(
+            transport_options={'max_retries': 3, 'confirm_publish': True})
+        app.amqp.Producer.assert_called_once_with(connection)
+        self.assertEqual(task.apply_async.call_args_list,
+                         [call(args=(self.records[0:2],), producer=producer),
+                          call(args=(self.records[2:4],), producer=producer),
+                          call(args=(self.records[4:],), producer=producer)])
+        self.assertTrue(connection.release.called)
+
+    def test_packets_are_applied_when_eager(self):
+        """
+        Tests that with CELERY_ALWAYS_EAGER the packets are applied without
+        opening a connection to the broker.
+
+        :return: no return
+        """
+        from run import publish_in_bulk
+
+        task = MagicMock()
+        with patch.object(tasks, 'app') as app:
+            app.conf = {'CELERY_ALWAYS_EAGER': True}
+            packets = publish_in_bulk(task, self.records, packet_size=10)
+
+        self.assertEqual(packets, 1)
+        self.assertFalse(app.connection_for_write.called)
+        task.apply_async.assert_called_once_with(args=(self.records,))
+
+
+class TestRun(test_base.TestUnit):
+    """
+    Class that tests the options of run.py
+    """
+
+    def test_snapshot_is_only_used_to_check_for_extraction(self):
+        """
+        Tests that the snapshot, which only records the rows checked for
+        extraction, cannot be used with forced updates or to identify the
+        facilities, and that nothing is published or saved then.
+
+        :return: no return
+        """
+        sys.path.append(self.app.conf['PROJ_HOME'])
+        from run import run
+
+        test_file = os.path.join(self.app.conf['PROJ_HOME'], 'tests/test_integration/stub_data/fulltext_range_of_formats.links')
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            snapshot_file = os.path.join(tmp_dir, 'links.snapshot')
+            with patch.object(tasks.task_check_if_extract, 'delay') as check_if_extract, \
+                    patch.object(tasks.task_identify_facilities, 'delay') as identify_facilities:
+                for kwargs in ({'force_extract': True}, {'force_send': True}, {'facility_ner': True}):
+                    self.assertRaises(ValueError, run, test_file, snapshot=snapshot_file, **kwargs)
+                self.assertFalse(check_if_extract.called)
+                self.assertFalse(identify_facilities.called)
+                self.assertFalse(os.path.exists(snapshot_file))
+
+                run(test_file, snapshot=snapshot_file)
+                self.assertTrue(check_if_extract.called)
+                self.assertTrue(os.path.exists(snapshot_file))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,7 +5,8 @@ import json
 
 import unittest
 from mock import patch
-from adsft import app, tasks, checker
+from sqlalchemy.orm import Query
+from adsft import app, tasks, checker, extraction
 from adsmsg import FulltextUpdate
 import httpretty
 
@@ -70,6 +71,107 @@ class TestWorkers(unittest.TestCase):
 
 
 
+    def test_task_check_if_extract_pdf_batch(self):
+        self.app.conf['PDF_EXTRACT_BATCH_SIZE'] = 2
+        with patch.object(tasks.task_extract, 'delay', return_value=None) as task_extract, \
+                patch.object(tasks.task_extract_pdf_batch, 'delay', return_value=None) as task_extract_pdf_batch:
+
+            message = [{'bibcode': 'fta{}'.format(i), 'provider': 'MNRAS',
+                        'ft_source': '{}/tests/test_integration/stub_data/full_test.pdf'.format(self.proj_home)}
+                       for i in range(3)]
+            tasks.task_check_if_extract(message)
+            self.assertFalse(task_extract.called)
+            self.assertEqual(task_extract_pdf_batch.call_count, 2)
+            batches = [call[0][0] for call in task_extract_pdf_batch.call_args_list]
+            self.assertEqual([[m['bibcode'] for m in batch] for batch in batches], [['fta0', 'fta1'], ['fta2']])
+            self.assertEqual(batches[0][0]['file_format'], 'pdf')
+
+    def test_task_extract_pdf_batch(self):
+        extracted = {'bibcode': 'fta', 'file_format': 'pdf', 'fulltext': 'Introduction',
+                     'meta_path': u'{}/ft/a/meta.json'.format(self.app.conf['FULLTEXT_EXTRACT_PATH'])}
+        failed = {'bibcode': 'ftb', 'file_format': 'pdf', 'ft_source': '/a/b/missing.pdf'}
+        with patch('adsft.extraction.extract_pdf_batch', return_value=([extracted], [failed])) as extract_pdf_batch, \
+                patch('adsft.writer.write_content', return_value=None) as write_content, \
+                patch.object(tasks.task_output_results, 'delay', return_value=None) as task_output_results, \
+                patch.object(tasks.task_identify_facilities, 'delay', return_value=None) as identify_facilities:
+            tasks.task_extract_pdf_batch([{'bibcode': 'fta'}, {'bibcode': 'ftb'}])
+            self.assertEqual(extract_pdf_batch.call_count, 1)
+            write_content.assert_called_once_with(extracted)
+            self.assertEqual(task_output_results.call_args[0][0], {'bibcode': 'fta', 'body': 'Introduction'})
+            self.assertEqual(identify_facilities.call_args[0][0], [extracted])
+
+    def test_xml_parser_choices_are_shared_through_the_database(self):
+        db_app = app.ADSFulltextCelery('test', proj_home=self.proj_home, local_config={'SQLALCHEMY_URL': 'sqlite:///'})
+        tasks.app = db_app
+        selector = extraction.XMLParserSelector()
+        try:
+            with patch.object(extraction, 'XML_PARSER_SELECTOR', selector):
+                selector.record([('journal', 'MNRAS', 'MNRAS')], 'lxml-html', 2)
+                tasks._sync_xml_parser_choices()
+                choices = db_app.get_xml_parser_choices()
+                self.assertEqual([(c['provider'], c['bibstem'], c['parser_name'], c['documents']) for c in choices],
+                                 [('MNRAS', 'MNRAS', 'lxml-html', 1)])
+
+                db_app.save_xml_parser_choices([('Wiley', 'JGRA', 'html5lib', 3)])
+                self.assertEqual(db_app.reset_xml_parser_choices(provider='MNRAS'), 1)
+                selector.loaded_at = 0
+                tasks._sync_xml_parser_choices()
+                self.assertEqual(selector.order([('journal', 'Wiley', 'JGRA')], ['lxml-xml', 'html5lib'])[0], 'html5lib')
+                self.assertEqual(selector.order([('journal', 'MNRAS', 'MNRAS')], ['html5lib', 'lxml-html'])[0], 'html5lib')
+        finally:
+            db_app.close_app()
+            tasks.app = self.app
+
+    def test_content_decoder_statistics_are_logged(self):
+        decoder = extraction.ContentDecoder()
+        with patch.object(extraction, 'CONTENT_DECODER', decoder), \
+                patch.object(tasks.logger, 'info') as info:
+            tasks._log_content_decoder_statistics()
+            self.assertFalse(info.called)
+            decoder.statistics = {'utf-8': 3, 'detector': 1}
+            tasks._log_content_decoder_statistics()
+            info.assert_called_once_with('Content decoder routes: %s', 'detector: 1 (25.0%), utf-8: 3 (75.0%)')
+
+    def test_xml_parser_statistics_are_logged(self):
+        selector = extraction.XMLParserSelector()
+        selector.record([('journal', 'MNRAS', 'MNRAS')], 'lxml-html', 3)
+        selector.record([('journal', 'MNRAS', 'MNRAS')], None, 2)
+        with patch.object(extraction, 'XML_PARSER_SELECTOR', selector), \
+                patch.object(tasks.logger, 'info') as info:
+            tasks._log_xml_parser_statistics()
+        info.assert_called_once_with("XML parsers for provider '%s': %i documents, %i fallbacks, %i failures, successes %s",
+                                     'MNRAS', 2, 3, 1, {'lxml-html': 1})
+
+    def test_xml_parser_choices_are_not_lost_when_saving_fails(self):
+        db_app = app.ADSFulltextCelery('test', proj_home=self.proj_home, local_config={'SQLALCHEMY_URL': 'sqlite:///'})
+        tasks.app = db_app
+        selector = extraction.XMLParserSelector()
+        try:
+            with patch.object(extraction, 'XML_PARSER_SELECTOR', selector):
+                # another worker inserts the same choice after it was looked up
+                db_app.save_xml_parser_choices([('MNRAS', 'MNRAS', 'lxml-html', 2)])
+                get = Query.get
+                lookups = []
+                def get_before_insert(query, ident):
+                    lookups.append(ident)
+                    return None if len(lookups) == 1 else get(query, ident)
+                with patch.object(Query, 'get', autospec=True, side_effect=get_before_insert):
+                    selector.record([('journal', 'MNRAS', 'MNRAS')], 'html5lib', 1)
+                    tasks._sync_xml_parser_choices()
+                self.assertEqual(len(lookups), 2)
+                self.assertEqual([(c['parser_name'], c['documents']) for c in db_app.get_xml_parser_choices()],
+                                 [('html5lib', 3)])
+
+                # the choices that could not be saved are saved with the next ones
+                selector.record([('journal', 'MNRAS', 'MNRAS')], 'lxml-html', 1)
+                with patch.object(db_app, 'save_xml_parser_choices', side_effect=Exception('database is down')):
+                    tasks._sync_xml_parser_choices()
+                selector.record([('journal', 'MNRAS', 'MNRAS')], 'lxml-xml', 1)
+                self.assertEqual(selector.pop_changed_journal_choices(), [('MNRAS', 'MNRAS', 'lxml-xml', 2)])
+        finally:
+            db_app.close_app()
+            tasks.app = self.app
+
     def test_task_extract_standard(self):
         with patch('adsft.writer.write_content', return_value=None) as task_write_text:
             msg = {'bibcode': 'fta', 'file_format': 'xml',
@@ -132,9 +234,26 @@ class TestWorkers(unittest.TestCase):
             self.assertEqual(actual.bibcode, msg['bibcode'])
             self.assertEqual(actual.body, msg['body'])
 
+    def test_task_output_results_does_not_clean_twice(self):
+        with patch('adsft.app.ADSFulltextCelery.forward_message', return_value=None) as forward_message, \
+                patch.object(tasks.TextCleaner, 'run', return_value='cleaned') as run:
+            # cleaned by the current version
+            msg = {'bibcode': 'fta', 'body': 'Introduction', 'cleaner_version': tasks.TextCleaner.version}
+            tasks.task_output_results(msg)
+            self.assertFalse(run.called)
+            self.assertEqual(forward_message.call_args[0][0].body, 'Introduction')
+
+            # stored before the stamp or cleaned by a previous version
+            for msg in ({'bibcode': 'fta', 'body': 'Introduction\n'},
+                        {'bibcode': 'fta', 'body': 'Introduction\n', 'cleaner_version': tasks.TextCleaner.version - 1}):
+                tasks.task_output_results(msg)
+                self.assertEqual(forward_message.call_args[0][0].body, 'cleaned')
+            self.assertEqual(run.call_count, 2)
+
     def test_task_identify_facilities(self):
 
-        with patch('adsft.writer.write_file', return_value=None) as task_write_text:
+        with patch('adsft.writer.write_file', return_value=None) as task_write_text, \
+                patch('adsft.ner.get_model', return_value=None) as get_model:
             msg = {
                     'bibcode': 'fta',
                     'file_format': 'pdf',
@@ -154,19 +273,21 @@ class TestWorkers(unittest.TestCase):
                 with patch('adsft.reader.read_content', return_value=msg) as read_content:
                     facs = ['facility0', 'facility1', 'facility1']
 
-                    with patch('adsft.ner.get_facilities', return_value=facs) as get_facs:
+                    with patch('adsft.ner.get_facilities_batch', side_effect=lambda model, texts, gazetteer: [facs] * len(texts)) as get_facs:
                         tasks.task_identify_facilities(msg)
                         self.assertTrue(load_meta.called)
                         self.assertTrue(read_content.called)
                         self.assertTrue(get_facs.called)
                         self.assertTrue(task_write_text.called)
+                        get_model.assert_any_call(self.app.conf['NER_FACILITY_MODEL_ACK'])
+                        get_model.assert_any_call(self.app.conf['NER_FACILITY_MODEL_FT'])
 
                         actual = task_write_text.call_args[0][1]
                         self.assertEqual(actual['facility-ack'], list(set(facs)))
                         self.assertEqual(actual['facility-ft'], list(set(facs)))
 
                     # test when facilties are not found, this will test the logic with logs when we move to python3
-                    with patch('adsft.ner.get_facilities', return_value=[]) as get_facs:
+                    with patch('adsft.ner.get_facilities_batch', side_effect=lambda model, texts, gazetteer: [[]] * len(texts)) as get_facs:
                         tasks.task_identify_facilities(msg)
                         # use logging to check logic here when we switch to python3
 
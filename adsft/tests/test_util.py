@@ -3,10 +3,13 @@ from builtins import chr
 import unittest
 import os
 import re
+import shutil
+import tempfile
 
 from adsft import utils
 from adsft.tests import test_base
 import math
+from datetime import datetime
 
 class TestFileStreamInput(test_base.TestUnit):
     """
@@ -52,6 +55,78 @@ class TestFileStreamInput(test_base.TestUnit):
         )
         self.assertIn('MNRAS', FileInputStream.provider)
 
+    def test_file_stream_input_stream(self):
+        """
+        Tests the stream method. It checks that the records are the same as
+        the ones extracted, that the reading can be resumed from the position
+        reached and that lines that cannot be parsed are counted and skipped.
+
+        :return: no return
+        """
+
+        test_file = os.path.join(self.app.conf['PROJ_HOME'], 'tests/test_integration/stub_data/fulltext_range_of_formats.links')
+        FileInputStream = utils.FileInputStream(test_file)
+        FileInputStream.extract(force_extract=True)
+
+        stream = utils.FileInputStream(test_file)
+        records = stream.stream(force_extract=True)
+        first = [next(records), next(records)]
+        self.assertEqual(first, FileInputStream.payload[:2])
+        self.assertEqual(stream.line_number, 2)
+
+        resumed = utils.FileInputStream(test_file)
+        rest = list(resumed.stream(force_extract=True, start_offset=stream.offset))
+        self.assertEqual(first + rest, FileInputStream.payload)
+
+        resumed = utils.FileInputStream(test_file)
+        rest = list(resumed.stream(force_extract=True, start_line=stream.line_number))
+        self.assertEqual(first + rest, FileInputStream.payload)
+        self.assertEqual(resumed.errors, 0)
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            broken_file = os.path.join(tmp_dir, 'broken.links')
+            with open(broken_file, 'w') as f:
+                f.write('2015MNRAS.446.4239E\n\n2015MNRAS.446.4239E\t/test.pdf\tMNRAS\n')
+            broken = utils.FileInputStream(broken_file)
+            self.assertEqual([r['bibcode'] for r in broken.stream()], ['2015MNRAS.446.4239E'])
+            self.assertEqual(broken.errors, 1)
+            self.assertEqual(broken.line_number, 3)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_links_snapshot(self):
+        """
+        Tests that the snapshot only lets through the rows of the links file
+        that are new or changed since the previous one was saved.
+
+        :return: no return
+        """
+
+        test_file = os.path.join(self.app.conf['PROJ_HOME'], 'tests/test_integration/stub_data/fulltext_range_of_formats.links')
+        tmp_dir = tempfile.mkdtemp()
+        snapshot_file = os.path.join(tmp_dir, 'links.snapshot')
+        records = utils.FileInputStream(test_file).stream()
+        records = list(records)
+        try:
+            snapshot = utils.LinksSnapshot(snapshot_file)
+            self.assertEqual(list(snapshot.filter(records)), records)
+            snapshot.save()
+
+            changed = dict(records[2], provider='Elsevier')
+            snapshot = utils.LinksSnapshot(snapshot_file)
+            self.assertEqual(list(snapshot.filter(records[:2] + [changed] + records[3:])), [changed])
+            self.assertEqual((snapshot.added, snapshot.unchanged), (1, len(records) - 1))
+
+            # a partial read only adds its rows to the previous snapshot
+            snapshot = utils.LinksSnapshot(snapshot_file)
+            self.assertEqual(list(snapshot.filter([changed])), [changed])
+            snapshot.save(merge=True)
+            snapshot = utils.LinksSnapshot(snapshot_file)
+            self.assertEqual(list(snapshot.filter(records + [changed])), [])
+        finally:
+            shutil.rmtree(tmp_dir)
+
     
     def test_trim(self):
         """
@@ -72,6 +147,30 @@ class TestFileStreamInput(test_base.TestUnit):
             r = utils.TextCleaner(x).run(translate=False, decode=True, normalise=True, trim=True)
             self.assertEqual(r, u'a b')
 
+    def test_is_clean(self):
+        """
+        A text made of cleaned texts is clean only if run would not change it
+        """
+        for text in (u'', u'a b', u'a\nb', u'a  b', u'a\tb', u' a', u'a ', u'a\u00a0b'):
+            cleaned = utils.TextCleaner(text).run(translate=False, decode=True, normalise=True, trim=True)
+            if utils.TextCleaner.is_clean(text):
+                self.assertEqual(cleaned, text)
+        self.assertTrue(utils.TextCleaner.is_clean(u'a b'))
+        self.assertFalse(utils.TextCleaner.is_clean(u'a\nb'))
+
+    def test_translate_non_ascii_text(self):
+        """
+        The characters of the translation map are found with a regex on text
+        that is not ASCII, the result is the same as str.translate
+        """
+        characters = u''.join(chr(n) for n in sorted(utils.TextCleaner.master_translate_map))
+        for text in (u'caf\u00e9 ' + characters + u' end', u'caf\u00e9\u00a0\u00ad\u2003 end',
+                     u'caf\u00e9 \U0001d465 \U0001fffe end', u'no\u00a0\x01 ascii\r', u'caf\u00e9'):
+            cleaner = utils.TextCleaner(text)
+            cleaner.translate()
+            self.assertEqual(cleaner.text, text.translate(utils.TextCleaner.master_translate_map))
+        self.assertEqual(utils.TextCleaner(u'caf\u00e9\u00a0 \u00ad x' + u'y' * 100).run(translate=True, decode=False), u'caf\u00e9')
+
     def test_get_filenames(self):
         """test code that breaks up file name strings"""
 
@@ -95,6 +194,18 @@ class TestFileStreamInput(test_base.TestUnit):
         files = utils.get_filenames(file_string)
         self.assertEqual(['/proj/ads/foo', '/proj/ads/ba,r', '/proj/ads/baz/,,/qu,ux'], files)
 
+    def test_index_date(self):
+        """
+        Tests that the index dates written are read back, and that the legacy
+        formats are still understood (in UTC).
+        """
+        date = datetime(2019, 1, 2, 3, 4, 5, 678)
+        self.assertEqual(utils.format_index_date(date), '2019-01-02T03:04:05.000678Z')
+        self.assertEqual(utils.parse_index_date(utils.format_index_date(date)), date)
+        self.assertEqual(utils.parse_index_date('2019-01-02T03:04:05Z'), datetime(2019, 1, 2, 3, 4, 5))
+        self.assertEqual(utils.parse_index_date('2019-01-02T05:04:05+02:00'), datetime(2019, 1, 2, 3, 4, 5))
+        self.assertEqual(utils.parse_index_date('Wed Jan  2 03:04:05 2019'), datetime(2019, 1, 2, 3, 4, 5))
+
 
 if __name__ == '__main__':
     unittest.main()
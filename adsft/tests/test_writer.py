@@ -1,7 +1,10 @@
 import unittest
 import os
+import errno
+import gzip
+from mock import patch
 
-from adsft import writer, reader
+from adsft import writer, reader, checker, compression
 from adsft.tests import test_base
 import json
 
@@ -282,6 +285,158 @@ class TestWriteMetaFileWorker(test_base.TestUnit):
         self.assertFalse(os.path.exists(temp_file_name))
         self.assertTrue(os.path.exists(self.meta_file))
 
+    def test_temporary_file_is_renamed(self):
+        """
+        Tests that the temporary file is renamed (not copied) with the right
+        permissions, and copied only when the rename fails across file systems.
+
+        :return: no return
+        """
+
+        writer.extract_content([self.dict_item])
+
+        temp_path = self.meta_file.replace('meta.json', '')
+        temp_file_name = writer.write_to_temp_file(self.dict_item, temp_path)
+        inode = os.stat(temp_file_name).st_ino
+        with patch('shutil.copy') as copy:
+            writer.move_temp_file_to_file(temp_file_name, self.meta_file, fsync=True)
+        self.assertFalse(copy.called)
+        self.assertEqual(os.stat(self.meta_file).st_ino, inode)
+        self.assertEqual(os.stat(self.meta_file).st_mode & 0o777, 0o640)
+
+        temp_file_name = writer.write_to_temp_file(self.dict_item, temp_path)
+        with patch('os.replace', side_effect=OSError(errno.EXDEV, 'Invalid cross-device link')):
+            writer.move_temp_file_to_file(temp_file_name, self.meta_file)
+        self.assertFalse(os.path.exists(temp_file_name))
+        with open(self.meta_file) as f:
+            self.assertEqual(json.load(f), self.dict_item)
+
+    def test_text_is_compressed_in_memory(self):
+        """
+        Tests that the text is written compressed to a single temporary file,
+        with the compression level given.
+
+        :return: no return
+        """
+
+        temp_path = self.meta_file.replace('meta.json', '')
+        os.makedirs(temp_path)
+        text = u'full text with some unicode: \u00e9 ' * 1000
+        sizes = []
+        for level in (1, 9):
+            temp_file_name = writer.write_to_temp_file(text, temp_path, json_format=False, compresslevel=level)
+            self.assertEqual(os.listdir(temp_path), [os.path.basename(temp_file_name)])
+            with gzip.open(temp_file_name, 'rb') as f:
+                self.assertEqual(f.read().decode('utf-8'), text)
+            sizes.append(os.path.getsize(temp_file_name))
+            os.remove(temp_file_name)
+        self.assertGreater(sizes[0], sizes[1])
+
+    def test_forced_send_writes_missing_grobid_full_text(self):
+        """
+        Tests that a FORCE_TO_SEND grobid extraction is written when the
+        grobid_fulltext.xml file is missing, even if a fulltext file of
+        another format exists, and skipped once it exists.
+
+        :return: no return
+        """
+
+        grobid_file = self.bibcode_pair_tree + 'grobid_fulltext.xml'
+        writer.write_content(self.dict_item)
+        self.assertTrue(os.path.exists(self.full_text_file))
+
+        self.dict_item['file_format'] = 'pdf-grobid'
+        self.dict_item['UPDATE'] = 'FORCE_TO_SEND'
+        self.dict_item['fulltext'] = '<TEI>grobid full text</TEI>'
+        try:
+            writer.write_content(self.dict_item)
+            self.assertTrue(os.path.exists(grobid_file))
+            self.assertEqual(reader.read_file(grobid_file, json_format=False), self.dict_item['fulltext'])
+
+            self.dict_item['fulltext'] = '<TEI>changed</TEI>'
+            self.assertIsNone(writer.write_content(self.dict_item))
+            self.assertEqual(reader.read_file(grobid_file, json_format=False), '<TEI>grobid full text</TEI>')
+        finally:
+            if os.path.exists(grobid_file):
+                os.remove(grobid_file)
+
+    def test_text_files_are_read_with_the_codec_they_were_written_with(self):
+        """
+        Tests that the text files are read whatever the codec they were
+        written with, and that writing with another codec removes the file
+        written with the previous one.
+
+        :return: no return
+        """
+
+        os.makedirs(self.bibcode_pair_tree)
+        text = u'full text with some unicode: \u00e9 ' * 100
+        plain_file = self.bibcode_pair_tree + 'fulltext.txt'
+        for name in ('gzip', 'none'):
+            codec = compression.get_codec(name)
+            file_name = compression.text_file_path(self.bibcode_pair_tree, 'fulltext', codec)
+            writer.move_temp_file_to_file(
+                writer.write_to_temp_file(text, self.bibcode_pair_tree, json_format=False, codec=codec),
+                file_name)
+            self.assertEqual(reader.read_file(file_name, json_format=False), text)
+        self.assertEqual(compression.find_text_file(self.bibcode_pair_tree, 'fulltext'), self.full_text_file)
+
+        # the codec is given by the magic bytes, even with a misleading suffix
+        os.rename(self.full_text_file, plain_file + '.bak')
+        self.assertEqual(reader.read_file(plain_file + '.bak', json_format=False), text)
+        os.rename(plain_file + '.bak', self.full_text_file)
+
+        writer.write_content(self.dict_item)
+        self.assertFalse(os.path.exists(plain_file))
+        self.assertEqual(reader.read_file(self.full_text_file, json_format=False), self.dict_item['fulltext'])
+
+    def test_read_cache_serves_files_not_written_again(self):
+        """
+        Tests that the files read again are served from the cache (in memory
+        or from its directory) until they are written again, and that the
+        least recently used entries are evicted.
+
+        :return: no return
+        """
+
+        os.makedirs(self.bibcode_pair_tree)
+        cache_directory = self.bibcode_pair_tree + 'cache/'
+        writer.write_file(self.full_text_file, u'first version', json_format=False)
+        writer.write_file(self.meta_file, {'bibcode': 'MNRAS2014'}, json_format=True)
+
+        with patch('adsft.reader._read_file', side_effect=reader._read_file) as read:
+            cache = reader.ExtractionCache(1000, directory=cache_directory, max_directory_size=1000)
+            for i in range(2):
+                self.assertEqual(cache.read(self.full_text_file, False, reader._read_file), u'first version')
+                meta = cache.read(self.meta_file, True, reader._read_file)
+                self.assertEqual(meta, {'bibcode': 'MNRAS2014'})
+                meta['bibcode'] = 'changed'
+            self.assertEqual(read.call_count, 2)
+
+            writer.write_file(self.full_text_file, u'second version', json_format=False)
+            os.utime(self.full_text_file, (0, 0))
+            self.assertEqual(cache.read(self.full_text_file, False, reader._read_file), u'second version')
+            self.assertEqual(read.call_count, 3)
+
+            # the decompressed text is shared with the caches of other processes
+            other_cache = reader.ExtractionCache(1000, directory=cache_directory, max_directory_size=1000)
+            self.assertEqual(other_cache.read(self.full_text_file, False, reader._read_file), u'second version')
+            self.assertEqual(read.call_count, 3)
+            self.assertEqual(other_cache.get_statistics()['directory_hits'], 1)
+
+        self.assertEqual(cache.get_statistics(),
+                         {'hits': 2, 'directory_hits': 0, 'misses': 3, 'evictions': 0, 'hit_ratio': 0.4})
+
+        small_cache = reader.ExtractionCache(30)
+        small_cache.read(self.full_text_file, False, reader._read_file)
+        small_cache.read(self.meta_file, True, reader._read_file)
+        self.assertEqual(list(small_cache.entries), [(self.meta_file, True)])
+        self.assertEqual(small_cache.get_statistics()['evictions'], 1)
+
+        for file_name in os.listdir(cache_directory):
+            os.remove(os.path.join(cache_directory, file_name))
+        os.rmdir(cache_directory)
+
     def test_write_worker_returns_content(self):
         """
         Tests the extract_content method. Checks that the payload that the
@@ -302,5 +457,33 @@ class TestWriteMetaFileWorker(test_base.TestUnit):
             .format(payload)
         )
 
+    def test_write_content_returns_extraction_state(self):
+        """
+        Tests that write_content returns the entry of the extraction index, and
+        that the index then gives the same decision as the meta.json written.
+
+        :return: no return
+        """
+
+        self.dict_item['ft_source'] = os.path.join(self.app.conf['PROJ_HOME'], 'tests/test_unit/stub_data/test.txt')
+        self.dict_item['index_date'] = '2020-01-01T00:00:00Z'
+        state = writer.write_content(self.dict_item)
+
+        self.assertEqual(state['bibcode'], 'MNRAS2014')
+        self.assertEqual(state['ft_source'], self.dict_item['ft_source'])
+        self.assertEqual(state['source_size'], os.stat(self.dict_item['ft_source']).st_size)
+        self.assertEqual(state['meta_mtime'], os.stat(self.meta_file).st_mtime)
+        self.assertEqual(state['fulltext_mtime'], os.stat(self.full_text_file).st_mtime)
+
+        with open(self.meta_file) as f:
+            meta_content = json.load(f)
+        # the pair tree of test1 is te/st/1/
+        message = {'bibcode': 'test1'}
+        extract_path = os.path.join(self.app.conf['PROJ_HOME'], 'tests/test_unit/stub_data')
+        for ft_source in (self.dict_item['ft_source'], '/vagrant/other.txt'):
+            message['ft_source'] = ft_source
+            self.assertEqual(checker.state_needs_update(message, state),
+                             checker.meta_needs_update(message, meta_content, extract_path))
+
 if __name__ == '__main__':
     unittest.main()
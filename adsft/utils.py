@@ -26,6 +26,12 @@ import string
 import unicodedata
 import re
 import json
+import hashlib
+from array import array
+from bisect import bisect_left
+from datetime import datetime
+from dateutil.parser import parse as dateutil_parse
+from dateutil.tz import tzutc
 
 # ============================= INITIALIZATION ==================================== #
 # - Use app logger:
@@ -40,6 +46,18 @@ logger = setup_logging(__name__, proj_home=proj_home,
                         attach_stdout=config.get('LOG_STDOUT', False))
 
 
+# ================================ FUNCTIONS ====================================== #
+
+def _character_class(ranges):
+    """
+    :param ranges: list of (first, last) code points
+    :return: regular expression character class matching any of them
+    """
+    return '[' + ''.join(re.escape(chr(start)) if start == end else
+                         re.escape(chr(start)) + '-' + re.escape(chr(end))
+                         for start, end in ranges) + ']'
+
+
 # ================================ CLASSES ======================================== #
 
 class FileInputStream(object):
@@ -60,6 +78,9 @@ class FileInputStream(object):
         self.full_text_path = ''
         self.provider = ''
         self.payload = None
+        self.offset = 0
+        self.line_number = 0
+        self.errors = 0
 
     def print_info(self):
         """
@@ -82,47 +103,187 @@ class FileInputStream(object):
         :return: the bibcode, full text path, provider, and payload content
         """
 
-        in_file = self.input_stream
-        try:
-            with open(in_file, 'r') as f:
-
-                    raw = []
-                    bibcode, full_text_path, provider = [], [], []
-                    for line in f:
-                        try:
-                            l = [i for i in line.strip().split('\t') if i != '']
-                            if len(l) == 0:
-                                continue
-                            bibcode.append(l[0])
-                            full_text_path.append(l[1])
-                            provider.append(l[2])
-                            payload_dictionary = {
-                                'bibcode': bibcode[-1],
-                                'ft_source': full_text_path[-1],
-                                'provider': provider[-1]
-                            }
-
-                            if force_extract:
-                                payload_dictionary['UPDATE'] = \
-                                    'FORCE_TO_EXTRACT'
-
-                            if force_send and not force_extract:
-                                payload_dictionary['UPDATE'] = \
-                                    'FORCE_TO_SEND'
-
-                            raw.append(payload_dictionary)
-                        except Exception as err:
-                            logger.warning('Extraction failed for file %s, line: %s. Skipping', in_file, line)
-                            continue
+        raw = []
+        bibcode, full_text_path, provider = [], [], []
+        for payload_dictionary in self.stream(force_extract=force_extract, force_send=force_send):
+            bibcode.append(payload_dictionary['bibcode'])
+            full_text_path.append(payload_dictionary['ft_source'])
+            provider.append(payload_dictionary['provider'])
+            raw.append(payload_dictionary)
+
+        if self.errors != -1:
             self.bibcode = bibcode
             self.full_text_path = full_text_path
             self.provider = provider
             self.payload = raw
 
+        return self.bibcode, self.full_text_path, self.provider, self.payload
+
+    def stream(self, force_extract=False, force_send=False, start_offset=0, start_line=0):
+        """
+        Generator that parses the file line by line and yields the payload of
+        each record as soon as it is read, so that nothing but the current
+        line is held in memory. After each record, self.offset and
+        self.line_number are the byte offset and the number of the next line,
+        which can be given back as start_offset/start_line to resume.
+        Lines that cannot be parsed are logged with their line number and
+        skipped, self.errors counts them (-1 if the file cannot be opened).
+
+        :param force_extract: boolean decides if the normal checks should
+        be ignored and extracted regardless
+        :param force_send: boolean decides if the normal checks should
+        be ignored and send regardless
+        :param start_offset: byte offset of the line to start from
+        :param start_line: number (0-based) of the line to start from, the
+        lines before it are skipped (counted from start_offset if both given)
+        :return: generator of payload dictionaries
+        """
+
+        in_file = self.input_stream
+        self.offset = start_offset
+        self.line_number = start_line
+        self.errors = 0
+        try:
+            f = open(in_file, 'rb')
         except IOError as err:
+            self.errors = -1
             logger.warning('Exception in extracting file %s. Stacktrace: %s', in_file, sys.exc_info())
+            return
+
+        with f:
+            if start_offset:
+                f.seek(start_offset)
+            for _ in range(start_line):
+                line = f.readline()
+                if not line:
+                    break
+                self.offset += len(line)
+
+            for line in f:
+                line_offset = self.offset
+                self.offset += len(line)
+                self.line_number += 1
+                try:
+                    l = [i for i in line.decode('utf-8').strip().split('\t') if i != '']
+                    if len(l) == 0:
+                        continue
+                    payload_dictionary = {
+                        'bibcode': l[0],
+                        'ft_source': l[1],
+                        'provider': l[2]
+                    }
+                except Exception as err:
+                    self.errors += 1
+                    logger.warning('Extraction failed for file %s, line %d (offset %d): %s. Skipping', in_file, self.line_number, line_offset, line.decode('utf-8', 'replace').rstrip())
+                    continue
+
+                if force_extract:
+                    payload_dictionary['UPDATE'] = \
+                        'FORCE_TO_EXTRACT'
+
+                if force_send and not force_extract:
+                    payload_dictionary['UPDATE'] = \
+                        'FORCE_TO_SEND'
+
+                yield payload_dictionary
+
+
+
+class LinksSnapshot(object):
+    """
+    Compact snapshot of the rows of a links file: a sorted array of 64 bit
+    hashes of (bibcode, ft_source, provider), and optionally the last modified
+    time of the source files. It is used to only publish the rows that were
+    added or changed since the previous run.
+    """
 
-        return self.bibcode, self.full_text_path, self.provider, self.payload
+    def __init__(self, path, check_mtime=False):
+        """
+        Initialisation (constructor) method of the class, loads the snapshot
+        of the previous run if there is one
+        :param path: path to the snapshot file
+        :param check_mtime: also consider a row changed if the last modified
+        time of its source files changed
+        :return: no return
+        """
+
+        self.path = path
+        self.check_mtime = check_mtime
+        self.previous = array('Q')
+        self.current = array('Q')
+        self.added = 0
+        self.unchanged = 0
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                self.previous.frombytes(f.read())
+            logger.info('Loaded snapshot of %i rows from %s', len(self.previous), path)
+
+    def digest(self, record):
+        """
+        :param record: payload dictionary of a row of the links file
+        :return: 64 bit hash of the row
+        """
+
+        row = u'\t'.join((record['bibcode'], record['ft_source'], record['provider']))
+        if self.check_mtime:
+            try:
+                file_names = get_filenames(record['ft_source'])
+            except ValueError:
+                file_names = [record['ft_source']]
+            mtimes = []
+            for file_name in file_names:
+                try:
+                    mtimes.append(str(os.stat(file_name).st_mtime))
+                except OSError:
+                    mtimes.append('-')
+            row += u'\t' + u','.join(mtimes)
+        return int.from_bytes(hashlib.blake2b(row.encode('utf-8'), digest_size=8).digest(), 'little')
+
+    def changed(self, record):
+        """
+        Adds the row to the current snapshot
+        :param record: payload dictionary of a row of the links file
+        :return: True if the row is not in the previous snapshot
+        """
+
+        digest = self.digest(record)
+        self.current.append(digest)
+        i = bisect_left(self.previous, digest)
+        if i < len(self.previous) and self.previous[i] == digest:
+            self.unchanged += 1
+            return False
+        self.added += 1
+        return True
+
+    def filter(self, records):
+        """
+        :param records: iterable of payload dictionaries
+        :return: generator of the records that changed
+        """
+
+        for record in records:
+            if self.changed(record):
+                yield record
+
+    def save(self, merge=False):
+        """
+        Writes the current snapshot (the rows seen since it was loaded), it
+        replaces the previous one atomically
+        :param merge: also keep the rows of the previous snapshot, for runs
+        that only read part of the links file
+        :return: no return
+        """
+
+        rows = set(self.current)
+        if merge:
+            rows.update(self.previous)
+        current = array('Q', sorted(rows))
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(current.tobytes())
+        os.rename(tmp_path, self.path)
+        logger.info('Saved snapshot of %i rows to %s (%i added or changed, %i unchanged)',
+                    len(current), self.path, self.added, self.unchanged)
 
 
 
@@ -175,6 +336,22 @@ class TextCleaner(object):
     # merge the two translation maps, prioritizing the map to space translations
     tmp = master_translate_map.update(map_replace_with_space)
 
+    # stamped on the extractions cleaned by run (see extraction.extract_content),
+    # it must be increased when the output of run changes so that texts stored
+    # with a previous version are cleaned again before being sent
+    version = 1
+
+    # whitespace that trimwords changes: anything but single spaces between words
+    untrimmed_pattern = re.compile(r'[^\S ]|  |^ | $')
+
+    # finds the characters of the translation map below U+10000, on text that
+    # is not ASCII this is much faster than str.translate, which looks up every
+    # character (character classes with higher code points are slow, text
+    # that contains them is translated with str.translate)
+    translate_pattern = re.compile(_character_class([(start, end) for start, end in replace_with_none + replace_with_space
+                                                     if end <= 0xFFFF]) + '+')
+    supplementary_pattern = re.compile(_character_class([(0x10000, 0x10FFFF)]))
+
     def __init__(self, text):
         """
         Initialisation method (constructor) of the class
@@ -207,7 +384,14 @@ class TextCleaner(object):
         :return: no return
         """
 
-        self.text = self.text.translate(self.master_translate_map)
+        if isinstance(self.text, str) and not self.text.isascii() \
+                and not self.supplementary_pattern.search(self.text):
+            self.text = self.translate_pattern.sub(self._translate_match, self.text)
+        else:
+            self.text = self.text.translate(self.master_translate_map)
+
+    def _translate_match(self, match):
+        return match.group().translate(self.master_translate_map)
 
     def decode(self):
         """
@@ -247,7 +431,11 @@ class TextCleaner(object):
         else:
             test_type = unicode
 
-        self.text = unicodedata.normalize('NFKC', test_type(self.text))
+        self.text = test_type(self.text)
+        # ASCII text is already normalised, for other text normalize returns
+        # the same string after a quick check if it is already normalised
+        if not self.text.isascii():
+            self.text = unicodedata.normalize('NFKC', self.text)
 
     def trimwords(self, maxlength=100):
         """
@@ -258,7 +446,23 @@ class TextCleaner(object):
         :param maxlength: maximum length of words to keep
         :return: no return
         """
-        self.text = " ".join([word for word in self.text.split() if len(word) < maxlength])
+        words = self.text.split()
+        if max(map(len, words), default=0) >= maxlength:
+            words = [word for word in words if len(word) < maxlength]
+        self.text = " ".join(words)
+
+    @classmethod
+    def is_clean(cls, text):
+        """
+        Checks that a text made of texts cleaned by run (e.g. the xpaths of
+        an XML document, or the files of a source) was not joined with other
+        whitespace than single spaces, so that run would not change it
+
+        :param text: text made of cleaned texts
+        :return: True if run would leave the text unchanged
+        """
+
+        return cls.untrimmed_pattern.search(text) is None
 
     def run(self, translate=True, decode=True, normalise=True, trim=True):
         """
@@ -310,3 +514,35 @@ def get_filenames(file_string):
             files[i] = files[i][:-1]
 
     return files
+
+
+# Format of the index_date written in the meta.json files (UTC)
+INDEX_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+
+def format_index_date(date=None):
+    """
+    :param date: naive UTC datetime, now if not given
+    :return: the date as written in the index_date of the meta.json files
+    """
+    if date is None:
+        date = datetime.utcnow()
+    return date.strftime(INDEX_DATE_FORMAT)
+
+
+def parse_index_date(value):
+    """
+    Parses the index_date of a meta.json file. The dates written by the
+    pipeline are read with datetime.fromisoformat, dateutil is only used for
+    the legacy ones in other formats.
+
+    :param value: the index_date
+    :return: naive UTC datetime
+    """
+    try:
+        date = datetime.fromisoformat(value[:-1] if value.endswith('Z') else value)
+    except (ValueError, TypeError, AttributeError):
+        date = dateutil_parse(value)
+    if date.tzinfo is not None:
+        date = date.astimezone(tzutc()).replace(tzinfo=None)
+    return date
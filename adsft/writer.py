@@ -14,13 +14,14 @@ __status__ = 'Production'
 __credit__ = ['V. Sudilovsky', 'A. Accomazzi', 'J. Luker']
 __license__ = 'GPLv3'
 
-import sys
 import os
+import errno
 import json
 import tempfile
 import shutil
-import gzip
 from adsft.rules import META_CONTENT
+from adsft import compression
+from adsft.checker import extraction_state, SOURCE_FINGERPRINTER
 
 # ============================= INITIALIZATION ==================================== #
 # - Use app logger:
@@ -37,71 +38,105 @@ logger = setup_logging(__name__, proj_home=proj_home,
 
 # =============================== FUNCTIONS ======================================= #
 
-def write_to_temp_file(payload, temp_path='/tmp/', json_format=True):
+def write_to_temp_file(payload, temp_path='/tmp/', json_format=True, compresslevel=None, codec=None):
     """
     Writes the received payloadto a temporary file using the temporary file lib
 
     :param payload: text received from the pipeline
     :param temp_path: path to write the temporary file
     :param json_format: whether the given content is in json format
+    :param compresslevel: compression level of the content that is not in
+    json format (FULLTEXT_COMPRESSION_LEVEL by default)
+    :param codec: codec used to compress the content that is not in json
+    format (see compression.py, FULLTEXT_CODEC by default)
     :return: the temporary file name written to disk
     """
 
-    with tempfile.NamedTemporaryFile(mode='w', dir=temp_path,
-                                     delete=False) as temp_file:
-        temp_file_name = temp_file.name
-        temp_file_name_compress = temp_file_name + '.gz'
-        if json_format:
+    if json_format:
+        with tempfile.NamedTemporaryFile(mode='w', dir=temp_path,
+                                         delete=False) as temp_file:
+            temp_file_name = temp_file.name
             json.dump(payload, temp_file)
-        else:
-            if sys.version_info < (3,) and isinstance(payload, unicode):
-                temp_file.write(payload.encode('utf-8'))
-            else:
-                temp_file.write(payload) # assuming this is already a bytecode
-            temp_file.close()
-            with open(temp_file_name, 'rb') as file_in:
-                try:
-                    with gzip.open(temp_file_name_compress, 'wb') as file_out:
-                        shutil.copyfileobj(file_in, file_out)
-                    os.chmod(temp_file_name_compress, 0o640)
-                except Exception as err:
-                    logger.error('Unexpected error from shutil in copying temp file to compressed temp file: %s', err)
-
+    else:
+        if codec is None:
+            codec = compression.get_codec()
+        if compresslevel is None:
+            compresslevel = config.get('FULLTEXT_COMPRESSION_LEVEL', None)
+        if not isinstance(payload, bytes):
+            payload = payload.encode('utf-8')
+        # the content is compressed while it is written, there is no
+        # uncompressed copy on disk
+        with tempfile.NamedTemporaryFile(mode='wb', dir=temp_path, suffix=codec.suffix,
+                                         delete=False) as temp_file:
+            temp_file_name = temp_file.name
             try:
-                os.remove(temp_file_name)
+                codec.write(temp_file, payload, level=compresslevel)
             except Exception as err:
-                logger.error('Unexpected error from os in removing non-compressed temp file: %s', err)
-
-            temp_file_name = temp_file_name_compress
+                logger.error('Unexpected error from %s in writing compressed temp file: %s', codec.name, err)
 
     logger.debug('Temp file name: %s', temp_file_name)
 
     return temp_file_name
 
 
-def move_temp_file_to_file(temp_file_name, new_file_name):
+def move_temp_file_to_file(temp_file_name, new_file_name, fsync=None):
     """
-    Copies the temporary file to a new file with the wanted name. Removes the
-    old  temporary file on success.
+    Renames the temporary file to the new file with the wanted name, which
+    atomically replaces any previous version. The temporary file is copied
+    and removed only if they are not on the same file system.
 
     :param temp_file_name: name of the temporary file
     :param new_file_name: name wanted for the final file
+    :param fsync: flush the file (and the directory entry) to disk before
+    returning (WRITER_FSYNC by default)
     :return: no return is given
     """
 
+    if fsync is None:
+        fsync = config.get('WRITER_FSYNC', False)
+
     try:
-        shutil.copy(temp_file_name, new_file_name)
         # protect full-text from world access but keep it group-readable
-        os.chmod(new_file_name, 0o640)
+        os.chmod(temp_file_name, 0o640)
+        if fsync:
+            _fsync(temp_file_name)
     except Exception as err:
-        logger.error('Unexpected error from shutil in copying temporary file to new file: %s', err)
+        logger.error('Unexpected error from os in preparing temporary file: %s', err)
 
     try:
-        os.remove(temp_file_name)
-    except Exception as err:
-        logger.error('Unexpected error from os removing a file: %s', err)
+        os.replace(temp_file_name, new_file_name)
+    except OSError as err:
+        if err.errno != errno.EXDEV:
+            logger.error('Unexpected error from os in renaming temporary file to new file: %s', err)
+            return
+        try:
+            shutil.copy(temp_file_name, new_file_name)
+            os.chmod(new_file_name, 0o640)
+            if fsync:
+                _fsync(new_file_name)
+        except Exception as err:
+            logger.error('Unexpected error from shutil in copying temporary file to new file: %s', err)
+
+        try:
+            os.remove(temp_file_name)
+        except Exception as err:
+            logger.error('Unexpected error from os removing a file: %s', err)
+
+    if fsync:
+        try:
+            _fsync(os.path.dirname(new_file_name) or '.')
+        except Exception as err:
+            logger.error('Unexpected error from os in flushing directory: %s', err)
+
+    logger.debug('Succeeded to move: %s to %s', temp_file_name, new_file_name)
+
 
-    logger.debug('Succeeded to copy: %s to %s', temp_file_name, new_file_name)
+def _fsync(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
 
 def write_file(file_name, payload, json_format=True):
     """
@@ -124,7 +159,26 @@ def write_file(file_name, payload, json_format=True):
     move_temp_file_to_file(temp_file_name, file_name)
 
 
-def write_content(payload_dictionary):
+def remove_other_text_files(directory, name):
+    """
+    Removes the files of a content written with another codec than the one
+    in use (e.g. fulltext.txt.gz after writing fulltext.txt.zst), so that an
+    older version is never read
+
+    :param directory: pair tree directory of the article
+    :param name: name of the content, e.g. fulltext or acknowledgements
+    :return: no return
+    """
+
+    for path in compression.text_file_paths(directory, name)[1:]:
+        try:
+            os.remove(path)
+            logger.debug('Removed %s written with another codec', path)
+        except OSError:
+            pass
+
+
+def write_content(payload_dictionary, fingerprint=None):
     """
     Function that writes a single document to file. It expects a json-type
     payload that has been converted into a Python dictionary.
@@ -139,19 +193,25 @@ def write_content(payload_dictionary):
 
     :param payload_dictionary: the complete extracted content and meta-data of
     the document payload
-    :return: no return
+    :param fingerprint: save in the meta.json the fingerprint of the content of
+    the full text file (FT_SOURCE_FINGERPRINT by default)
+    :return: the state of the extraction for the extraction index (see
+    checker.extraction_state), None if no meta.json was written
     """
 
     meta_output_file_path = payload_dictionary['meta_path']
     bibcode_pair_tree_path = os.path.dirname(meta_output_file_path)
     if payload_dictionary['file_format'] == 'pdf-grobid':
         full_text_output_file_path = os.path.join(bibcode_pair_tree_path, 'grobid_fulltext.xml')
+        full_text_exists = os.path.exists(full_text_output_file_path)
     else:
-        full_text_output_file_path = os.path.join(bibcode_pair_tree_path, 'fulltext.txt.gz')
+        full_text_output_file_path = compression.text_file_path(bibcode_pair_tree_path, 'fulltext')
+        # the full text may have been written with another codec
+        full_text_exists = compression.find_text_file(bibcode_pair_tree_path, 'fulltext') is not None
 
     if 'UPDATE' in payload_dictionary and \
         payload_dictionary['UPDATE'] == 'FORCE_TO_SEND' and \
-        os.path.exists(meta_output_file_path) and os.path.exists(full_text_output_file_path):
+        os.path.exists(meta_output_file_path) and full_text_exists:
             # Data was already extracted and saved
             return
 
@@ -164,7 +224,7 @@ def write_content(payload_dictionary):
     # Write everything but the full text content to the meta.json
     meta_dict = {}
 
-    for const in ('meta_path', 'ft_source', 'bibcode', 'provider', 'UPDATE', 'file_format', 'index_date', 'dataset', 'facility'):
+    for const in ('meta_path', 'ft_source', 'bibcode', 'provider', 'UPDATE', 'file_format', 'index_date', 'dataset', 'facility', 'cleaner_version'):
         try:
             meta_dict[const] = payload_dictionary[const]
             logger.debug('Adding meta content: %s', const)
@@ -172,6 +232,13 @@ def write_content(payload_dictionary):
             #print('Missing meta content: {0}'.format(const))
             continue
 
+    if fingerprint is None:
+        fingerprint = config.get('FT_SOURCE_FINGERPRINT', False)
+    if fingerprint and payload_dictionary['file_format'] != 'pdf-grobid':
+        # hashed by the worker that extracted it, so that check_if_extract only
+        # reads the full text files that are newer than their extraction
+        meta_dict['ft_source_hash'] = SOURCE_FINGERPRINTER.fingerprint(payload_dictionary['ft_source'])
+
     # Write the custom extractions of content to the meta.json
     logger.debug('Copying extra meta content')
     for meta_key_word in META_CONTENT[payload_dictionary['file_format']]:
@@ -184,11 +251,12 @@ def write_content(payload_dictionary):
             meta_dict[meta_key_word] = meta_key_word_value
 
             try:
-                meta_constant_file_path = os.path.join(bibcode_pair_tree_path,
-                                                       meta_key_word) + '.txt.gz'
+                meta_constant_file_path = compression.text_file_path(bibcode_pair_tree_path,
+                                                                     meta_key_word)
                 logger.debug('Writing %s to file at: %s', meta_key_word, meta_constant_file_path)
                 write_file(meta_constant_file_path, meta_key_word_value,
                            json_format=False)
+                remove_other_text_files(bibcode_pair_tree_path, meta_key_word)
                 logger.info('WriteMetaFile: completed bibcode: %s', payload_dictionary['bibcode'])
             except IOError:
                 logger.error('IO Error when writing to file.')
@@ -198,7 +266,7 @@ def write_content(payload_dictionary):
             logger.debug('Does not contain the following meta data: %s', meta_key_word)
             continue
 
-    # Write the full text content to its own file fulltext.txt.gz
+    # Write the full text content to its own file (fulltext.txt.gz with gzip)
     logger.debug('Copying full text content')
 
     if 'fulltext' in payload_dictionary and payload_dictionary['fulltext'] != "":
@@ -206,6 +274,8 @@ def write_content(payload_dictionary):
             logger.debug('Writing to file: %s', full_text_output_file_path)
             logger.debug('Content has length: %s', len(payload_dictionary['fulltext']))
             write_file(full_text_output_file_path, payload_dictionary['fulltext'], json_format=False)
+            if payload_dictionary['file_format'] != 'pdf-grobid':
+                remove_other_text_files(bibcode_pair_tree_path, 'fulltext')
             logger.debug('Writing complete.')
         except IOError:
             logger.exception('IO Error when writing to file %s', payload_dictionary['bibcode'])
@@ -225,6 +295,8 @@ def write_content(payload_dictionary):
             logger.exception('IO Error when writing to file.')
             raise IOError
 
+        return extraction_state(meta_dict, meta_output_file_path)
+
 
 def extract_content(input_list, **kwargs):
     """
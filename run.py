@@ -6,7 +6,9 @@ import os
 import tempfile
 import argparse
 import json
-from adsft import tasks, utils
+import time
+from itertools import islice
+from adsft import tasks, utils, checker
 
 # ============================= INITIALIZATION ==================================== #
 
@@ -36,6 +38,60 @@ def read_links_from_file(file_input, force_extract=False, force_send=False):
     return FileInputStream
 
 
+def publish_in_bulk(task, records, packet_size=100, links=None):
+    """
+    Publishes the records to the given task in packets of packet_size records,
+    the task must accept a list of records. All the packets are sent through
+    the same producer connection, using publisher confirms so that we know the
+    broker has received them.
+
+    :param task: celery task the packets are sent to
+    :param records: iterable of records to publish
+    :param packet_size: number of records per packet
+    :param links: file stream the records are read from (see utils.py), its
+    position is logged so that an interrupted run can be resumed
+    :return: number of packets published
+    """
+    packet_size = max(1, packet_size)
+    records = iter(records)
+    start = time.time()
+    total = 0
+    packets = 0
+
+    if tasks.app.conf.get('CELERY_ALWAYS_EAGER'):
+        connection = None
+        publish = lambda packet: task.apply_async(args=(packet,))
+    else:
+        # publisher confirms on top of the configured transport options
+        transport_options = dict(tasks.app.conf.get('broker_transport_options') or {}, confirm_publish=True)
+        connection = tasks.app.connection_for_write(transport_options=transport_options)
+        producer = tasks.app.amqp.Producer(connection)
+        publish = lambda packet: task.apply_async(args=(packet,), producer=producer)
+
+    try:
+        while True:
+            packet = list(islice(records, packet_size))
+            if not packet:
+                break
+            publish(packet)
+            total += len(packet)
+            packets += 1
+            if packets % 1000 == 0:
+                elapsed = time.time() - start
+                logger.info("[%i] Published %i packets to '%s' (%.0f records/s)",
+                            total, packets, task.name, total / elapsed if elapsed else 0)
+                if links is not None:
+                    logger.info('Next line to publish: %i (offset %i)', links.line_number, links.offset)
+    finally:
+        if connection is not None:
+            connection.release()
+
+    elapsed = time.time() - start
+    logger.info("Published %i records in %i packets to '%s' in %.1f seconds (%.0f records/s)",
+                total, packets, task.name, elapsed, total / elapsed if elapsed else 0)
+    return packets
+
+
 def run(full_text_links, **kwargs):
     """
     Locates the file specified by the user, loads the list of bibcodes and
@@ -72,16 +128,53 @@ def run(full_text_links, **kwargs):
     else:
         facility_ner = False
 
+    if 'bulk' in kwargs:
+        bulk = kwargs['bulk']
+    else:
+        bulk = False
+
+    if 'packet_size' in kwargs:
+        packet_size = kwargs['packet_size']
+    else:
+        packet_size = 100
+
+    if 'start_offset' in kwargs:
+        start_offset = kwargs['start_offset']
+    else:
+        start_offset = 0
+
+    if 'start_line' in kwargs:
+        start_line = kwargs['start_line']
+    else:
+        start_line = 0
+
+    if 'snapshot' in kwargs:
+        snapshot = kwargs['snapshot']
+    else:
+        snapshot = None
+
+    if 'snapshot_mtime' in kwargs:
+        snapshot_mtime = kwargs['snapshot_mtime']
+    else:
+        snapshot_mtime = False
+
+    if snapshot and (force_extract or force_send or facility_ner):
+        # the snapshot records the rows checked for extraction, the rows
+        # published to another task or with forced updates would be skipped
+        # by the next run
+        raise ValueError('A snapshot cannot be used with forced extractions or sends, or facility identification')
 
     if diagnose:
-        print("Calling 'read_links_from_file' with filename '{}', force_extract set to '{}' and force_send "
+        print("Streaming links from file '{}', force_extract set to '{}' and force_send "
               "set to '{}'".format(full_text_links, str(force_extract), str(force_send)))
-    logger.debug("Calling 'read_links_from_file' with filename '%s', force_extract set to '%s' and force_send "
+    logger.debug("Streaming links from file '%s', force_extract set to '%s' and force_send "
                  "set to '%s'", full_text_links, str(force_extract), str(force_send))
-    records = read_links_from_file(
-        full_text_links,
+    links = utils.FileInputStream(full_text_links)
+    records = links.stream(
         force_extract=force_extract,
-        force_send=force_send
+        force_send=force_send,
+        start_offset=start_offset,
+        start_line=start_line
     )
 
 
@@ -99,22 +192,67 @@ def run(full_text_links, **kwargs):
 
     logger.info('Publishing records to: %s', task_str)
 
-    i = 0
-    total = len(records.payload)
-    for record in records.payload:
-        logger.debug('Publishing [%i/%i]: [%s]', i+1, total, record['bibcode'])
+    if snapshot:
+        # only the rows that are new or changed since the last run are
+        # published, the others are just added to the new snapshot
+        links_snapshot = utils.LinksSnapshot(snapshot, check_mtime=snapshot_mtime)
+        records = links_snapshot.filter(records)
+
+    if max_queue_size:
+        # islice stops before reading the next line, the position logged
+        # at the end is thus the first record that was not published
+        records = islice(records, max_queue_size)
+
+    if bulk and not diagnose:
+        publish_in_bulk(getattr(tasks, task_str), records, packet_size=packet_size, links=links)
+    else:
+        i = 0
+        for record in records:
+            logger.debug('Publishing [%i]: [%s]', i+1, record['bibcode'])
+
+            if diagnose:
+                print("[{}] Calling '{}' with '{}'".format(i+1, task_str, str(record)))
+            logger.debug("[%i] Calling '%s' with '%s'", i+1, task_str, str(record))
+            if i % 100000 == 0:
+                logger.info("[%i] Calling '%s' (line %i, offset %i)", i+1, task_str, links.line_number, links.offset)
+            getattr(tasks, task_str).delay(record)
+            i += 1
 
         if max_queue_size and i >= max_queue_size:
             logger.info('Max_queue_size reached, stopping. (Max queue size = %d)', max_queue_size)
-            break
 
-        if diagnose:
-            print("[{}/{}] Calling '{}' with '{}'".format(i+1, total, task_str, str(record)))
-        logger.debug("[%i/%i] Calling '%s' with '%s'", i+1, total, task_str, str(record))
-        if i % 100000 == 0:
-            logger.info("[%i/%i] Calling '%s'", i+1, total, task_str)
-        getattr(tasks, task_str).delay(record)
-        i += 1
+    if snapshot and not diagnose:
+        # the rows that were not read are kept from the previous snapshot
+        links_snapshot.save(merge=bool(start_offset or start_line or max_queue_size))
+
+    if links.errors:
+        logger.warning('%i lines of %s could not be read', links.errors, full_text_links)
+    logger.info('Stopped after line %i (offset %i) of %s', links.line_number, links.offset, full_text_links)
+
+def rebuild_extraction_index(extract_path, batch_size=1000):
+    """
+    Regenerates the extraction index from the meta.json files of the pair tree
+
+    :param extract_path: path where the full text content is extracted to
+    :param batch_size: number of entries saved per transaction
+    :return: number of entries saved
+    """
+    removed = tasks.app.reset_extraction_states()
+    logger.info('Removed %i entries from the extraction index', removed)
+    saved = 0
+    batch = []
+    for state in checker.walk_extraction_states(extract_path):
+        batch.append(state)
+        if len(batch) >= batch_size:
+            tasks.app.save_extraction_states(batch)
+            saved += len(batch)
+            batch = []
+            logger.info('Saved %i entries to the extraction index', saved)
+    if batch:
+        tasks.app.save_extraction_states(batch)
+        saved += len(batch)
+    logger.info('Rebuilt the extraction index with %i entries', saved)
+    return saved
 
 def build_diagnostics(bibcodes=None, raw_files=None, providers=None):
     tmp_file = tempfile.NamedTemporaryFile(delete=False)
@@ -191,6 +329,64 @@ if __name__ == '__main__':
                         action='store_true',
                         help='Run named entity recognition for facilities, this flag will be ignored if --extract_force is true.')
 
+    parser.add_argument('--bulk',
+                        dest='bulk',
+                        action='store_true',
+                        help='Publish the records in packets of --packet_size records through a single connection')
+
+    parser.add_argument('--packet_size',
+                        dest='packet_size',
+                        action='store',
+                        type=int,
+                        help='The number of records per packet when publishing in bulk')
+
+    parser.add_argument('--start-offset',
+                        dest='start_offset',
+                        action='store',
+                        type=int,
+                        default=0,
+                        help='Byte offset of the links file to start from (to resume an interrupted run)')
+
+    parser.add_argument('--start-line',
+                        dest='start_line',
+                        action='store',
+                        type=int,
+                        default=0,
+                        help='Number of lines of the links file to skip (to resume an interrupted run)')
+
+    parser.add_argument('--snapshot',
+                        dest='snapshot',
+                        action='store',
+                        default=None,
+                        metavar='PATH',
+                        help='Only publish the rows of the links file that were added or changed since the snapshot saved in PATH by the previous run (rows count as done once published)')
+
+    parser.add_argument('--snapshot-mtime',
+                        dest='snapshot_mtime',
+                        action='store_true',
+                        default=False,
+                        help='With --snapshot, also publish the rows whose source files were modified')
+
+    parser.add_argument('--parser-choices',
+                        dest='parser_choices',
+                        action='store_true',
+                        help='Show the XML parser learned for each provider and journal')
+
+    parser.add_argument('--reset-parser-choices',
+                        dest='reset_parser_choices',
+                        action='store',
+                        nargs='?',
+                        const='',
+                        default=None,
+                        metavar='PROVIDER[/BIBSTEM]',
+                        help='Forget the XML parsers learned (all of them, or only for a provider and/or journal)')
+
+    parser.add_argument('--rebuild-extraction-index',
+                        dest='rebuild_extraction_index',
+                        action='store_true',
+                        default=False,
+                        help='Regenerate the extraction index from the meta.json files in FULLTEXT_EXTRACT_PATH')
+
     parser.set_defaults(full_text_links=False)
     parser.set_defaults(packet_size=100)
     parser.set_defaults(purge_queues=False)
@@ -199,6 +395,7 @@ if __name__ == '__main__':
     parser.set_defaults(force_send=False)
     parser.set_defaults(diagnose=False)
     parser.set_defaults(facility_ner=False)
+    parser.set_defaults(bulk=False)
 
     args = parser.parse_args()
 
@@ -223,6 +420,31 @@ if __name__ == '__main__':
 
         args.full_text_links = build_diagnostics(raw_files=args.raw_files, bibcodes=args.bibcodes, providers=args.providers)
 
+    if args.parser_choices or args.reset_parser_choices is not None:
+        if not tasks.app.conf.get('SQLALCHEMY_URL'):
+            print("The XML parser choices are only kept when SQLALCHEMY_URL is set")
+            sys.exit(1)
+        if args.reset_parser_choices is not None:
+            provider, _, bibstem = args.reset_parser_choices.partition('/')
+            removed = tasks.app.reset_xml_parser_choices(provider=provider or None, bibstem=bibstem or None)
+            print("Removed {} XML parser choices".format(removed))
+        if args.parser_choices:
+            for choice in tasks.app.get_xml_parser_choices():
+                print(json.dumps(choice))
+        sys.exit(0)
+
+    if args.rebuild_extraction_index:
+        if not tasks.app.conf.get('SQLALCHEMY_URL'):
+            print("The extraction index is only kept when SQLALCHEMY_URL is set")
+            sys.exit(1)
+        saved = rebuild_extraction_index(tasks.app.conf['FULLTEXT_EXTRACT_PATH'])
+        print("Saved {} entries to the extraction index".format(saved))
+        sys.exit(0)
+
+    if args.snapshot and (args.force_extract or args.force_send or args.facility_ner):
+        print("--snapshot can only be used to check the records for extraction (not with -e, -s or --ner)")
+        sys.exit(1)
+
     if not args.full_text_links:
         print("You need to give the input list")
         parser.print_help()
@@ -235,7 +457,12 @@ if __name__ == '__main__':
         force_extract=args.force_extract,
         force_send=args.force_send,
         diagnose=args.diagnose,
-        facility_ner=args.facility_ner)
+        facility_ner=args.facility_ner,
+        bulk=args.bulk,
+        start_offset=args.start_offset,
+        start_line=args.start_line,
+        snapshot=args.snapshot,
+        snapshot_mtime=args.snapshot_mtime)
 
     if args.diagnose:
         print("Removing diagnostics temporary file '{}'".format(args.full_text_links))
@@ -0,0 +1,86 @@
+"""
+Benchmark of writer.write_file for the fulltext bodies, with gzip compression
+levels 1, 6 and 9, compared with the previous implementation (plain text
+written to a temporary file, reread and gzipped into a second temporary file).
+Reports the time per body, the throughput in MB/s of UTF-8 encoded text and
+the compression ratio.
+
+Run as:
+   python scripts/benchmark_compression.py [file ...]
+
+Without files, it uses the text of the test stub data cut in bodies of 50,
+100, 250 and 500 KB (the typical size of our fulltexts).
+"""
+from __future__ import print_function
+
+import glob
+import gzip
+import os
+import re
+import shutil
+import sys
+import tempfile
+import timeit
+
+proj_home = os.path.realpath(os.path.join(os.path.dirname(__file__), '../'))
+sys.path.insert(0, proj_home)
+from adsft import writer
+
+
+def previous_write_file(file_name, payload):
+    with tempfile.NamedTemporaryFile(mode='w', dir=os.path.dirname(file_name),
+                                     delete=False) as temp_file:
+        temp_file_name = temp_file.name
+        temp_file.write(payload)
+    with open(temp_file_name, 'rb') as file_in:
+        with gzip.open(temp_file_name + '.gz', 'wb') as file_out:
+            shutil.copyfileobj(file_in, file_out)
+    os.remove(temp_file_name)
+    shutil.copy(temp_file_name + '.gz', file_name)
+    os.remove(temp_file_name + '.gz')
+
+
+def load_texts(file_names):
+    texts = []
+    for file_name in file_names:
+        with open(file_name, 'rb') as f:
+            texts.append((os.path.basename(file_name), f.read().decode('utf-8', 'ignore')))
+    return texts
+
+
+def stub_texts():
+    content = []
+    for pattern in ('tests/test_unit/stub_data/*.txt', 'tests/test_unit/stub_data/*.xml',
+                    'tests/test_integration/stub_data/*.xml'):
+        for name, text in load_texts(sorted(glob.glob(os.path.join(proj_home, pattern)))):
+            # tags are removed to get something closer to an extracted text
+            content.append(' '.join(re.sub('<[^>]+>', ' ', text).split()))
+    content = ' '.join(content)
+    content = content * (500 * 1024 // len(content) + 1)
+    return [('stub-data-{0}KB'.format(size), content[:size * 1024]) for size in (50, 100, 250, 500)]
+
+
+if __name__ == '__main__':
+
+    file_names = sys.argv[1:]
+    texts = load_texts(file_names) if file_names else stub_texts()
+    tmp_dir = tempfile.mkdtemp()
+    file_name = os.path.join(tmp_dir, 'fulltext.txt.gz')
+
+    print("{0:20} {1:>8} {2:>10} {3:>10} {4:>10} {5:>8}".format('text', 'KB', 'method', 'ms', 'MB/s', 'ratio'))
+    try:
+        for name, text in texts:
+            size = len(text.encode('utf-8'))
+            methods = [('previous', lambda: previous_write_file(file_name, text))]
+            for level in (1, 6, 9):
+                methods.append(('level {0}'.format(level),
+                                lambda level=level: writer.move_temp_file_to_file(
+                                    writer.write_to_temp_file(text, tmp_dir, json_format=False, compresslevel=level),
+                                    file_name, fsync=False)))
+            for method, write in methods:
+                elapsed = min(timeit.repeat(write, number=5, repeat=3)) / 5
+                print("{0:20} {1:>8.0f} {2:>10} {3:>10.2f} {4:>10.1f} {5:>7.1f}x".format(
+                    name[:20], size / 1024., method, elapsed * 1000, size / elapsed / 1024. / 1024.,
+                    float(size) / os.path.getsize(file_name)))
+    finally:
+        shutil.rmtree(tmp_dir)
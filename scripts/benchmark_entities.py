@@ -0,0 +1,63 @@
+"""
+Micro-benchmark of the entity conversion applied to every XML and HTML file
+before parsing, compared with the previous implementation (re.sub calling
+entitymap for every entity).
+
+Run as:
+   python scripts/benchmark_entities.py [file ...]
+
+Without files, it uses the XML and HTML files of the test stub data and a
+synthetic MathML-like document with tens of thousands of entities.
+"""
+from __future__ import print_function
+
+import glob
+import os
+import re
+import sys
+import timeit
+
+proj_home = os.path.realpath(os.path.join(os.path.dirname(__file__), '../'))
+sys.path.insert(0, proj_home)
+from adsft import entitydefs as edef
+
+
+def previous_convertentities(input_string):
+    if input_string is None:
+        return input_string
+    return re.sub(r'&(#\d+|#x[0-9a-fA-F]+|\w+);', edef.entitymap, input_string)
+
+
+def load_documents(file_names):
+    documents = []
+    for file_name in file_names:
+        with open(file_name, 'rb') as f:
+            documents.append((os.path.basename(file_name), f.read().decode('utf-8', 'ignore')))
+    return documents
+
+
+def synthetic_documents():
+    mathml = u'<mml:mi>&alpha;</mml:mi><mml:mo>&PlusMinus;</mml:mo><mml:mn>&#x03B2;</mml:mn> text &amp; more &unknown; '
+    return [('synthetic-mathml', mathml * 10000),
+            ('synthetic-no-entities', u'<p>plain text without entities</p>' * 30000)]
+
+
+if __name__ == '__main__':
+
+    file_names = sys.argv[1:]
+    if file_names:
+        documents = load_documents(file_names)
+    else:
+        for pattern in ('tests/test_unit/stub_data/*.xml', 'tests/test_unit/stub_data/*.html',
+                        'tests/test_integration/stub_data/*.xml', 'tests/test_integration/stub_data/*.html'):
+            file_names.extend(sorted(glob.glob(os.path.join(proj_home, pattern))))
+        documents = load_documents(file_names) + synthetic_documents()
+
+    print("{0:40} {1:>10} {2:>12} {3:>12} {4:>8}".format('document', 'entities', 'previous ms', 'current ms', 'speedup'))
+    for name, document in documents:
+        assert edef.convertentities(document) == previous_convertentities(document), name
+        entities = len(edef.ENTITY_PATTERN.findall(document))
+        number = max(1, 200000 // max(len(document) // 100, 1))
+        previous = min(timeit.repeat(lambda: previous_convertentities(document), number=number, repeat=3)) / number
+        current = min(timeit.repeat(lambda: edef.convertentities(document), number=number, repeat=3)) / number
+        print("{0:40} {1:>10} {2:>12.3f} {3:>12.3f} {4:>7.1f}x".format(name[:40], entities, previous * 1000, current * 1000, previous / current))
@@ -0,0 +1,59 @@
+"""
+Reports the start up time and memory of a worker process with the spacy models
+for facilities loaded on first use (only by the processes running the NER)
+and with the models loaded by every process (as when they were loaded when
+adsft.tasks was imported).
+
+Run as:
+   python scripts/benchmark_ner_loading.py
+
+Each case is measured in a new Python process, the memory is the resident set
+size of the process (from /proc/self/status, or the maximum resident set size
+where /proc is not available).
+"""
+from __future__ import print_function
+
+import json
+import os
+import subprocess
+import sys
+
+proj_home = os.path.realpath(os.path.join(os.path.dirname(__file__), '../'))
+
+MEASURE = """
+import json, os, resource, sys, time
+sys.path.insert(0, {proj_home!r})
+
+def rss():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024.
+    except IOError:
+        pass
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 1024. / (1024. if sys.platform == 'darwin' else 1.)
+
+start = time.time()
+from adsft import tasks, ner
+if {load_models}:
+    for model in tasks.NER_MODELS:
+        ner.get_model(tasks.app.conf[model])
+print(json.dumps({{'seconds': time.time() - start, 'rss': rss()}}))
+"""
+
+
+def measure(load_models):
+    output = subprocess.check_output([sys.executable, '-c',
+                                      MEASURE.format(proj_home=proj_home, load_models=load_models)])
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+
+    print("{0:45} {1:>10} {2:>10}".format('worker process', 'start (s)', 'RSS (MB)'))
+    for name, load_models in (('extract, check and output (models not loaded)', False),
+                              ('facility-ner or previous version (both models)', True)):
+        result = measure(load_models)
+        print("{0:45} {1:>10.2f} {2:>10.0f}".format(name, result['seconds'], result['rss']))
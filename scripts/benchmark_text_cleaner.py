@@ -0,0 +1,73 @@
+"""
+Benchmark of TextCleaner.run, as used on the extracted full texts, compared
+with the previous implementation (str.translate, NFKC normalisation and a
+filtered split/join on every text). Reports the throughput in MB/s of
+UTF-8 encoded text.
+
+Run as:
+   python scripts/benchmark_text_cleaner.py [file ...]
+
+Without files, it uses the text of the test stub data repeated to a few MB,
+as ASCII text and with some non-ASCII characters.
+"""
+from __future__ import print_function
+
+import glob
+import os
+import re
+import sys
+import timeit
+import unicodedata
+
+proj_home = os.path.realpath(os.path.join(os.path.dirname(__file__), '../'))
+sys.path.insert(0, proj_home)
+from adsft.utils import TextCleaner
+
+
+def previous_run(text, translate=True, decode=True, normalise=True, trim=True):
+    if translate:
+        text = text.translate(TextCleaner.master_translate_map)
+    if decode and isinstance(text, bytes):
+        text = text.decode('utf-8', 'ignore')
+    if normalise:
+        text = unicodedata.normalize('NFKC', str(text))
+    if trim:
+        text = " ".join([word for word in text.split() if len(word) < 100])
+    return text
+
+
+def load_texts(file_names):
+    texts = []
+    for file_name in file_names:
+        with open(file_name, 'rb') as f:
+            texts.append((os.path.basename(file_name), f.read().decode('utf-8', 'ignore')))
+    return texts
+
+
+def stub_texts():
+    content = []
+    for pattern in ('tests/test_unit/stub_data/*.txt', 'tests/test_unit/stub_data/*.ocr',
+                    'tests/test_unit/stub_data/*.xml', 'tests/test_integration/stub_data/*.xml'):
+        for name, text in load_texts(sorted(glob.glob(os.path.join(proj_home, pattern)))):
+            # tags are removed to get something closer to an extracted text
+            content.append(re.sub('<[^>]+>', ' ', text))
+    content = ' '.join(content)
+    ascii_text = content.encode('ascii', 'ignore').decode('ascii')
+    repeat = 4 * 1024 * 1024 // len(ascii_text) + 1
+    return [('stub-data-ascii', ascii_text * repeat),
+            ('stub-data-unicode', (content + u' café –  \r\n') * repeat)]
+
+
+if __name__ == '__main__':
+
+    file_names = sys.argv[1:]
+    texts = load_texts(file_names) if file_names else stub_texts()
+
+    print("{0:30} {1:>10} {2:>14} {3:>14} {4:>8}".format('text', 'MB', 'previous MB/s', 'current MB/s', 'speedup'))
+    for name, text in texts:
+        # translate and decode as for XML, normalise and trim as for every text
+        assert TextCleaner(text=text).run(translate=True, decode=False) == previous_run(text, translate=True, decode=False), name
+        size = len(text.encode('utf-8')) / 1024. / 1024.
+        previous = min(timeit.repeat(lambda: previous_run(text, translate=True, decode=False), number=1, repeat=3))
+        current = min(timeit.repeat(lambda: TextCleaner(text=text).run(translate=True, decode=False), number=1, repeat=3))
+        print("{0:30} {1:>10.1f} {2:>14.1f} {3:>14.1f} {4:>7.1f}x".format(name[:30], size, size / previous, size / current, previous / current))
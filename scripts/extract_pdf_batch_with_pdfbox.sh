@@ -0,0 +1,16 @@
+#!/bin/bash
+
+# Call the PDF extractor once for many "source.pdf|output.txt" arguments, the
+# text of each PDF is written to its output file (missing if it failed)
+
+# modify these lines if you need to change java/locations etc.
+
+java=java
+home=`dirname "$BASH_SOURCE"`
+jar=$home/../target/ADSfulltext-1.2-SNAPSHOT-jar-with-dependencies.jar
+
+if [ $# -eq 0 ]; then
+	exit 0
+fi
+
+$java -jar $jar "$@"
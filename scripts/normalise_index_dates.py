@@ -0,0 +1,75 @@
+"""
+Rewrites the index_date of the meta.json files written by previous versions of
+the pipeline in the fixed format read without dateutil (utils.INDEX_DATE_FORMAT).
+The last modified time of the meta.json files is kept, as check_if_extract
+compares it with the ones of the source and fulltext files.
+
+Run as:
+   python scripts/normalise_index_dates.py [--dry-run] [extract_path]
+
+The extract path defaults to FULLTEXT_EXTRACT_PATH. If the extraction index is
+enabled, rebuild it afterwards with `python run.py --rebuild-extraction-index`.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import sys
+
+proj_home = os.path.realpath(os.path.join(os.path.dirname(__file__), '../'))
+sys.path.insert(0, proj_home)
+from adsputils import load_config
+from adsft import utils, writer
+
+
+def normalise_meta_file(meta_path, dry_run=False):
+    """
+    :param meta_path: path to a meta.json file
+    :param dry_run: do not rewrite the file
+    :return: True if the index_date was not in the fixed format
+    """
+    with open(meta_path, 'r') as f:
+        meta_content = json.load(f)
+    index_date = meta_content.get('index_date')
+    if not index_date:
+        return False
+    normalised = utils.format_index_date(utils.parse_index_date(index_date))
+    if normalised == index_date:
+        return False
+    if not dry_run:
+        meta_stat = os.stat(meta_path)
+        meta_content['index_date'] = normalised
+        writer.write_file(meta_path, meta_content, json_format=True)
+        os.utime(meta_path, (meta_stat.st_atime, meta_stat.st_mtime))
+    return True
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Normalise the index_date of the meta.json files')
+    parser.add_argument('extract_path', nargs='?', default=None,
+                        help='Root of the pair tree (FULLTEXT_EXTRACT_PATH by default)')
+    parser.add_argument('--dry-run', dest='dry_run', action='store_true', default=False,
+                        help='Only count the files that would be rewritten')
+    args = parser.parse_args()
+
+    extract_path = args.extract_path or load_config(proj_home=proj_home)['FULLTEXT_EXTRACT_PATH']
+
+    checked = normalised = failed = 0
+    for root, dirs, files in os.walk(extract_path):
+        if 'meta.json' not in files:
+            continue
+        meta_path = os.path.join(root, 'meta.json')
+        checked += 1
+        try:
+            if normalise_meta_file(meta_path, dry_run=args.dry_run):
+                normalised += 1
+        except Exception as err:
+            failed += 1
+            print('{0}: {1}'.format(meta_path, err), file=sys.stderr)
+        if checked % 100000 == 0:
+            print('{0} meta files checked, {1} normalised'.format(checked, normalised))
+
+    print('{0} meta files checked, {1} {2}normalised, {3} failed'.format(
+        checked, normalised, 'to be ' if args.dry_run else '', failed))
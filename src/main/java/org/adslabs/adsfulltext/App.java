@@ -21,6 +21,8 @@ import net.sourceforge.argparse4j.inf.Namespace;
 import net.sourceforge.argparse4j.inf.MutuallyExclusiveGroup;
 import net.sourceforge.argparse4j.impl.Arguments;
 
+import java.io.BufferedReader;
+import java.io.InputStreamReader;
 import java.nio.file.Files;
 import java.nio.file.Paths;
 import java.nio.charset.StandardCharsets;
@@ -34,8 +36,52 @@ public class App {
     // Variable declaration
     // --------------------------
     static Logger logger = LoggerFactory.getLogger(App.class);
+    // Responses in server mode carry this prefix so that the caller can tell
+    // them apart from log4j output, which is also written to stdout
+    static final String RESPONSE_PREFIX = "ADSFT-";
     // --------------------------
 
+    // Long-lived mode: keeps the JVM and PDFBox classes loaded and reads one
+    // "pdf|output" request per line from stdin, answering each with a single
+    // "OK <output>" or "ERROR <message>" line. "PING" is answered with "PONG"
+    // so the caller can health check the process.
+    //
+    private static void serve(PDFExtract extractor) throws IOException {
+        BufferedReader in = new BufferedReader(new InputStreamReader(System.in, StandardCharsets.UTF_8));
+        PrintStream out = new PrintStream(System.out, true, "UTF-8");
+        String line;
+
+        while ((line = in.readLine()) != null) {
+          line = line.trim();
+          if (line.isEmpty()) {
+            continue;
+          }
+          if (line.equals("PING")) {
+            out.println(RESPONSE_PREFIX + "PONG");
+            continue;
+          }
+
+          String[] parts = line.split("\\|");
+          if (parts.length != 2) {
+            logger.info("Ignoring erroneous input: " + line);
+            out.println(RESPONSE_PREFIX + "ERROR Erroneous input: " + line);
+            continue;
+          }
+
+          logger.debug("Extracting: " + parts[0]);
+          try {
+            String result = extractor.extract(parts[0]);
+            Files.write(Paths.get(parts[1]), result.getBytes(StandardCharsets.UTF_8));
+            out.println(RESPONSE_PREFIX + "OK " + parts[1]);
+          }
+          catch (Exception e) {
+            logger.error("Failed extracting {}, error: {}", line, e.getMessage());
+            String message = String.valueOf(e.getMessage()).replaceAll("[\\r\\n]+", " ");
+            out.println(RESPONSE_PREFIX + "ERROR " + message);
+          }
+        }
+    }
+
     public static void main(String[] args) throws Exception {
 
         // Parsing details
@@ -44,10 +90,13 @@ public class App {
         ArgumentParser parser = ArgumentParsers.newArgumentParser("ExtractPDF")
                 .defaultHelp(true)
                 .description("Application for extracting fulltext from PDF.");
+        parser.addArgument("--server")
+              .action(Arguments.storeTrue())
+              .help("Stay resident and read pdf|output requests from stdin, one per line");
         parser.addArgument("pdfs")
               .metavar("N")
               .type(String.class)
-              .nargs("+")
+              .nargs("*")
               .help("Location of the source pdf[| + output path to save results to]");
         // -------------------------------------------------------------------
         Namespace ns = null;
@@ -61,6 +110,11 @@ public class App {
          
         PDFExtract extractor = new PDFExtract();
         String result = null;
+
+        if (ns.getBoolean("server")) {
+          serve(extractor);
+          System.exit(0);
+        }
         
         for (String file: (List<String>) ns.get("pdfs")) {
           if (file.indexOf("|") > -1) {
@@ -74,7 +128,8 @@ public class App {
                 result = extractor.extract(parts[0]);
                 Files.write(Paths.get(parts[1]), result.getBytes(StandardCharsets.UTF_8));
               }
-              catch (IOException e) {
+              catch (Exception e) {
+                // keep going, a failed file only misses its output file
                 logger.error("Failed extracting {}, error: {}", file, e.getMessage());
                 e.printStackTrace();
               }